@@ -6,28 +6,45 @@ plugin's commands, listeners, and the plugin_loaded hook from the submodules
 under `utils/` so Sublime can discover them here.
 
 Implementation lives in the submodules:
-- utils/log.py         — _log / _log_error
+- utils/log.py         — _log / _log_error, log ring buffer, Show Log / Show Performance Stats
+- utils/metrics.py     — per-stage request timers and latency percentiles (no Sublime deps)
 - utils/text_utils.py  — pure text helpers (no Sublime deps)
-- utils/api.py         — HTTP / auth helpers
+- utils/api.py         — HTTP / auth helpers, keep-alive connection pool
 - utils/settings.py    — settings discovery, first-run wizard, Configure command
+- utils/snapshot.py    — per-buffer line snapshots kept in sync from edits
+- utils/symbols.py     — project symbol index for cross-file prompt context (no Sublime deps)
+- utils/retrieval.py   — BM25 snippet search over the open views (no Sublime deps)
+- utils/embeddings.py  — embedded project chunks and vector search (no Sublime deps)
 - utils/suggest.py     — phantom inline-suggestion flow
 - utils/chat.py        — chat-about-selection feature
+- utils/edit.py        — inline edit / refactor of the selection
 """
 
+from .utils.log import (  # noqa: F401
+    CodeContinueShowLogCommand,
+    CodeContinueShowPerformanceStatsCommand,
+)
 from .utils.settings import (  # noqa: F401
     CodeContinueConfigureCommand,
     plugin_loaded,
+    plugin_unloaded,
 )
+from .utils.snapshot import SnapshotChangeListener  # noqa: F401
 from .utils.suggest import (  # noqa: F401
     CodeContinueAcceptCommand,
     CodeContinueListener,
+    CodeContinueNextSuggestionCommand,
+    CodeContinuePreviousSuggestionCommand,
     CodeContinueSuggestCommand,
 )
 from .utils.chat import (  # noqa: F401
     ChatEventListener,
     CodeContinueChatCommand,
+    CodeContinueStopGeneratingCommand,
 )
 from .utils.edit import (  # noqa: F401
+    CodeContinueCancelEditCommand,
     CodeContinueEditCommand,
     CodeContinueReplaceSelectionCommand,
+    EditEventListener,
 )
@@ -0,0 +1,383 @@
+"""Offline benchmarks for the request path.
+
+Runs entirely on this machine: a `MockLLMServer` stands in for the model
+and `sublime_stub` for Sublime Text, so results are comparable between
+runs and regressions show up as numbers rather than impressions.
+
+    python tests/bench_request_path.py              # full run
+    python tests/bench_request_path.py --quick      # fewer iterations
+    python tests/bench_request_path.py --output bench_output.txt
+
+Sections:
+
+1. Provider hot paths: `get_provider`, payload building + JSON encoding,
+   response parsing, context building, BM25 retrieval (ops/s).
+2. Stream decoding: `iter_stream_text` over canned SSE / NDJSON bodies
+   (tokens/s).
+3. End to end against the mock server: suggest (chat, FIM, Anthropic,
+   Ollama; streaming and not; symbol context), chat and edit flows, plus
+   error injection.
+   Reports latency percentiles, throughput, and the plugin's own overhead
+   (wall time minus the time the mock server was told to take).
+4. The per-stage breakdown collected by `utils.metrics` during section 3.
+
+Not collected by `unittest discover` (file name does not start with test_).
+"""
+
+import argparse
+import io
+import itertools
+import json
+import os
+import random
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.dirname(HERE))
+
+import sublime_stub  # noqa: E402
+
+sublime = sublime_stub.install()
+
+from mock_server import DEFAULT_REPLY, MockLLMServer, split_tokens  # noqa: E402
+from utils import chat, edit, metrics, settings as settings_module, suggest  # noqa: E402
+from utils.api import AnthropicProvider, FIMProvider, OpenAIProvider, get_provider, iter_stream_text  # noqa: E402
+from utils.retrieval import ChunkIndex  # noqa: E402
+from utils.text_utils import build_context  # noqa: E402
+
+
+SETTINGS_FILE = "CodeContinue.sublime-settings"
+
+SAMPLE_CODE = "\n".join(
+    "def handler_{0}(request):\n    value = request.get('k{0}')\n    return transform(value)\n".format(i)
+    for i in range(40)
+)
+
+
+# -- helpers -------------------------------------------------------------------
+
+def percentiles(samples):
+    values = sorted(samples)
+    return (
+        metrics.percentile(values, 50),
+        metrics.percentile(values, 95),
+        values[-1],
+    )
+
+
+def ops_per_second(fn, min_time_s):
+    """Call *fn* repeatedly for at least *min_time_s*; return (ops/s, µs/op)."""
+    fn()  # warm up
+    count = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while elapsed < min_time_s:
+        for _ in range(50):
+            fn()
+        count += 50
+        elapsed = time.perf_counter() - start
+    return count / elapsed, elapsed / count * 1e6
+
+
+_VERBS = ("load", "save", "parse", "render", "fetch", "update", "build", "check", "merge", "encode", "scan", "sync")
+_NOUNS = ("user", "order", "invoice", "config", "session", "report", "token", "cache", "query", "page",
+          "account", "payload", "schema", "record", "event", "profile")
+
+
+def synthetic_module(doc, functions=60):
+    """~1000 lines of plausible Python whose functions call one another."""
+    rng = random.Random(doc)
+    name = lambda: "{0}_{1}".format(rng.choice(_VERBS), rng.choice(_NOUNS))
+    lines = []
+    for i in range(functions):
+        lines.append("def {0}_{1}(request, {2}):".format(name(), i, rng.choice(_NOUNS)))
+        for j in range(rng.randint(8, 20)):
+            lines.append("    {0}_{1} = {2}({3}.{4}, limit={5})".format(
+                rng.choice(_NOUNS), j, name(), rng.choice(_NOUNS), rng.choice(_NOUNS), j))
+        lines.extend(["    return {0}_0".format(rng.choice(_NOUNS)), ""])
+    return lines
+
+
+class CannedResponse:
+    """Just enough of a response for `iter_stream_text`."""
+
+    def __init__(self, body, content_type):
+        self.headers = {"Content-Type": content_type}
+        self._body = io.BytesIO(body)
+
+    def readline(self):
+        return self._body.readline()
+
+    def read(self, amt=None):
+        return self._body.read(amt)
+
+
+def configure(**overrides):
+    plugin_settings = sublime.load_settings(SETTINGS_FILE)
+    plugin_settings.clear()
+    plugin_settings.update({
+        "endpoint": "",
+        "model": "mock-coder",
+        "api_key": "",
+        "provider": "",
+        "stream": True,
+        "timeout_ms": 10000,
+        "trigger_language": ["python"],
+        "completion_mode": "chat",
+        "completion_cache_size": 0,
+        "context_token_budget": 1024,
+        "debug": False,
+    })
+    plugin_settings.update(overrides)
+    settings_module._notify_settings_change()
+    return plugin_settings
+
+
+def wait_for(predicate, timeout_s=15.0):
+    deadline = time.monotonic() + timeout_s
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.0005)
+    return True
+
+
+# -- section 1: provider hot paths -------------------------------------------------
+
+def bench_providers(out, min_time_s):
+    out.append("## Provider hot paths")
+    out.append("{0:<44}{1:>14}{2:>12}".format("operation", "ops/s", "µs/op"))
+    messages = [
+        {"role": "system", "content": suggest.DEFAULT_SYSTEM_PROMPT},
+        {"role": "user", "content": "Continue the following code:\n" + SAMPLE_CODE},
+    ]
+    openai, anthropic = OpenAIProvider(), AnthropicProvider()
+    fim = FIMProvider("completions", "qwen")
+    openai_body = json.dumps({"choices": [{"message": {"content": DEFAULT_REPLY}}]})
+    anthropic_body = json.dumps({"content": [{"type": "text", "text": DEFAULT_REPLY}]})
+    fim_body = json.dumps({"choices": [{"text": DEFAULT_REPLY}]})
+    plugin_settings = {"api_key": "sk-test"}
+    before, after = SAMPLE_CODE[:len(SAMPLE_CODE) // 2], SAMPLE_CODE[len(SAMPLE_CODE) // 2:]
+
+    retrieval = ChunkIndex()
+    views = [synthetic_module(doc) for doc in range(30)]
+    for doc, lines in enumerate(views):
+        retrieval.update(doc, "view_{0}.py".format(doc), lines, 0)
+    edits = itertools.count(1)
+    query_before, query_after = "\n".join(views[5][200:240]), "\n".join(views[5][240:250])
+
+    def reindex():
+        version = next(edits)
+        views[0][500] = "    value = request.get('edit{0}')".format(version % 2)
+        retrieval.update(0, "view_0.py", views[0], version)
+
+    cases = [
+        ("get_provider (OpenAI URL)", lambda: get_provider("http://localhost:1234/v1/chat/completions", plugin_settings)),
+        ("get_provider (Anthropic URL)", lambda: get_provider("https://api.anthropic.com/v1/messages", plugin_settings)),
+        ("OpenAI payload + json.dumps", lambda: json.dumps(openai.format_payload("m", messages, 1024, 0.3, True)).encode()),
+        ("Anthropic payload + json.dumps", lambda: json.dumps(anthropic.format_payload("m", messages, 1024, 0.3, True)).encode()),
+        ("FIM (qwen) payload + json.dumps", lambda: json.dumps(fim.format_payload("m", SAMPLE_CODE, SAMPLE_CODE, 1024, 0.3)).encode()),
+        ("OpenAI json.loads + parse_response", lambda: openai.parse_response(json.loads(openai_body))),
+        ("Anthropic json.loads + parse_response", lambda: anthropic.parse_response(json.loads(anthropic_body))),
+        ("FIM json.loads + parse_response", lambda: fim.parse_response(json.loads(fim_body))),
+        ("build_context (1024-token budget)", lambda: build_context(before, after, 1024, 0.75)),
+        ("BM25 re-index after a 1-line edit (1k lines)", reindex),
+        ("BM25 snippets (30 views, 30k lines)", lambda: retrieval.snippets(query_before, query_after, 512)),
+    ]
+    for name, fn in cases:
+        rate, micros = ops_per_second(fn, min_time_s)
+        out.append("{0:<44}{1:>14,.0f}{2:>12.2f}".format(name, rate, micros))
+    out.append("")
+
+
+# -- section 2: stream decoding ------------------------------------------------------
+
+def bench_streams(out, min_time_s):
+    out.append("## Stream decoding (iter_stream_text)")
+    out.append("{0:<44}{1:>14}{2:>12}".format("format", "tokens/s", "µs/token"))
+    tokens = split_tokens(DEFAULT_REPLY * 25)
+    openai_sse = b"".join(
+        "data: {0}\n\n".format(json.dumps({"choices": [{"delta": {"content": t}}]})).encode() for t in tokens
+    ) + b"data: [DONE]\n\n"
+    anthropic_sse = b"".join(
+        "event: content_block_delta\ndata: {0}\n\n".format(
+            json.dumps({"type": "content_block_delta", "delta": {"type": "text_delta", "text": t}})).encode()
+        for t in tokens
+    ) + b'data: {"type": "message_stop"}\n\n'
+    ollama_ndjson = b"".join(
+        (json.dumps({"message": {"content": t}, "done": False}) + "\n").encode() for t in tokens
+    ) + b'{"message": {"content": ""}, "done": true}\n'
+    cases = [
+        ("OpenAI SSE", openai_sse, "text/event-stream", OpenAIProvider()),
+        ("Anthropic SSE", anthropic_sse, "text/event-stream", AnthropicProvider()),
+        ("Ollama NDJSON", ollama_ndjson, "application/x-ndjson", OpenAIProvider()),
+    ]
+    for name, body, content_type, provider in cases:
+        def decode():
+            for _ in iter_stream_text(CannedResponse(body, content_type), provider):
+                pass
+        rate, micros = ops_per_second(decode, min_time_s)
+        out.append("{0:<44}{1:>14,.0f}{2:>12.2f}".format(name, rate * len(tokens), micros / len(tokens)))
+    out.append("")
+
+
+# -- section 3: end to end -------------------------------------------------------------
+
+def run_suggest(view, iteration):
+    """Trigger one suggestion in *view*; returns (seconds, ok)."""
+    # A distinct line per iteration keeps every request a cache miss.
+    text = SAMPLE_CODE + "\ndef bench_{0}():\n    ".format(iteration)
+
+    def trigger():
+        suggest.clear_phantoms(view)
+        view.text = text
+        view._change_count += 1
+        view.sel()[:] = [sublime.Region(len(text))]
+        start = time.monotonic()
+        suggest.CodeContinueSuggestCommand(view).run(None)
+        return start, suggest._states[view.id()]
+
+    start, state = sublime_stub.ui_call(trigger)
+    finished = wait_for(lambda: state.cancel_token is None)
+    sublime_stub.ui_drain()
+    elapsed = time.monotonic() - start
+    # Showing a non-streamed phantom replaces the state object.
+    shown = suggest._states.get(view.id())
+    return elapsed, finished and shown is not None and shown.has_phantom and not shown.streaming
+
+
+def run_chat(window, iteration, endpoint, provider_settings):
+    plugin_settings = sublime.load_settings(SETTINGS_FILE)
+    provider = get_provider(endpoint, plugin_settings)
+    chat_view = window.new_file()
+    state = chat.ChatState(
+        history=[
+            {"role": "system", "content": chat.CHAT_SYSTEM_PROMPT},
+            {"role": "user", "content": "Explain handler_{0}:\n```python\n{1}\n```".format(iteration, SAMPLE_CODE[:400])},
+        ],
+        endpoint=endpoint,
+        model=plugin_settings.get("model"),
+        timeout_s=10.0,
+        headers=provider.build_headers(provider_settings),
+        code=SAMPLE_CODE[:400],
+        lang="python",
+        file_name="bench.py",
+        provider=provider,
+        stream=plugin_settings.get("stream"),
+    )
+    chat._states[chat_view.id()] = state
+    state.requesting = True
+    start = time.monotonic()
+    sublime_stub.ui_call(chat._chat_do_api_call, chat_view, state)
+    finished = wait_for(lambda: not state.requesting)
+    elapsed = time.monotonic() - start
+    ok = finished and state.history[-1]["role"] == "assistant"
+    chat._states.pop(chat_view.id(), None)
+    return elapsed, ok
+
+
+def run_edit(window, iteration):
+    selected = "def handler_{0}(request):\n    return request\n".format(iteration)
+    view = sublime.View(text="# header\n" + selected, window=window)
+    view.sel()[:] = [sublime.Region(len("# header\n"), len(view.text))]
+    sublime_stub.ui_call(lambda: edit.CodeContinueEditCommand(view).run(None))
+    _caption, on_done, _on_cancel = window.input_panel
+    start = time.monotonic()
+    sublime_stub.ui_call(on_done, "add a docstring")
+    finished = wait_for(lambda: view.id() not in edit._states)
+    elapsed = time.monotonic() - start
+    return elapsed, finished and DEFAULT_REPLY.strip() in view.text
+
+
+def bench_end_to_end(out, iterations, ttft_s, tokens_per_s):
+    reply_tokens = len(split_tokens(DEFAULT_REPLY))
+    generation_s = ttft_s + (reply_tokens - 1) / tokens_per_s if tokens_per_s else ttft_s
+    out.append("## End to end (mock server: TTFT {0:.0f} ms, {1:.0f} tokens/s, {2} tokens/reply -> {3:.1f} ms of model time)".format(
+        ttft_s * 1000, tokens_per_s, reply_tokens, generation_s * 1000))
+    out.append("{0:<40}{1:>6}{2:>6}{3:>10}{4:>10}{5:>10}{6:>12}{7:>10}".format(
+        "flow", "ok", "fail", "p50 ms", "p95 ms", "max ms", "overhead ms", "req/s"))
+
+    window = sublime.Window()
+    scenarios = [
+        ("suggest / OpenAI chat / JSON", "/v1/chat/completions", {"stream": False}, "suggest", {}),
+        ("suggest / OpenAI chat / SSE", "/v1/chat/completions", {"stream": True}, "suggest", {}),
+        ("suggest / FIM completions / JSON", "/v1/chat/completions", {"stream": False, "completion_mode": "fim"}, "suggest", {}),
+        ("suggest / Anthropic / SSE", "/v1/messages", {"stream": True, "provider": "anthropic"}, "suggest", {}),
+        ("suggest / Ollama chat / NDJSON", "/api/chat", {"stream": True}, "suggest", {}),
+        ("suggest / 3 candidates via n / SSE", "/v1/chat/completions", {"stream": True, "num_candidates": 3}, "suggest", {}),
+        # Symbol index over this repository, scanned before the first request.
+        ("suggest / symbol context / SSE", "/v1/chat/completions", {"stream": True, "symbol_context_tokens": 256}, "suggest", {}),
+        ("chat / OpenAI / SSE", "/v1/chat/completions", {"stream": True}, "chat", {}),
+        ("edit / OpenAI / SSE", "/v1/chat/completions", {"stream": True}, "edit", {}),
+        ("suggest / 20% HTTP 500", "/v1/chat/completions", {"stream": False}, "suggest", {"error_rate": 0.2}),
+        ("suggest / 20% mid-stream disconnect", "/v1/chat/completions", {"stream": True}, "suggest", {"disconnect_rate": 0.2}),
+        # The primary stalls for 2 s; the backup server answers after the 100 ms hedge delay.
+        ("suggest / stalled primary, hedged", "/v1/chat/completions", {"stream": True, "hedge_delay_ms": 100}, "suggest", {"ttft_s": 2.0}),
+    ]
+    for name, path, overrides, flow, faults in scenarios:
+        shaping = dict(ttft_s=ttft_s, tokens_per_s=tokens_per_s)
+        with MockLLMServer(**dict(shaping, **faults)) as server, MockLLMServer(**shaping) as backup:
+            endpoint = server.url(path)
+            if "hedge_delay_ms" in overrides:
+                overrides = dict(overrides, secondary_endpoint=backup.url(path), secondary_model="mock-chat")
+            configure(endpoint=endpoint, **overrides)
+            view = sublime.View(window=window)
+            window.project_folders = [os.path.dirname(HERE)] if "symbol_context_tokens" in overrides else []
+            if window.project_folders:
+                index = sublime_stub.ui_call(suggest._symbol_index, view)
+                wait_for(lambda: index.refreshed_at is not None)
+            samples, failures = [], 0
+            started = time.monotonic()
+            for i in range(iterations):
+                if flow == "suggest":
+                    elapsed, ok = run_suggest(view, i)
+                elif flow == "chat":
+                    elapsed, ok = run_chat(window, i, endpoint, sublime.load_settings(SETTINGS_FILE))
+                else:
+                    elapsed, ok = run_edit(window, i)
+                if ok:
+                    samples.append(elapsed)
+                else:
+                    failures += 1
+            wall = time.monotonic() - started
+            sublime_stub.ui_call(suggest.clear_phantoms, view)
+        if samples:
+            p50, p95, worst = percentiles(samples)
+            out.append("{0:<40}{1:>6}{2:>6}{3:>10.1f}{4:>10.1f}{5:>10.1f}{6:>12.1f}{7:>10.1f}".format(
+                name, len(samples), failures, p50 * 1000, p95 * 1000, worst * 1000,
+                (p50 - generation_s) * 1000, iterations / wall))
+        else:
+            out.append("{0:<40}{1:>6}{2:>6}{3:>10}".format(name, 0, failures, "-"))
+    out.append("")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--quick", action="store_true", help="fewer iterations, shorter timing loops")
+    parser.add_argument("--iterations", type=int, default=None, help="end-to-end requests per scenario")
+    parser.add_argument("--ttft-ms", type=float, default=20.0, help="mock time to first token")
+    parser.add_argument("--tokens-per-s", type=float, default=400.0, help="mock generation speed (0 = instant)")
+    parser.add_argument("--output", help="also write the report to this file")
+    args = parser.parse_args(argv)
+
+    iterations = args.iterations or (10 if args.quick else 50)
+    min_time_s = 0.05 if args.quick else 0.3
+
+    out = ["# CodeContinue request-path benchmark", "python {0}".format(sys.version.split()[0]), ""]
+    bench_providers(out, min_time_s)
+    bench_streams(out, min_time_s)
+    bench_end_to_end(out, iterations, args.ttft_ms / 1000.0, args.tokens_per_s)
+    out.append("## Per-stage breakdown (utils.metrics)")
+    out.append(metrics.format_report())
+
+    report = "\n".join(out)
+    print(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+"""In-process mock LLM server for benchmarks and end-to-end checks.
+
+Speaks just enough of each wire format the plugin talks to:
+
+- OpenAI chat         POST /v1/chat/completions   (JSON or SSE)
+- OpenAI completions  POST /v1/completions        (JSON or SSE, FIM `prompt`/`suffix`)
+- Anthropic messages  POST /v1/messages           (JSON or SSE events)
+- Ollama              POST /api/chat, /api/generate (JSON or NDJSON; streams unless `"stream": false`)
+- Model lists         GET  /v1/models, /api/tags
+
+Latency is shaped per request: `ttft_s` before the first token, then
+`tokens_per_s` for the rest (0 sends everything at once). Errors are
+injected with `error_rate` (HTTP `error_status`, with Retry-After on 429)
+and `disconnect_rate` (the socket is dropped after the first token).
+OpenAI-style routes answer `"n": k` with k variants of the reply unless
+`honor_n` is False.
+
+    with MockLLMServer(reply="return x\\n", ttft_s=0.05, tokens_per_s=200) as server:
+        url = server.url("/v1/chat/completions")
+
+Standard library only.
+"""
+
+import http.server
+import json
+import random
+import re
+import socket
+import threading
+import time
+
+
+DEFAULT_REPLY = "    result = compute(value)\n    if result is None:\n        return default\n    return result\n"
+
+_TOKEN_RE = re.compile(r"\s*\S+|\s+")
+
+
+def split_tokens(text):
+    """Split *text* into word-ish tokens whose concatenation is *text*."""
+    return _TOKEN_RE.findall(text)
+
+
+class MockLLMServer:
+    """Threaded HTTP server on 127.0.0.1 with a random free port."""
+
+    def __init__(self, reply=DEFAULT_REPLY, ttft_s=0.0, tokens_per_s=0.0, error_rate=0.0,
+                 error_status=500, disconnect_rate=0.0, retry_after_s=1, seed=0, honor_n=True):
+        self.reply = reply
+        self.ttft_s = ttft_s
+        self.tokens_per_s = tokens_per_s
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.disconnect_rate = disconnect_rate
+        self.retry_after_s = retry_after_s
+        self.honor_n = honor_n
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = []         # (method, path, parsed JSON body or None)
+        self.errors = 0
+        self.disconnects = 0
+        self._httpd = None
+        self._thread = None
+
+    # -- lifecycle ---------------------------------------------------------
+
+    def start(self):
+        server = self
+
+        class Handler(_MockHandler):
+            mock = server
+
+        self._httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._httpd.daemon_threads = True
+        self._thread = threading.Thread(target=self._httpd.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._httpd is not None:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    @property
+    def port(self):
+        return self._httpd.server_address[1]
+
+    def url(self, path="/v1/chat/completions"):
+        return "http://127.0.0.1:{0}{1}".format(self.port, path)
+
+    # -- behaviour ---------------------------------------------------------
+
+    def _roll(self, rate):
+        if rate <= 0:
+            return False
+        with self._lock:
+            return self._random.random() < rate
+
+    def _note(self, method, path, body):
+        with self._lock:
+            self.requests.append((method, path, body))
+
+    def reset_counters(self):
+        with self._lock:
+            self.requests = []
+            self.errors = 0
+            self.disconnects = 0
+
+
+class _MockHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    mock = None  # set on the per-server subclass
+
+    def setup(self):
+        super().setup()
+        # Headers and body go out in separate writes; without this, Nagle
+        # plus the client's delayed ACK adds ~40 ms to every JSON reply.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    # -- plumbing ----------------------------------------------------------
+
+    def _send_json(self, status, obj, extra_headers=()):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in extra_headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _start_stream(self, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+    def _chunk(self, data):
+        self.wfile.write("{0:x}\r\n".format(len(data)).encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def _end_stream(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _drop(self):
+        with self.mock._lock:
+            self.mock.disconnects += 1
+        self.close_connection = True
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _paced_tokens(self):
+        """Yield reply tokens on the configured schedule."""
+        mock = self.mock
+        if mock.ttft_s:
+            time.sleep(mock.ttft_s)
+        interval = 1.0 / mock.tokens_per_s if mock.tokens_per_s else 0.0
+        for i, token in enumerate(split_tokens(mock.reply)):
+            if i and interval:
+                time.sleep(interval)
+            yield i, token
+
+    def _full_reply(self):
+        """Wait out TTFT and generation time, then return the whole reply."""
+        for _ in self._paced_tokens():
+            pass
+        return self.mock.reply
+
+    # -- routing -----------------------------------------------------------
+
+    def do_GET(self):
+        self.mock._note("GET", self.path, None)
+        if self.path.endswith("/models"):
+            self._send_json(200, {"data": [{"id": "mock-coder"}, {"id": "mock-chat"}]})
+        elif self.path.endswith("/api/tags"):
+            self._send_json(200, {"models": [{"name": "mock-coder"}]})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": "invalid JSON"})
+            return
+        mock = self.mock
+        mock._note("POST", self.path, body)
+
+        if mock._roll(mock.error_rate):
+            with mock._lock:
+                mock.errors += 1
+            headers = [("Retry-After", str(mock.retry_after_s))] if mock.error_status == 429 else []
+            self._send_json(mock.error_status, {"error": {"message": "injected error"}}, headers)
+            return
+
+        path = self.path.split("?", 1)[0]
+        if path.endswith("/chat/completions"):
+            self._openai_chat(body)
+        elif path.endswith("/completions"):
+            self._openai_completions(body)
+        elif path.endswith("/messages"):
+            self._anthropic(body)
+        elif path.endswith("/api/chat"):
+            self._ollama(body, chat=True)
+        elif path.endswith("/api/generate"):
+            self._ollama(body, chat=False)
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    # -- formats -----------------------------------------------------------
+
+    def _sse(self, events, done=True):
+        """Stream *events* (an iterator of (index, JSON-able)) as SSE."""
+        self._start_stream("text/event-stream")
+        for i, event in events:
+            if i == 1 and self.mock._roll(self.mock.disconnect_rate):
+                self._drop()
+                return
+            self._chunk("data: {0}\n\n".format(json.dumps(event)).encode())
+        if done:
+            self._chunk(b"data: [DONE]\n\n")
+        self._end_stream()
+
+    def _choices(self, body):
+        """The variants an OpenAI-style request asks for (`n`)."""
+        n = max(1, int(body.get("n", 1))) if self.mock.honor_n else 1
+        reply = self.mock.reply
+        return [reply if k == 0 else reply.replace("default", "fallback_{0}".format(k)) for k in range(n)]
+
+    def _variant_events(self, variants, make_choice):
+        """Interleave the variants' tokens, one chunk per choice per step."""
+        token_lists = [split_tokens(v) for v in variants]
+        for i, _token in self._paced_tokens():
+            for k, tokens in enumerate(token_lists):
+                if i < len(tokens):
+                    yield i, {"choices": [make_choice(k, tokens[i])]}
+        steps = len(token_lists[0])
+        for k, tokens in enumerate(token_lists):
+            for token in tokens[steps:]:
+                yield steps, {"choices": [make_choice(k, token)]}
+
+    def _openai_chat(self, body):
+        variants = self._choices(body)
+        if body.get("stream"):
+            self._sse(self._variant_events(variants, lambda k, t: {"index": k, "delta": {"content": t}}))
+            return
+        self._full_reply()
+        self._send_json(200, {
+            "id": "mock", "object": "chat.completion", "model": body.get("model", ""),
+            "choices": [{"index": k, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}
+                        for k, text in enumerate(variants)],
+        })
+
+    def _openai_completions(self, body):
+        variants = self._choices(body)
+        if body.get("stream"):
+            self._sse(self._variant_events(variants, lambda k, t: {"index": k, "text": t}))
+            return
+        self._full_reply()
+        self._send_json(200, {
+            "id": "mock", "object": "text_completion", "model": body.get("model", ""),
+            "choices": [{"index": k, "text": text, "finish_reason": "stop"} for k, text in enumerate(variants)],
+        })
+
+    def _anthropic(self, body):
+        if body.get("stream"):
+            def events():
+                yield 0, {"type": "message_start", "message": {"id": "mock", "role": "assistant"}}
+                yield 0, {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}
+                for i, token in self._paced_tokens():
+                    yield i, {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": token}}
+                yield 0, {"type": "content_block_stop", "index": 0}
+                yield 0, {"type": "message_stop"}
+            self._sse(events(), done=False)
+            return
+        self._send_json(200, {
+            "id": "mock", "type": "message", "role": "assistant",
+            "content": [{"type": "text", "text": self._full_reply()}], "stop_reason": "end_turn",
+        })
+
+    def _ollama(self, body, chat):
+        def chunk(text, done):
+            if chat:
+                return {"model": body.get("model", ""), "message": {"role": "assistant", "content": text}, "done": done}
+            return {"model": body.get("model", ""), "response": text, "done": done}
+
+        if body.get("stream", True):
+            self._start_stream("application/x-ndjson")
+            for i, token in self._paced_tokens():
+                if i == 1 and self.mock._roll(self.mock.disconnect_rate):
+                    self._drop()
+                    return
+                self._chunk((json.dumps(chunk(token, False)) + "\n").encode())
+            self._chunk((json.dumps(chunk("", True)) + "\n").encode())
+            self._end_stream()
+            return
+        self._send_json(200, chunk(self._full_reply(), True))
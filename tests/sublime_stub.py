@@ -0,0 +1,450 @@
+"""A small working stand-in for the `sublime` / `sublime_plugin` modules.
+
+Unlike the attribute stubs in the unit tests, this one runs the plugin:
+views hold real text, `set_timeout` callbacks run in order on a single
+"UI" thread (`ui_call` runs a function there and waits), and
+`view.run_command` dispatches to the plugin's TextCommand classes by their
+snake_case name. Used by the benchmarks to drive the suggest, chat and
+edit flows end to end.
+
+Call `install()` before importing anything from `utils`.
+"""
+
+import heapq
+import itertools
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import types
+
+
+# -- UI thread ---------------------------------------------------------------
+
+class _UILoop(threading.Thread):
+
+    def __init__(self):
+        super().__init__(name="stub UI thread", daemon=True)
+        self._queue = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def post(self, callback, delay_ms=0):
+        with self._cond:
+            heapq.heappush(self._queue, (time.monotonic() + delay_ms / 1000.0, next(self._seq), callback))
+            self._cond.notify()
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._queue or self._queue[0][0] > time.monotonic():
+                    timeout = self._queue[0][0] - time.monotonic() if self._queue else None
+                    self._cond.wait(timeout)
+                _due, _seq, callback = heapq.heappop(self._queue)
+            try:
+                callback()
+            except Exception as e:  # keep the loop alive like Sublime does
+                print("stub UI thread: {0!r}".format(e))
+
+
+_ui = _UILoop()
+
+
+def ui_call(fn, *args, **kwargs):
+    """Run *fn* on the UI thread and return its result."""
+    if threading.current_thread() is _ui:
+        return fn(*args, **kwargs)
+    done = threading.Event()
+    result = {}
+
+    def call():
+        try:
+            result["value"] = fn(*args, **kwargs)
+        except BaseException as e:
+            result["error"] = e
+        finally:
+            done.set()
+
+    _ui.post(call)
+    done.wait()
+    if "error" in result:
+        raise result["error"]
+    return result.get("value")
+
+
+def ui_drain():
+    """Wait until every callback posted so far has run."""
+    ui_call(lambda: None)
+
+
+# -- sublime -------------------------------------------------------------------
+
+class Region:
+
+    def __init__(self, a, b=None):
+        self.a = a
+        self.b = a if b is None else b
+
+    def begin(self):
+        return min(self.a, self.b)
+
+    def end(self):
+        return max(self.a, self.b)
+
+    def empty(self):
+        return self.a == self.b
+
+    def size(self):
+        return self.end() - self.begin()
+
+    def __repr__(self):
+        return "Region({0}, {1})".format(self.a, self.b)
+
+
+class Settings(dict):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._callbacks = {}
+
+    def set(self, key, value):
+        self[key] = value
+        for callbacks in list(self._callbacks.values()):
+            for callback in callbacks:
+                callback()
+
+    def erase(self, key):
+        self.pop(key, None)
+
+    def has(self, key):
+        return key in self
+
+    def add_on_change(self, tag, callback):
+        self._callbacks.setdefault(tag, []).append(callback)
+
+    def clear_on_change(self, tag):
+        self._callbacks.pop(tag, None)
+
+
+class Syntax:
+
+    def __init__(self, name="Python", scope="source.python", path="Packages/Python/Python.sublime-syntax"):
+        self.name = name
+        self.scope = scope
+        self.path = path
+
+
+class Phantom:
+
+    def __init__(self, region, content, layout):
+        self.region = region
+        self.content = content
+        self.layout = layout
+
+
+class PhantomSet:
+
+    def __init__(self, view, key=""):
+        self.view = view
+        self.key = key
+        self.phantoms = []
+
+    def update(self, phantoms):
+        self.phantoms = list(phantoms)
+        self.view.phantom_updates += 1
+
+
+class Selection(list):
+
+    def clear(self):
+        del self[:]
+
+    def add(self, region):
+        self.append(region)
+
+
+_ids = itertools.count(1)
+
+
+class View:
+
+    def __init__(self, text="", window=None, syntax=None):
+        self._id = next(_ids)
+        self.text = text
+        self._sel = Selection([Region(len(text))])
+        self._settings = Settings()
+        self._syntax = syntax or Syntax()
+        self._window = window
+        self._change_count = 0
+        self._read_only = False
+        self._scratch = False
+        self._regions = {}
+        self.status = {}
+        self.phantom_updates = 0
+        self._name = ""
+
+    # identity / metadata
+    def id(self):
+        return self._id
+
+    def buffer_id(self):
+        return self._id
+
+    def window(self):
+        return self._window
+
+    def settings(self):
+        return self._settings
+
+    def syntax(self):
+        return self._syntax
+
+    def meta_info(self, key, point):
+        if key == "shellVariables" and self._syntax.scope == "source.python":
+            return [{"name": "TM_COMMENT_START", "value": "# "}]
+        return []
+
+    def file_name(self):
+        return None
+
+    def clones(self):
+        return []
+
+    def change_count(self):
+        return self._change_count
+
+    def set_name(self, name):
+        self._name = name
+
+    def name(self):
+        return self._name
+
+    def set_scratch(self, scratch):
+        self._scratch = scratch
+
+    def is_scratch(self):
+        return self._scratch
+
+    def assign_syntax(self, syntax):
+        pass
+
+    def is_read_only(self):
+        return self._read_only
+
+    def set_read_only(self, value):
+        self._read_only = value
+
+    def set_status(self, key, value):
+        self.status[key] = value
+
+    def erase_status(self, key):
+        self.status.pop(key, None)
+
+    # text
+    def size(self):
+        return len(self.text)
+
+    def substr(self, region):
+        if isinstance(region, int):
+            return self.text[region:region + 1]
+        return self.text[region.begin():region.end()]
+
+    def sel(self):
+        return self._sel
+
+    def rowcol(self, point):
+        before = self.text[:point]
+        row = before.count("\n")
+        return row, point - (before.rfind("\n") + 1)
+
+    def text_point(self, row, col):
+        lines = self.text.split("\n")
+        return sum(len(line) + 1 for line in lines[:row]) + col
+
+    def line(self, point):
+        if isinstance(point, Region):
+            point = point.begin()
+        start = self.text.rfind("\n", 0, point) + 1
+        end = self.text.find("\n", point)
+        return Region(start, len(self.text) if end < 0 else end)
+
+    def _edit(self, begin, end, text):
+        self.text = self.text[:begin] + text + self.text[end:]
+        self._change_count += 1
+
+    def insert(self, edit, point, text):
+        self._edit(point, point, text)
+        return len(text)
+
+    def replace(self, edit, region, text):
+        self._edit(region.begin(), region.end(), text)
+
+    def erase(self, edit, region):
+        self._edit(region.begin(), region.end(), "")
+
+    # regions
+    def add_regions(self, key, regions, *args, **kwargs):
+        self._regions[key] = list(regions)
+
+    def get_regions(self, key):
+        return list(self._regions.get(key, []))
+
+    def erase_regions(self, key):
+        self._regions.pop(key, None)
+
+    # commands
+    def run_command(self, name, args=None):
+        args = args or {}
+        if name == "append":
+            self._edit(len(self.text), len(self.text), args.get("characters", ""))
+        elif name == "select_all":
+            self._sel[:] = [Region(0, len(self.text))]
+        elif name in ("left_delete", "right_delete"):
+            region = self._sel[0]
+            self._edit(region.begin(), region.end(), "")
+            self._sel[:] = [Region(region.begin())]
+        elif name == "move_to":
+            self._sel[:] = [Region(len(self.text))]
+        else:
+            command = _find_command(name)
+            if command is not None:
+                command(self).run(None, **args)
+
+
+class Window:
+
+    def __init__(self):
+        self._id = next(_ids)
+        self.views = []
+        self.input_panel = None   # (caption, on_done, on_cancel) of the last input panel
+        self.panels = {}
+        self.layout = {}
+        self.project_folders = []
+
+    def id(self):
+        return self._id
+
+    def folders(self):
+        return list(self.project_folders)
+
+    def new_file(self):
+        view = View(window=self)
+        self.views.append(view)
+        return view
+
+    def show_input_panel(self, caption, initial, on_done, on_change, on_cancel):
+        self.input_panel = (caption, on_done, on_cancel)
+
+    def show_quick_panel(self, items, on_select, *args, **kwargs):
+        on_select(-1)
+
+    def create_output_panel(self, name):
+        view = self.panels[name] = View(window=self)
+        return view
+
+    def run_command(self, name, args=None):
+        pass
+
+    def get_layout(self):
+        return self.layout
+
+    def set_layout(self, layout):
+        self.layout = layout
+
+    def set_view_index(self, view, group, index):
+        pass
+
+    def focus_view(self, view):
+        pass
+
+
+_settings = {}
+_active_window = Window()
+_cache_dir = os.path.join(tempfile.gettempdir(), "codecontinue-stub-cache")
+
+
+def load_settings(name):
+    settings = _settings.get(name)
+    if settings is None:
+        settings = _settings[name] = Settings()
+    return settings
+
+
+def set_timeout(callback, delay=0):
+    _ui.post(callback, delay)
+
+
+def _snake_case(name):
+    return re.sub(r"(?<!^)(?=[A-Z])", "_", name).lower()
+
+
+def _find_command(name):
+    """Find the loaded TextCommand subclass registered as *name*."""
+    plugin = sys.modules["sublime_plugin"]
+    pending = list(plugin.TextCommand.__subclasses__())
+    while pending:
+        cls = pending.pop()
+        pending.extend(cls.__subclasses__())
+        if cls.__name__.endswith("Command") and _snake_case(cls.__name__[:-len("Command")]) == name:
+            return cls
+    return None
+
+
+# -- sublime_plugin --------------------------------------------------------------
+
+class EventListener:
+    pass
+
+
+class ViewEventListener:
+    pass
+
+
+class TextChangeListener:
+    pass
+
+
+class TextCommand:
+
+    def __init__(self, view):
+        self.view = view
+
+
+class WindowCommand:
+
+    def __init__(self, window):
+        self.window = window
+
+
+def install():
+    """Register the stub modules (idempotent) and start the UI thread."""
+    if "sublime" in sys.modules and getattr(sys.modules["sublime"], "_is_stub", False):
+        return sys.modules["sublime"]
+    sublime = types.ModuleType("sublime")
+    sublime._is_stub = True
+    for name, value in {
+        "Region": Region, "Settings": Settings, "Syntax": Syntax, "Phantom": Phantom,
+        "PhantomSet": PhantomSet, "View": View, "Window": Window,
+        "LAYOUT_INLINE": 0, "LAYOUT_BELOW": 1, "LAYOUT_BLOCK": 2, "DRAW_NO_FILL": 32,
+        "load_settings": load_settings, "save_settings": lambda name: None,
+        "set_timeout": set_timeout, "set_timeout_async": set_timeout,
+        "status_message": lambda msg: None, "error_dialog": lambda msg: None,
+        "message_dialog": lambda msg: None, "active_window": lambda: _active_window,
+        "cache_path": lambda: _cache_dir,
+    }.items():
+        setattr(sublime, name, value)
+
+    sublime_plugin = types.ModuleType("sublime_plugin")
+    for name, value in {
+        "EventListener": EventListener, "ViewEventListener": ViewEventListener,
+        "TextChangeListener": TextChangeListener, "TextCommand": TextCommand,
+        "WindowCommand": WindowCommand,
+    }.items():
+        setattr(sublime_plugin, name, value)
+
+    sys.modules["sublime"] = sublime
+    sys.modules["sublime_plugin"] = sublime_plugin
+    _ui.start()
+    return sublime
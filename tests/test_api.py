@@ -7,19 +7,77 @@ import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from unittest.mock import MagicMock, patch
+import http.server
+import io
+import json
+import socket
+import threading
+import time
 import urllib.error
 
+from utils import api
 from utils.api import (
+    BREAKER_CLOSED,
+    BREAKER_HALF_OPEN,
+    BREAKER_OPEN,
     AnthropicProvider,
+    CancelToken,
+    ConnectionPool,
+    EndpointHealth,
+    EndpointUnavailable,
+    FIMProvider,
     OpenAIProvider,
+    RequestCancelled,
+    SlotAffinity,
+    detect_fim_template,
     fetch_models,
+    format_usage,
+    get_embeddings_endpoint,
+    get_fim_endpoint,
+    get_fim_provider,
     get_models_endpoint,
     get_provider,
+    is_outage_error,
+    iter_stream_text,
     normalize_endpoint,
+    parse_usage,
     test_endpoint_connectivity,
 )
 
 
+class _FakeStreamResponse(io.BytesIO):
+    """BytesIO with the `headers` attribute iter_stream_text inspects."""
+
+    def __init__(self, body, content_type):
+        super().__init__(body)
+        self.headers = {"Content-Type": content_type}
+
+
+class _KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    """Echo handler that speaks HTTP/1.1 keep-alive and records client ports."""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.server.client_ports.add(self.client_address[1])
+        length = int(self.headers.get("Content-Length", 0))
+        payload = self.rfile.read(length)
+        if b"slow" in payload:
+            time.sleep(1.0)
+        status = 500 if b"fail" in payload else 200
+        body = json.dumps({"echo": payload.decode()}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        # Simulate a server-side keep-alive timeout: close without telling the client.
+        self.close_connection = b"drop" in payload
+
+    def log_message(self, *args):
+        pass
+
+
 class TestEndpointHelpers(unittest.TestCase):
     def test_normalize_endpoint_empty(self):
         self.assertEqual(normalize_endpoint(""), "")
@@ -51,6 +109,27 @@ class TestEndpointHelpers(unittest.TestCase):
         self.assertEqual(get_models_endpoint("http://localhost:11434/api/chat"), "http://localhost:11434/api/tags")
 
 
+    def test_get_embeddings_endpoint(self):
+        self.assertEqual(get_embeddings_endpoint("http://localhost:1234"), "http://localhost:1234/v1/embeddings")
+        self.assertEqual(get_embeddings_endpoint("http://localhost:11434/api/chat"), "http://localhost:11434/v1/embeddings")
+        self.assertEqual(get_embeddings_endpoint("https://api.anthropic.com"), "")
+
+    def test_get_fim_endpoint(self):
+        self.assertEqual(
+            get_fim_endpoint("http://localhost:8000"),
+            ("http://localhost:8000/v1/completions", "completions"),
+        )
+        self.assertEqual(
+            get_fim_endpoint("http://localhost:8080/v1/chat/completions", "infill"),
+            ("http://localhost:8080/infill", "infill"),
+        )
+        self.assertEqual(
+            get_fim_endpoint("http://localhost:11434/api/chat"),
+            ("http://localhost:11434/api/generate", "ollama"),
+        )
+        self.assertEqual(get_fim_endpoint("https://api.anthropic.com"), (None, None))
+
+
 class TestFetchModels(unittest.TestCase):
     @patch("urllib.request.urlopen")
     def test_fetch_models_openai_format(self, mock_urlopen):
@@ -106,6 +185,294 @@ class TestConnectivity(unittest.TestCase):
         self.assertIn("Connection refused", msg)
 
 
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _KeepAliveHandler)
+        self.server.client_ports = set()
+        threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True).start()
+        self.url = "http://127.0.0.1:{0}/v1/chat/completions".format(self.server.server_address[1])
+        self.pool = ConnectionPool(max_per_host=2, idle_timeout_s=30.0)
+
+    def tearDown(self):
+        self.pool.close_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _post(self, text):
+        with self.pool.request(self.url, data=text.encode(), timeout_s=5.0) as resp:
+            return json.loads(resp.read().decode())
+
+    def test_reuses_connection(self):
+        self.assertEqual(self._post("one"), {"echo": "one"})
+        self.assertEqual(self._post("two"), {"echo": "two"})
+        self.assertEqual(len(self.server.client_ports), 1)
+
+    def test_idle_eviction(self):
+        self._post("one")
+        self.pool.idle_timeout_s = 0.0
+        self._post("two")
+        self.assertEqual(len(self.server.client_ports), 2)
+
+    def test_http_error_raises_and_keeps_connection(self):
+        with self.assertRaises(urllib.error.HTTPError) as ctx:
+            self._post("fail")
+        self.assertEqual(ctx.exception.code, 500)
+        self._post("ok")
+        self.assertEqual(len(self.server.client_ports), 1)
+
+    def test_connection_cap(self):
+        first = self.pool.request(self.url, data=b"a", timeout_s=5.0)
+        second = self.pool.request(self.url, data=b"b", timeout_s=5.0)
+        with self.assertRaises(urllib.error.URLError):
+            self.pool.request(self.url, data=b"c", timeout_s=0.05)
+        first.read()
+        first.close()
+        second.read()
+        second.close()
+        self.assertEqual(self._post("d"), {"echo": "d"})
+
+    def test_stale_connection_retried(self):
+        self._post("drop")
+        self.assertEqual(self._post("two"), {"echo": "two"})
+        self.assertEqual(len(self.server.client_ports), 2)
+
+    def test_cancel_while_waiting_for_response(self):
+        token = CancelToken()
+        threading.Timer(0.1, token.cancel, args=("superseded",)).start()
+        start = time.monotonic()
+        with self.assertRaises(RequestCancelled):
+            self.pool.request(self.url, data=b"slow", timeout_s=5.0, cancel=token)
+        self.assertLess(time.monotonic() - start, 0.9)
+        self.assertEqual(self._post("after"), {"echo": "after"})
+
+    def test_cancelled_token_rejects_new_request(self):
+        token = CancelToken()
+        token.cancel("view closed")
+        with self.assertRaises(RequestCancelled):
+            self.pool.request(self.url, data=b"x", timeout_s=5.0, cancel=token)
+
+    def test_cancel_after_close_does_not_touch_pooled_socket(self):
+        token = CancelToken()
+        with self.pool.request(self.url, data=b"one", timeout_s=5.0, cancel=token) as resp:
+            resp.read()
+        token.cancel("late")
+        self.assertEqual(self._post("two"), {"echo": "two"})
+        self.assertEqual(len(self.server.client_ports), 1)
+
+    def test_refused_connection_raises_url_error(self):
+        probe = socket.socket()
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+        probe.close()
+        with self.assertRaises(urllib.error.URLError):
+            self.pool.request("http://127.0.0.1:{0}/v1".format(port), data=b"x", timeout_s=1.0)
+
+
+class TestEndpointHealth(unittest.TestCase):
+    URL = "http://127.0.0.1:1234/v1/chat/completions"
+
+    def setUp(self):
+        self.probe_ok = False
+        self.changes = []
+        self.health = EndpointHealth(
+            failure_threshold=2, probe_interval_s=3600.0,
+            probe=lambda url: self.probe_ok, on_change=lambda url, state: self.changes.append(state),
+        )
+
+    def _open(self):
+        for _ in range(2):
+            self.health.note_failure(self.URL)
+        return api._host_key(self.URL)
+
+    def test_opens_after_consecutive_failures(self):
+        self.health.note_failure(self.URL)
+        self.health.note_success(self.URL)
+        self.health.note_failure(self.URL)
+        self.assertTrue(self.health.allow(self.URL))
+        self.health.note_failure(self.URL)
+        self.assertFalse(self.health.allow(self.URL))
+        self.assertEqual(self.changes, [BREAKER_OPEN])
+
+    def test_breaker_is_per_host(self):
+        self._open()
+        self.assertFalse(self.health.allow("http://127.0.0.1:1234/v1/completions"))
+        self.assertTrue(self.health.allow("http://127.0.0.1:8080/v1/chat/completions"))
+
+    def test_probe_half_opens_and_success_closes(self):
+        key = self._open()
+        self.assertFalse(self.health.probe_once(key))
+        self.assertEqual(self.health.state(self.URL), BREAKER_OPEN)
+        self.probe_ok = True
+        self.assertTrue(self.health.probe_once(key))
+        self.assertEqual(self.health.state(self.URL), BREAKER_HALF_OPEN)
+        self.assertTrue(self.health.allow(self.URL))
+        self.health.note_success(self.URL)
+        self.assertEqual(self.health.state(self.URL), BREAKER_CLOSED)
+        self.assertEqual(self.changes, [BREAKER_OPEN, BREAKER_CLOSED])
+
+    def test_half_open_failure_reopens_at_once(self):
+        key = self._open()
+        self.probe_ok = True
+        self.health.probe_once(key)
+        self.health.note_failure(self.URL)
+        self.assertEqual(self.health.state(self.URL), BREAKER_OPEN)
+
+    def test_half_open_lets_one_trial_through(self):
+        key = self._open()
+        self.probe_ok = True
+        self.health.probe_once(key)
+        self.assertTrue(self.health.acquire(self.URL))
+        self.assertFalse(self.health.acquire(self.URL))
+        self.assertFalse(self.health.allow(self.URL))
+        self.health.release(self.URL)  # e.g. the trial was cancelled
+        self.assertTrue(self.health.acquire(self.URL))
+        self.health.note_success(self.URL)
+        self.assertEqual(self.health.state(self.URL), BREAKER_CLOSED)
+        self.assertTrue(self.health.acquire(self.URL))
+        self.assertTrue(self.health.acquire(self.URL))
+
+    def test_background_probe_detects_recovery(self):
+        self.health.probe_interval_s = 0.01
+        self.probe_ok = True
+        self._open()
+        deadline = time.monotonic() + 2.0
+        while self.health.state(self.URL) == BREAKER_OPEN and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.health.state(self.URL), BREAKER_HALF_OPEN)
+
+    def test_outage_errors(self):
+        self.assertTrue(is_outage_error(urllib.error.URLError("refused")))
+        self.assertTrue(is_outage_error(urllib.error.HTTPError(self.URL, 503, "down", {}, None)))
+        self.assertFalse(is_outage_error(urllib.error.HTTPError(self.URL, 400, "bad", {}, None)))
+        self.assertFalse(is_outage_error(EndpointUnavailable("open")))
+        self.assertFalse(is_outage_error(RequestCancelled("superseded")))
+
+    def test_open_url_fails_fast_while_open(self):
+        probe = socket.socket()
+        probe.bind(("127.0.0.1", 0))
+        url = "http://127.0.0.1:{0}/v1/chat/completions".format(probe.getsockname()[1])
+        probe.close()
+        with patch.object(api, "endpoint_health", self.health):
+            for _ in range(2):
+                with self.assertRaises(urllib.error.URLError):
+                    api.open_url(url, b"{}", timeout_s=1.0)
+            start = time.monotonic()
+            with self.assertRaises(EndpointUnavailable):
+                api.open_url(url, b"{}", timeout_s=1.0)
+            self.assertLess(time.monotonic() - start, 0.05)
+
+
+class TestSlotAffinity(unittest.TestCase):
+
+    def test_views_keep_slots_and_lru_gives_way(self):
+        slots = SlotAffinity(2)
+        self.assertEqual([slots.slot("a"), slots.slot("b"), slots.slot("a")], [0, 1, 0])
+        self.assertEqual(slots.slot("c"), 1)  # "b" was least recently used
+        self.assertEqual(slots.slot("b"), 0)
+        slots.forget("c")
+        self.assertEqual(slots.slot("d"), 1)
+
+    def test_resize_drops_slots_out_of_range(self):
+        slots = SlotAffinity(3)
+        for key in "abc":
+            slots.slot(key)
+        slots.resize(2)
+        self.assertEqual(slots.slot("b"), 1)
+        self.assertEqual(slots.slot("c"), 0)  # slot 2 is gone; "a" gives way
+
+
+class TestIterStreamText(unittest.TestCase):
+    def test_openai_sse(self):
+        body = (
+            b'data: {"choices": [{"delta": {"role": "assistant"}}]}\n\n'
+            b'data: {"choices": [{"delta": {"content": "def "}}]}\n\n'
+            b'data: {"choices": [{"delta": {"content": "f():"}}]}\n\n'
+            b'data: [DONE]\n\n'
+        )
+        resp = _FakeStreamResponse(body, "text/event-stream; charset=utf-8")
+        self.assertEqual(list(iter_stream_text(resp, OpenAIProvider())), ["def ", "f():"])
+
+    def test_openai_sse_with_several_choices(self):
+        body = (
+            b'data: {"choices": [{"index": 0, "delta": {"content": "a"}}]}\n\n'
+            b'data: {"choices": [{"index": 1, "delta": {"content": "b"}}]}\n\n'
+            b'data: {"choices": [{"index": 1, "delta": {"content": "c"}}]}\n\n'
+            b'data: {"choices": [{"index": 0, "delta": {"content": "d"}}]}\n\n'
+            b'data: [DONE]\n\n'
+        )
+        others = {}
+        resp = _FakeStreamResponse(body, "text/event-stream")
+        self.assertEqual(list(iter_stream_text(resp, OpenAIProvider(), others)), ["a", "d"])
+        self.assertEqual(others, {1: "bc"})
+
+    def test_json_reply_with_several_choices(self):
+        body = json.dumps({"choices": [
+            {"index": 1, "message": {"content": "second"}},
+            {"index": 0, "message": {"content": "first"}},
+        ]}).encode()
+        others = {}
+        resp = _FakeStreamResponse(body, "application/json")
+        self.assertEqual(list(iter_stream_text(resp, OpenAIProvider(), others)), ["first"])
+        self.assertEqual(others, {1: "second"})
+
+    def test_anthropic_sse(self):
+        body = (
+            b'event: message_start\ndata: {"type": "message_start"}\n\n'
+            b'event: content_block_delta\ndata: {"type": "content_block_delta", "delta": {"type": "text_delta", "text": "x = "}}\n\n'
+            b'event: content_block_delta\ndata: {"type": "content_block_delta", "delta": {"type": "text_delta", "text": "1"}}\n\n'
+            b'event: message_stop\ndata: {"type": "message_stop"}\n\n'
+        )
+        resp = _FakeStreamResponse(body, "text/event-stream")
+        self.assertEqual(list(iter_stream_text(resp, AnthropicProvider())), ["x = ", "1"])
+
+    def test_anthropic_sse_usage(self):
+        body = (
+            b'data: {"type": "message_start", "message": {"usage": {"input_tokens": 12, '
+            b'"cache_read_input_tokens": 900, "cache_creation_input_tokens": 0, "output_tokens": 1}}}\n\n'
+            b'data: {"type": "content_block_delta", "delta": {"type": "text_delta", "text": "x"}}\n\n'
+            b'data: {"type": "message_delta", "usage": {"output_tokens": 7}}\n\n'
+            b'data: {"type": "message_stop"}\n\n'
+        )
+        resp = _FakeStreamResponse(body, "text/event-stream")
+        list(iter_stream_text(resp, AnthropicProvider()))
+        self.assertEqual(resp.usage, {"prompt": 912, "cached": 900, "written": 0, "output": 7})
+
+    def test_anthropic_error_event_raises(self):
+        body = b'event: error\ndata: {"type": "error", "error": {"type": "overloaded_error"}}\n\n'
+        resp = _FakeStreamResponse(body, "text/event-stream")
+        with self.assertRaises(ValueError):
+            list(iter_stream_text(resp, AnthropicProvider()))
+
+    def test_ollama_ndjson(self):
+        body = (
+            b'{"message": {"content": "ret"}, "done": false}\n'
+            b'{"message": {"content": "urn"}, "done": false}\n'
+            b'{"message": {"content": ""}, "done": true}\n'
+        )
+        resp = _FakeStreamResponse(body, "application/x-ndjson")
+        self.assertEqual("".join(iter_stream_text(resp, OpenAIProvider())), "return")
+
+    def test_sse_without_trailing_blank_line(self):
+        body = b'data: {"choices": [{"delta": {"content": "tail"}}]}\n'
+        resp = _FakeStreamResponse(body, "text/event-stream")
+        self.assertEqual(list(iter_stream_text(resp, OpenAIProvider())), ["tail"])
+
+    def test_non_stream_fallback(self):
+        body = b'{"choices": [{"message": {"content": " whole reply "}}]}'
+        resp = _FakeStreamResponse(body, "application/json")
+        self.assertEqual(list(iter_stream_text(resp, OpenAIProvider())), ["whole reply"])
+
+
+    def test_llamacpp_infill_stream(self):
+        body = (
+            b'data: {"content": "x = ", "stop": false}\n\n'
+            b'data: {"content": "1", "stop": false}\n\n'
+            b'data: {"content": "", "stop": true}\n\n'
+        )
+        resp = _FakeStreamResponse(body, "text/event-stream")
+        self.assertEqual(list(iter_stream_text(resp, FIMProvider("infill"))), ["x = ", "1"])
+
+
 class TestGetProvider(unittest.TestCase):
     def test_get_provider_by_endpoint(self):
         self.assertIsInstance(get_provider("https://api.openai.com/v1/chat/completions"), OpenAIProvider)
@@ -147,6 +514,65 @@ class TestOpenAIProvider(unittest.TestCase):
         result = {"choices": [{"message": {"content": " hello  "}}]}
         self.assertEqual(self.provider.parse_response(result), "hello")
 
+    def test_several_candidates(self):
+        payload = self.provider.format_payload("gpt-4", [], 100, 0.5, n=3)
+        self.assertEqual(payload["n"], 3)
+        self.assertNotIn("n", self.provider.format_payload("gpt-4", [], 100, 0.5))
+        result = {"choices": [{"index": 1, "message": {"content": "b"}}, {"index": 0, "message": {"content": "a "}}]}
+        self.assertEqual(self.provider.parse_candidates(result), ["a", "b"])
+        self.assertNotIn("n", AnthropicProvider().format_payload("claude", [], 100, 0.5, n=3))
+
+    def test_kv_cache_slot(self):
+        payload = self.provider.format_payload("m", [], 100, 0.5, slot=2)
+        self.assertEqual((payload["cache_prompt"], payload["id_slot"]), (True, 2))
+        self.assertNotIn("id_slot", self.provider.format_payload("m", [], 100, 0.5))
+        self.assertEqual(FIMProvider("infill").format_payload("m", "a", "b", 100, 0.5, slot=0)["id_slot"], 0)
+        self.assertNotIn("id_slot", FIMProvider("ollama").format_payload("m", "a", "b", 100, 0.5, slot=0))
+
+
+class TestFIMProvider(unittest.TestCase):
+    def test_server_suffix_payload(self):
+        payload = FIMProvider().format_payload("m", "def f(", "):", 64, 0.2, stream=True)
+        self.assertEqual(payload["prompt"], "def f(")
+        self.assertEqual(payload["suffix"], "):")
+        self.assertTrue(payload["stream"])
+
+    def test_template_payload(self):
+        payload = FIMProvider(template="qwen").format_payload("m", "a", "b", 64, 0.2)
+        self.assertEqual(payload["prompt"], "<|fim_prefix|>a<|fim_suffix|>b<|fim_middle|>")
+        self.assertNotIn("suffix", payload)
+        self.assertIn("<|endoftext|>", payload["stop"])
+
+    def test_infill_payload(self):
+        payload = FIMProvider("infill").format_payload("m", "a", "b", 64, 0.2)
+        self.assertEqual(payload["input_prefix"], "a")
+        self.assertEqual(payload["input_suffix"], "b")
+        self.assertEqual(payload["n_predict"], 64)
+
+    def test_ollama_payload_disables_default_streaming(self):
+        payload = FIMProvider("ollama").format_payload("m", "a", "b", 64, 0.2)
+        self.assertIs(payload["stream"], False)
+        self.assertEqual(payload["options"]["num_predict"], 64)
+
+    def test_parse_response(self):
+        self.assertEqual(FIMProvider().parse_response({"choices": [{"text": "  x\n"}]}), "  x")
+        self.assertEqual(FIMProvider("infill").parse_response({"content": "y"}), "y")
+        self.assertEqual(FIMProvider("ollama").parse_response({"response": "z"}), "z")
+
+    def test_detect_fim_template(self):
+        self.assertEqual(detect_fim_template("qwen2.5-coder-7b"), "qwen")
+        self.assertEqual(detect_fim_template("bigcode/starcoder2-3b"), "starcoder")
+        self.assertEqual(detect_fim_template("deepseek-coder-6.7b-base"), "deepseek")
+        self.assertIsNone(detect_fim_template("gpt-4o"))
+
+    def test_get_fim_provider(self):
+        url, provider = get_fim_provider("http://localhost:1234", {"fim_template": "auto"}, "qwen2.5-coder")
+        self.assertEqual(url, "http://localhost:1234/v1/completions")
+        self.assertEqual(provider.template, "qwen")
+        _url, provider = get_fim_provider("http://localhost:1234", {"fim_template": "none"}, "qwen2.5-coder")
+        self.assertIsNone(provider.template)
+        self.assertEqual(get_fim_provider("http://x", {"provider": "anthropic"}), (None, None))
+
 
 class TestAnthropicProvider(unittest.TestCase):
     def setUp(self):
@@ -176,7 +602,56 @@ class TestAnthropicProvider(unittest.TestCase):
         result = {"content": [{"text": " hello  "}]}
         self.assertEqual(self.provider.parse_response(result), "hello")
 
+    def test_prompt_caching_breakpoints(self):
+        messages = [
+            {"role": "system", "content": "sys"},
+            {"role": "user", "content": "code"},
+            {"role": "assistant", "content": "answer"},
+            {"role": "user", "content": "question"},
+        ]
+        payload = AnthropicProvider(prompt_caching=True).format_payload("claude", messages, 100, 0.5)
+        self.assertEqual(payload["system"], [{"type": "text", "text": "sys", "cache_control": {"type": "ephemeral"}}])
+        cached = ["cache_control" in str(m["content"]) for m in payload["messages"]]
+        self.assertEqual(cached, [True, True, False])
+        self.assertEqual(messages[1]["content"], "code")
+        # A single-message prompt only caches the system part.
+        payload = AnthropicProvider(prompt_caching=True).format_payload("claude", messages[:2], 100, 0.5)
+        self.assertEqual(payload["messages"], [{"role": "user", "content": "code"}])
+
+    def test_segmented_message_caches_its_stable_head(self):
+        messages = [{"role": "system", "content": "sys"}, {"role": "user", "content": ["head\n", "tail"]}]
+        payload = AnthropicProvider(prompt_caching=True).format_payload("claude", messages, 100, 0.5)
+        self.assertEqual(payload["messages"][0]["content"], [
+            {"type": "text", "text": "head\n", "cache_control": {"type": "ephemeral"}},
+            {"type": "text", "text": "tail"},
+        ])
+        self.assertEqual(AnthropicProvider().format_payload("claude", messages, 100, 0.5)["messages"],
+                         [{"role": "user", "content": "head\ntail"}])
+        self.assertEqual(OpenAIProvider().format_payload("m", messages, 100, 0.5)["messages"][1]["content"], "head\ntail")
+
+    def test_min_cache_tokens(self):
+        provider = AnthropicProvider(prompt_caching=True)
+        self.assertEqual(provider.min_cache_tokens("claude-sonnet-4-5"), 1024)
+        self.assertEqual(provider.min_cache_tokens("claude-3-5-haiku-latest"), 2048)
+        self.assertEqual(provider.min_cache_tokens("claude-haiku-4-5"), 4096)
+
+    def test_all_empty_segments_fall_back_to_a_string(self):
+        messages = [{"role": "user", "content": ["", ""]}]
+        payload = AnthropicProvider(prompt_caching=True).format_payload("claude", messages, 100, 0.5)
+        self.assertEqual(payload["messages"], [{"role": "user", "content": ""}])
+
+
+class TestUsage(unittest.TestCase):
+    def test_openai_and_llama_cpp(self):
+        usage = {"prompt_tokens": 2000, "completion_tokens": 20, "prompt_tokens_details": {"cached_tokens": 1536}}
+        self.assertEqual(parse_usage({"usage": usage}), {"prompt": 2000, "cached": 1536, "output": 20})
+        self.assertEqual(parse_usage({"timings": {"cache_n": 90, "prompt_n": 10}}), {"cached": 90, "prompt": 100})
+        self.assertIsNone(parse_usage({"choices": []}))
+
+    def test_format_usage(self):
+        self.assertEqual(format_usage({"prompt": 2000, "cached": 1500, "written": 0, "output": 20}),
+                         "2000 prompt tokens, 1500 cached (75%), 20 output")
+
 
 if __name__ == "__main__":
     unittest.main()
-
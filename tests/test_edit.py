@@ -0,0 +1,44 @@
+"""Tests for utils.edit — the anchored selection of a streaming edit."""
+
+import os
+import sys
+import types
+import unittest
+
+# --- Ensure sublime and sublime_plugin stubs exist in sys.modules ------------
+if "sublime" not in sys.modules:
+    sys.modules["sublime"] = types.ModuleType("sublime")
+if "sublime_plugin" not in sys.modules:
+    sys.modules["sublime_plugin"] = types.ModuleType("sublime_plugin")
+
+
+class _StubTextCommand:
+    pass
+
+
+for _name in ("TextCommand", "EventListener", "WindowCommand"):
+    if not hasattr(sys.modules["sublime_plugin"], _name):
+        setattr(sys.modules["sublime_plugin"], _name, _StubTextCommand)
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from sublime_stub import Region, View
+from utils.edit import EDIT_REGION_KEY, _selection_survives
+
+
+class TestSelectionSurvives(unittest.TestCase):
+
+    def test_collapsed_region_counts_as_deleted(self):
+        view = View(text="x = 1\ny = 2\n")
+        view.add_regions(EDIT_REGION_KEY, [Region(0, 5)], "", "", 0)
+        self.assertTrue(_selection_survives(view))
+        # Deleting the selected text leaves the region behind, collapsed.
+        view.add_regions(EDIT_REGION_KEY, [Region(0, 0)], "", "", 0)
+        self.assertFalse(_selection_survives(view))
+        view.erase_regions(EDIT_REGION_KEY)
+        self.assertFalse(_selection_survives(view))
+
+
+if __name__ == "__main__":
+    unittest.main()
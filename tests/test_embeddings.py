@@ -0,0 +1,208 @@
+"""Tests for utils.embeddings — embedded chunks and vector search."""
+
+import io
+import json
+import os
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils import api, embeddings
+from utils.embeddings import EmbeddingIndex, VectorStore, embed_texts, normalize
+
+
+VOCABULARY = ("user", "order", "invoice", "database", "render", "template", "parse", "config", "socket", "retry")
+
+
+def fake_embed(texts):
+    """Bag-of-words vectors over VOCABULARY (plus a bias so none is zero)."""
+    out = []
+    for text in texts:
+        words = re.findall(r"[a-z]+", text.lower())
+        out.append([float(sum(w.startswith(v) for w in words)) for v in VOCABULARY] + [0.1])
+    return out
+
+
+class CountingEmbed:
+
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, texts):
+        with self.lock:
+            self.calls.append(len(texts))
+        return fake_embed(texts)
+
+    @property
+    def embedded(self):
+        return sum(self.calls)
+
+
+FILES = {
+    "db.py": "def open_database(config):\n    return database.connect(config)\n\n\n"
+             "def fetch_user(database, user_id):\n    return database.user(user_id)\n",
+    "web/views.py": "def render_invoice(template, invoice):\n    return template.render(invoice=invoice)\n\n\n"
+                    "def render_order(template, order):\n    return template.render(order=order)\n",
+    "net.py": "def retry_socket(socket, retries):\n    for _ in range(retries):\n        socket.retry()\n",
+}
+
+
+class TestEmbeddingIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.project = os.path.join(self.root, "project")
+        self.cache = os.path.join(self.root, "cache")
+        for relpath, text in FILES.items():
+            self.write(relpath, text)
+        self.embed = CountingEmbed()
+
+    def write(self, relpath, text, mtime=None):
+        path = os.path.join(self.project, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(text)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def make_index(self):
+        index = EmbeddingIndex([self.project], self.cache, "embed-model", self.embed)
+        self.addCleanup(index.close)
+        return index
+
+    def test_nearest_chunks(self):
+        index = self.make_index()
+        self.assertEqual(index.refresh(), 5)
+        snippets = index.snippets(fake_embed(["render the invoice template"])[0], budget=200, top_k=1)
+        self.assertEqual(snippets, [("web/views.py", 0, FILES["web/views.py"].split("\n\n\n")[0])])
+        hits = index.search(fake_embed(["retry socket"])[0], 1)
+        self.assertEqual(hits[0][1:], (os.path.join(self.project, "net.py"), 0, 2))
+        excluded = index.search(fake_embed(["retry socket"])[0], 1, exclude=(hits[0][1], 1, 1))
+        self.assertNotEqual(excluded[0][1], hits[0][1])
+
+    def test_only_changed_chunks_are_embedded(self):
+        index = self.make_index()
+        index.refresh()
+        self.assertEqual(index.refresh(), 0)
+        self.write("db.py", FILES["db.py"].replace("user_id", "uid"), mtime=1)
+        self.assertEqual(index.refresh(), 1)
+        os.remove(os.path.join(self.project, "net.py"))
+        index.refresh()
+        self.assertEqual(len(index), 4)
+        self.assertEqual(self.embed.embedded, 6)
+
+    def test_batches_are_split(self):
+        with patch.object(embeddings, "EMBED_BATCH_SIZE", 2):
+            self.make_index().refresh()
+        self.assertEqual(sorted(self.embed.calls), [1, 2, 2])
+
+    def test_persisted_vectors_are_memory_mapped_on_load(self):
+        index = self.make_index()
+        index.refresh()
+        index.save()
+        index.close()
+        restored = self.make_index()
+        self.assertTrue(restored.load())
+        self.assertEqual(restored.refresh(), 0)
+        hits = restored.search(fake_embed(["database user"])[0], 1)
+        self.assertEqual(hits[0][1], os.path.join(self.project, "db.py"))
+
+    def test_embed_failure_keeps_finished_batches(self):
+        calls = []
+
+        def flaky(texts):
+            calls.append(texts)
+            if len(calls) > 1:
+                raise OSError("embedding server went away")
+            return fake_embed(texts)
+
+        index = EmbeddingIndex([self.project], self.cache, "embed-model", flaky)
+        self.addCleanup(index.close)
+        with patch.object(embeddings, "EMBED_BATCH_SIZE", 2), patch.object(embeddings, "EMBED_CONCURRENCY", 1):
+            with self.assertRaises(OSError):
+                index.refresh()
+        self.assertEqual(len(index), 2)
+
+    def test_ivf_search_finds_exact_match(self):
+        for i in range(40):
+            self.write("gen/mod_{0}.py".format(i), "def f_{0}():\n    return {1}\n".format(
+                i, " ".join(VOCABULARY[j % len(VOCABULARY)] for j in range(i % 7, i % 7 + 1 + i % 3))))
+        with patch.object(embeddings, "IVF_MIN_ROWS", 16):
+            index = self.make_index()
+            index.refresh()
+            self.assertIn("IVF", index.describe())
+            query = fake_embed([FILES["net.py"]])[0]
+            self.assertEqual(index.search(query, 1)[0][1], os.path.join(self.project, "net.py"))
+
+
+    def test_ivf_scan_is_capped(self):
+        for i in range(40):
+            self.write("gen/mod_{0}.py".format(i), "def f_{0}():\n    return {1}\n".format(i, VOCABULARY[i % 10]))
+        with patch.object(embeddings, "IVF_MIN_ROWS", 16), patch.object(embeddings, "MAX_SCAN_ROWS", 3):
+            index = self.make_index()
+            index.refresh()
+            self.assertEqual(len(index.search(fake_embed(["user order"])[0], 10)), 3)
+
+    def test_semantic_snippets_pass_the_cancel_token(self):
+        seen = []
+
+        def embed(texts, timeout_s=30.0, cancel=None):
+            seen.append(cancel)
+            return fake_embed(texts)
+
+        index = EmbeddingIndex([self.project], self.cache, "embed-model", fake_embed)
+        self.addCleanup(index.close)
+        index.refresh()
+        index.embed = embed
+        token = object()
+        snippets = embeddings.semantic_snippets(index, "retry socket", 200, cancel=token)
+        self.assertEqual(snippets[0][0], "net.py")
+        self.assertEqual(seen, [token])
+
+
+class TestVectorStore(unittest.TestCase):
+
+    def test_append_and_rewrite(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        store = VectorStore(os.path.join(root, "v.f32"), dim=2)
+        self.addCleanup(store.close)
+        self.assertEqual(store.append([normalize([1, 0]), normalize([0, 2]), normalize([3, 4])]), 0)
+        self.assertEqual(store.rows, 3)
+        self.assertEqual(store.rewrite([2, 0]), {2: 0, 0: 1})
+        self.assertAlmostEqual(store.row(0)[1], 0.8, places=6)
+
+
+class TestEmbedTexts(unittest.TestCase):
+
+    def test_orders_by_index(self):
+        body = {"data": [{"index": 1, "embedding": [0.0, 1.0]}, {"index": 0, "embedding": [1.0, 0.0]}]}
+        with patch.object(embeddings, "open_url", return_value=io.BytesIO(json.dumps(body).encode())) as open_url:
+            vectors = embed_texts("http://h/v1/embeddings", "m", {}, ["a", "b"])
+        self.assertEqual(vectors, [[1.0, 0.0], [0.0, 1.0]])
+        self.assertEqual(json.loads(open_url.call_args[0][1]), {"model": "m", "input": ["a", "b"]})
+
+    def test_failures_do_not_trip_the_completion_breaker(self):
+        probe = socket.socket()
+        probe.bind(("127.0.0.1", 0))
+        url = "http://127.0.0.1:{0}/v1/embeddings".format(probe.getsockname()[1])
+        probe.close()  # nothing listens there now
+        self.addCleanup(api.endpoint_health.reset)
+        for _ in range(api.BREAKER_FAILURE_THRESHOLD + 1):
+            with self.assertRaises(OSError):
+                embed_texts(url, "m", {}, ["a"], timeout_s=1.0)
+        self.assertEqual(api.endpoint_health.state(url), api.BREAKER_CLOSED)
+
+
+if __name__ == "__main__":
+    unittest.main()
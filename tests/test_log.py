@@ -0,0 +1,92 @@
+"""Tests for utils.log — lazy formatting, level gating and the file sink."""
+
+import io
+import os
+import sys
+import tempfile
+import types
+import unittest
+from contextlib import redirect_stdout
+from unittest.mock import patch
+
+# --- Ensure sublime and sublime_plugin stubs exist in sys.modules ------------
+if "sublime" not in sys.modules:
+    sys.modules["sublime"] = types.ModuleType("sublime")
+if "sublime_plugin" not in sys.modules:
+    sys.modules["sublime_plugin"] = types.ModuleType("sublime_plugin")
+
+
+class _StubWindowCommand:
+    pass
+
+
+if not hasattr(sys.modules["sublime_plugin"], "WindowCommand"):
+    setattr(sys.modules["sublime_plugin"], "WindowCommand", _StubWindowCommand)
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils import log
+
+
+class Exploding:
+    """Fails the test if anything tries to format it."""
+
+    def __format__(self, spec):
+        raise AssertionError("formatted while logging was disabled")
+
+
+class TestLog(unittest.TestCase):
+
+    def setUp(self):
+        log._ring.clear()
+        log._pending.clear()
+
+    def tearDown(self):
+        log.stop_log_writer()
+        log.configure_logging({})
+
+    def test_disabled_debug_does_not_format(self):
+        log.configure_logging({"debug": False})
+        with redirect_stdout(io.StringIO()) as out:
+            log._log("value: {0}", Exploding())
+        self.assertEqual(out.getvalue(), "")
+        self.assertEqual(log.recent_log_lines(), [])
+
+    def test_debug_formats_and_records(self):
+        log.configure_logging({"debug": True})
+        with redirect_stdout(io.StringIO()) as out:
+            log._log("{0} + {1}", 1, 2)
+            log._log("literal {braces}")
+        self.assertIn("1 + 2", out.getvalue())
+        self.assertTrue(log.recent_log_lines()[0].endswith("1 + 2"))
+        self.assertTrue(log.recent_log_lines()[1].endswith("literal {braces}"))
+
+    def test_errors_always_emitted(self):
+        log.configure_logging({"debug": False})
+        with redirect_stdout(io.StringIO()):
+            log._log_error("boom: {0:.3}", "abcdef")
+        self.assertTrue(log.recent_log_lines()[0].endswith("ERROR: boom: abc"))
+
+    def test_ring_buffer_is_bounded(self):
+        log.configure_logging({"debug": True})
+        with redirect_stdout(io.StringIO()):
+            for i in range(log.RING_SIZE + 5):
+                log._log("{0}", i)
+        lines = log.recent_log_lines()
+        self.assertEqual(len(lines), log.RING_SIZE)
+        self.assertTrue(lines[0].endswith(" 5"))
+
+    def test_file_sink_flushed_on_stop(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "sub", "CodeContinue.log")
+            with patch.object(log, "log_file_path", lambda: path):
+                log.configure_logging({"debug": True, "log_file": True})
+                with redirect_stdout(io.StringIO()):
+                    log._log("to the file")
+                log.stop_log_writer()
+            with open(path, encoding="utf-8") as f:
+                self.assertIn("to the file", f.read())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+"""Tests for utils.metrics — stage timers and latency percentiles."""
+
+import os
+import sys
+import unittest
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils import metrics
+from utils.metrics import LatencyWindow, RequestTimer, StageStats, percentile
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeResponse:
+
+    def __init__(self, connect_s):
+        self.connect_s = connect_s
+
+
+class TestPercentiles(unittest.TestCase):
+
+    def test_nearest_rank(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 95), 95)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([7], 99), 7)
+
+    def test_window_is_rolling(self):
+        window = LatencyWindow(size=3)
+        for value in (10.0, 1.0, 2.0, 3.0):
+            window.add(value)
+        self.assertEqual(window.summary(), (3, 2.0, 3.0, 3.0))
+        self.assertIsNone(LatencyWindow().summary())
+
+
+class TestRequestTimer(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = patch.object(metrics.time, "monotonic", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.stats = StageStats()
+
+    def test_laps_partition_the_request(self):
+        timer = RequestTimer("suggest", "ep", "m", stats=self.stats)
+        self.clock.now += 0.05
+        timer.lap("dispatch")
+        self.clock.now += 0.3
+        timer.lap_response(FakeResponse(connect_s=0.1))
+        self.clock.now += 0.02
+        timer.lap("parse")
+        timer.finish()
+        summary = lambda stage: self.stats.summary("suggest", "ep", "m", stage)[1]
+        self.assertAlmostEqual(summary("dispatch"), 0.05)
+        self.assertAlmostEqual(summary("connect"), 0.1)
+        self.assertAlmostEqual(summary("ttfb"), 0.2)
+        self.assertAlmostEqual(summary("total"), 0.37)
+
+    def test_reused_connection_has_no_connect_stage(self):
+        timer = RequestTimer("chat", "ep", "m", stats=self.stats)
+        self.clock.now += 0.2
+        timer.lap_response(FakeResponse(connect_s=None))
+        timer.finish()
+        self.assertIsNone(self.stats.summary("chat", "ep", "m", "connect"))
+        self.assertAlmostEqual(self.stats.summary("chat", "ep", "m", "ttfb")[1], 0.2)
+
+    def test_explicit_start_counts_from_trigger(self):
+        timer = RequestTimer("suggest", start=self.clock.now - 1.0, stats=self.stats)
+        timer.lap("dispatch")
+        self.assertAlmostEqual(timer.stages["dispatch"], 1.0)
+
+
+class TestReport(unittest.TestCase):
+
+    def test_report_lists_keys_and_stages_in_order(self):
+        stats = StageStats()
+        stats.record("suggest", "http://a", "m", {"ttfb": 0.2, "dispatch": 0.01, "total": 0.25})
+        report = stats.format_report()
+        self.assertIn("suggest  http://a  m", report)
+        self.assertLess(report.index("dispatch"), report.index("ttfb"))
+        self.assertIn("200.0", report)
+
+    def test_empty_report(self):
+        self.assertIn("No requests", StageStats().format_report())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+"""Tests for utils.retrieval — BM25 snippets over open views."""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils.retrieval import ChunkIndex, format_snippets, split_chunks, terms
+
+
+DB_PY = '''import sqlite3
+
+
+def open_database(path):
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def fetch_user(conn, user_id):
+    row = conn.execute("select * from users where id = ?", (user_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def render_page(template, context):
+    return template.format(**context)
+'''
+
+VIEWS_PY = '''def show_profile(request):
+    conn = open_database(settings.DB)
+    user = fetch_user(conn, request.user_id)
+'''
+
+
+class TestChunking(unittest.TestCase):
+
+    def test_chunks_start_at_top_level_lines(self):
+        chunks = split_chunks(DB_PY.split("\n"))
+        self.assertEqual([start for start, _text in chunks], [0, 9, 14])
+        self.assertTrue(chunks[1][1].startswith("def fetch_user"))
+
+    def test_edit_leaves_other_chunks_unchanged(self):
+        lines = DB_PY.split("\n")
+        before = {text for _start, text in split_chunks(lines)}
+        lines.insert(11, "    log(user_id)")
+        after = {text for _start, text in split_chunks(lines)}
+        self.assertEqual(len(before - after), 1)
+
+    def test_terms_split_identifiers(self):
+        counts = terms("user = fetchUser(conn, user_id)")
+        self.assertEqual(counts["fetchuser"], 1)
+        self.assertEqual(counts["fetch"], 1)
+        self.assertEqual(counts["user"], 3)
+        self.assertNotIn("id", counts)
+
+
+class TestChunkIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = ChunkIndex()
+        self.index.update(1, "db.py", DB_PY.split("\n"), version=1)
+        self.index.update(2, "views.py", VIEWS_PY.split("\n"), version=1)
+
+    def test_best_chunk_first_and_current_context_excluded(self):
+        snippets = self.index.snippets(VIEWS_PY, "", budget=500, exclude=(2, 0, 3))
+        self.assertEqual(snippets[0][:2], ("db.py", 9))
+        self.assertIn("def fetch_user(conn, user_id):", snippets[0][2])
+        self.assertNotIn("views.py", [name for name, _row, _text in snippets])
+
+    def test_budget_caps_snippets(self):
+        self.assertEqual(self.index.snippets(VIEWS_PY, "", budget=20, exclude=(2, 0, 3)), [])
+        self.assertEqual(len(self.index.snippets(VIEWS_PY, "", budget=500, top_k=1)), 1)
+
+    def test_update_only_replaces_changed_chunks(self):
+        lines = DB_PY.split("\n")
+        self.assertEqual(self.index.update(1, "db.py", lines, version=2), 0)
+        lines[15] = "    return template.format_map(context)"
+        self.assertEqual(self.index.update(1, "db.py", lines, version=3), 2)  # one removed, one added
+        lines.insert(0, "# header")
+        # The first chunk splits in two; the rest only move down a row.
+        self.assertEqual(self.index.update(1, "db.py", lines, version=4), 3)
+        self.assertEqual(self.index.snippets("fetch_user(", "", 500, exclude=(2, 0, 3), top_k=1)[0][:2], ("db.py", 10))
+        self.assertEqual(self.index.version(1), 4)
+
+    def test_remove_document(self):
+        self.index.remove(1)
+        self.assertEqual(self.index.snippets(VIEWS_PY, "", budget=500, exclude=(2, 0, 3)), [])
+        self.assertIsNone(self.index.version(1))
+
+
+class TestFormatSnippets(unittest.TestCase):
+
+    def test_commented_block(self):
+        block = format_snippets([("db.py", 9, "def f():\n    pass")], "//")
+        self.assertEqual(block, (
+            "// Related code from other open files:\n"
+            "// --- db.py, line 10 ---\n// def f():\n//     pass\n"
+        ))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,99 @@
+"""Tests for utils.scheduler — per-endpoint token buckets."""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils.scheduler import RequestScheduler, TokenBucket, parse_retry_after
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_burst_then_wait(self):
+        bucket = TokenBucket(rate=2.0, capacity=2.0)
+        self.assertEqual(bucket.try_acquire(now=0.0), 0.0)
+        self.assertEqual(bucket.try_acquire(now=0.0), 0.0)
+        self.assertAlmostEqual(bucket.try_acquire(now=0.0), 0.5)
+        self.assertEqual(bucket.try_acquire(now=0.5), 0.0)
+
+    def test_success_raises_rate_up_to_latency_ceiling(self):
+        bucket = TokenBucket(rate=0.5)
+        for _ in range(50):
+            bucket.note_success(1.0)
+        self.assertAlmostEqual(bucket.rate, 2.0)  # LATENCY_CONCURRENCY / 1 s
+
+    def test_fast_server_allows_higher_rate(self):
+        slow, fast = TokenBucket(), TokenBucket()
+        for _ in range(50):
+            slow.note_success(4.0)
+            fast.note_success(0.2)
+        self.assertGreater(fast.rate, slow.rate)
+
+    def test_rate_limited_halves_and_blocks(self):
+        bucket = TokenBucket(rate=4.0)
+        bucket.note_rate_limited(retry_after_s=10.0, now=0.0)
+        self.assertEqual(bucket.rate, 2.0)
+        self.assertAlmostEqual(bucket.try_acquire(now=1.0), 9.0)
+        self.assertEqual(bucket.try_acquire(now=11.0), 0.0)
+
+
+class TestRequestScheduler(unittest.TestCase):
+
+    def test_queues_latest_trigger_per_key(self):
+        scheduler = RequestScheduler(lambda: TokenBucket(rate=1.0, capacity=1.0))
+        self.assertEqual(scheduler.submit("ep", 1, "a", now=0.0), (0.0, False))
+        delay, first = scheduler.submit("ep", 1, "b", now=0.0)
+        self.assertGreater(delay, 0.0)
+        self.assertTrue(first)
+        delay, first = scheduler.submit("ep", 1, "c", now=0.1)
+        self.assertFalse(first)
+        self.assertEqual(scheduler.resume("ep", 1, now=0.5)[0], None)
+        self.assertEqual(scheduler.resume("ep", 1, now=1.0), ("c", 0.0))
+        self.assertEqual(scheduler.resume("ep", 1, now=5.0), (None, 0.0))
+
+    def test_buckets_are_per_endpoint(self):
+        scheduler = RequestScheduler(lambda: TokenBucket(rate=1.0, capacity=1.0))
+        self.assertTrue(scheduler.admit("a", now=0.0))
+        self.assertFalse(scheduler.admit("a", now=0.0))
+        self.assertTrue(scheduler.admit("b", now=0.0))
+
+    def test_configure_caps_rate(self):
+        scheduler = RequestScheduler()
+        scheduler.configure(max_requests_per_minute=30)
+        self.assertEqual(scheduler.bucket("ep").rate, 0.5)
+        scheduler.configure(0)
+        self.assertEqual(scheduler.bucket("ep").rate, 2.0)
+
+    def test_unchanged_cap_keeps_learned_rates(self):
+        scheduler = RequestScheduler()
+        scheduler.configure(30)
+        scheduler.bucket("ep").rate = 0.1
+        scheduler.configure(30)
+        self.assertEqual(scheduler.bucket("ep").rate, 0.1)
+        scheduler.configure(60)
+        self.assertEqual(scheduler.bucket("ep").rate, 1.0)
+
+    def test_discard(self):
+        scheduler = RequestScheduler(lambda: TokenBucket(rate=1.0, capacity=0.0))
+        scheduler.submit("ep", 1, "a", now=0.0)
+        scheduler.discard(1)
+        self.assertEqual(scheduler.resume("ep", 1, now=10.0), (None, 0.0))
+
+
+class TestParseRetryAfter(unittest.TestCase):
+
+    def test_seconds(self):
+        self.assertEqual(parse_retry_after("7"), 7.0)
+
+    def test_http_date(self):
+        self.assertAlmostEqual(parse_retry_after("Thu, 01 Jan 1970 00:01:40 GMT", now=40.0), 60.0)
+
+    def test_missing_or_garbage(self):
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after("soon"))
+
+
+if __name__ == "__main__":
+    unittest.main()
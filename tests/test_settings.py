@@ -18,10 +18,17 @@ _sublime_plugin_stub = types.ModuleType("sublime_plugin")
 class _StubTextCommand:
     pass
 
-_sublime_plugin_stub.TextCommand = _StubTextCommand
+class _StubWindowCommand:
+    pass
 
 sys.modules.setdefault("sublime", _sublime_stub)
-sys.modules.setdefault("sublime_plugin", _sublime_plugin_stub)
+_sublime_plugin_stub = sys.modules.setdefault("sublime_plugin", _sublime_plugin_stub)
+
+# Another test module may have registered the stub first; fill in what is missing.
+if not hasattr(_sublime_plugin_stub, "TextCommand"):
+    _sublime_plugin_stub.TextCommand = _StubTextCommand
+if not hasattr(_sublime_plugin_stub, "WindowCommand"):
+    _sublime_plugin_stub.WindowCommand = _StubWindowCommand
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
@@ -1,9 +1,12 @@
-"""Tests for utils.suggest — is_syntax_supported helper."""
+"""Tests for utils.suggest — syntax gating, CompletionCache, debounce helpers, request hedging and the request flow."""
 
 import os
 import sys
+import threading
+import time
 import types
 import unittest
+from unittest.mock import patch
 
 # --- Ensure sublime and sublime_plugin stubs exist in sys.modules ------------
 if "sublime" not in sys.modules:
@@ -23,18 +26,46 @@ class _StubTextCommand:
     pass
 
 
+class _StubTextChangeListener:
+    pass
+
+
+class _StubWindowCommand:
+    pass
+
+
 if not hasattr(sublime_plugin_mod, "EventListener"):
     setattr(sublime_plugin_mod, "EventListener", _StubEventListener)
 if not hasattr(sublime_plugin_mod, "TextCommand"):
     setattr(sublime_plugin_mod, "TextCommand", _StubTextCommand)
+if not hasattr(sublime_plugin_mod, "TextChangeListener"):
+    setattr(sublime_plugin_mod, "TextChangeListener", _StubTextChangeListener)
+if not hasattr(sublime_plugin_mod, "WindowCommand"):
+    setattr(sublime_plugin_mod, "WindowCommand", _StubWindowCommand)
 if not hasattr(sublime_mod, "load_settings"):
     setattr(sublime_mod, "load_settings", lambda x: {})
 if not hasattr(sublime_mod, "status_message"):
     setattr(sublime_mod, "status_message", lambda x: None)
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
 
-from utils.suggest import is_syntax_supported
+import sublime_stub
+from mock_server import MockLLMServer
+from utils import snapshot, suggest
+from utils.api import RequestCancelled
+from utils.metrics import RequestTimer, StageStats
+from utils.scheduler import RequestScheduler
+from utils.suggest import (
+    AdaptiveDebounce,
+    CompletionCache,
+    SecondarySettings,
+    TriggerGate,
+    hedge_delay,
+    is_syntax_supported,
+    normalize_context,
+)
+from utils.text_utils import build_context
 
 
 class FakeSyntax:
@@ -44,6 +75,42 @@ class FakeSyntax:
         self.scope = scope
 
 
+class FakeViewSettings:
+
+    def __init__(self):
+        self.callbacks = {}
+
+    def add_on_change(self, key, callback):
+        self.callbacks.setdefault(key, []).append(callback)
+
+    def clear_on_change(self, key):
+        self.callbacks.pop(key, None)
+
+    def fire(self):
+        for callbacks in list(self.callbacks.values()):
+            for callback in callbacks:
+                callback()
+
+
+class FakeView:
+
+    def __init__(self, view_id, syntax):
+        self._id = view_id
+        self._syntax = syntax
+        self._settings = FakeViewSettings()
+        self.syntax_calls = 0
+
+    def id(self):
+        return self._id
+
+    def syntax(self):
+        self.syntax_calls += 1
+        return self._syntax
+
+    def settings(self):
+        return self._settings
+
+
 class TestIsSyntaxSupported(unittest.TestCase):
 
     def test_exact_name_match(self):
@@ -76,5 +143,541 @@ class TestIsSyntaxSupported(unittest.TestCase):
         self.assertFalse(is_syntax_supported(syntax, []))
 
 
+class TestCompletionCache(unittest.TestCase):
+
+    def test_hit_and_miss_counts(self):
+        cache = CompletionCache()
+        key = cache.make_key("OpenAIProvider", "m", "sys", "def f():\n")
+        self.assertIsNone(cache.get(key))
+        cache.put(key, "return 1")
+        self.assertEqual(cache.get(key), "return 1")
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_key_depends_on_every_part(self):
+        base = CompletionCache.make_key("OpenAIProvider", "m", "sys", "ctx")
+        self.assertNotEqual(base, CompletionCache.make_key("OpenAIProvider", "m2", "sys", "ctx"))
+        self.assertNotEqual(base, CompletionCache.make_key("OpenAIProvider", "m", "sys2", "ctx"))
+        self.assertNotEqual(base, CompletionCache.make_key("AnthropicProvider", "m", "sys", "ctx"))
+
+    def test_lru_eviction_by_count(self):
+        cache = CompletionCache(max_entries=2)
+        cache.put("a", "1")
+        cache.put("b", "2")
+        cache.get("a")
+        cache.put("c", "3")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "1")
+        self.assertEqual(cache.get("c"), "3")
+
+    def test_eviction_by_bytes(self):
+        cache = CompletionCache(max_entries=10, max_bytes=10)
+        cache.put("a", "123456")
+        cache.put("b", "123456")
+        self.assertEqual(len(cache), 1)
+        self.assertIsNone(cache.get("a"))
+
+    def test_expiry(self):
+        cache = CompletionCache(ttl_s=10)
+        cache.put("a", "x", now=100.0)
+        self.assertEqual(cache.get("a", now=105.0), "x")
+        self.assertIsNone(cache.get("a", now=111.0))
+        self.assertEqual(len(cache), 0)
+
+    def test_peek_does_not_count(self):
+        cache = CompletionCache()
+        cache.put("a", "x")
+        self.assertEqual(cache.peek("a"), "x")
+        self.assertIsNone(cache.peek("b"))
+        self.assertEqual((cache.hits, cache.misses), (0, 0))
+
+    def test_clear(self):
+        cache = CompletionCache()
+        cache.put("a", "x")
+        cache.clear()
+        self.assertIsNone(cache.get("a"))
+
+    def test_normalize_context_ignores_trailing_indent(self):
+        self.assertEqual(normalize_context("def f():\n    "), normalize_context("def f():\n"))
+        self.assertNotEqual(normalize_context("def f():\n"), normalize_context("def f():"))
+
+
+class TestAdaptiveDebounce(unittest.TestCase):
+
+    def _typed(self, gap_s, count=30):
+        debounce = AdaptiveDebounce()
+        for i in range(count):
+            debounce.note_keystroke(now=i * gap_s)
+        return debounce
+
+    def test_slow_typists_wait_longer(self):
+        self.assertGreater(self._typed(0.3).delay_ms(), self._typed(0.1).delay_ms())
+
+    def test_long_pauses_do_not_count_as_cadence(self):
+        debounce = self._typed(0.1)
+        before = debounce.cadence_ms
+        debounce.note_keystroke(now=1000.0)
+        self.assertEqual(debounce.cadence_ms, before)
+
+    def test_slow_endpoint_fires_sooner(self):
+        fast, slow = self._typed(0.3), self._typed(0.3)
+        for _ in range(30):
+            fast.note_latency(0.2)
+            slow.note_latency(3.0)
+        self.assertLess(slow.delay_ms(), fast.delay_ms())
+
+    def test_block_opener_and_bounds(self):
+        debounce = self._typed(0.3)
+        self.assertLess(debounce.delay_ms(block_opener=True), debounce.delay_ms())
+        self.assertGreaterEqual(self._typed(0.001).delay_ms(), debounce.min_ms)
+        self.assertLessEqual(self._typed(1.9).delay_ms(), debounce.max_ms)
+
+    def test_prefetch_context_matches_enter(self):
+        # A prefetch at the end of "def f():" must build the same context an
+        # Enter with auto-indent builds, or it would never hit the cache.
+        above = "\n".join("line_{0:03d} = {0}".format(i) for i in range(200))
+        after = "\nreturn_value()"
+        prefetch, _ = build_context(above + "\ndef f():\n", after, 300)
+        enter, _ = build_context(above + "\ndef f():\n    ", after, 300)
+        self.assertEqual(normalize_context(prefetch), normalize_context(enter))
+
+
+class TestSchedulerCap(unittest.TestCase):
+
+    def test_cap_applies_without_a_settings_change(self):
+        with patch.object(suggest, "_scheduler", RequestScheduler()):
+            scheduler = suggest._configured_scheduler({"max_requests_per_minute": 30})
+            self.assertEqual(scheduler.bucket("ep").rate, 0.5)
+
+
+class TestTriggerGate(unittest.TestCase):
+
+    def setUp(self):
+        self.loads = 0
+        self.languages = ["python"]
+
+        def load():
+            self.loads += 1
+            return self.languages
+
+        self.gate = TriggerGate(load)
+
+    def test_per_view_answer_is_cached(self):
+        view = FakeView(1, FakeSyntax("Python", "source.python"))
+        self.assertTrue(self.gate.enabled(view))
+        self.assertTrue(self.gate.enabled(view))
+        self.assertEqual(view.syntax_calls, 1)
+        self.assertEqual(self.loads, 1)
+
+    def test_syntax_table_shared_across_views(self):
+        self.assertFalse(self.gate.enabled(FakeView(1, FakeSyntax("Rust", "source.rust"))))
+        self.assertFalse(self.gate.enabled(FakeView(2, FakeSyntax("Rust", "source.rust"))))
+        self.assertEqual(self.loads, 1)
+
+    def test_view_settings_change_rechecks_syntax(self):
+        view = FakeView(1, FakeSyntax("Plain Text", "text.plain"))
+        self.assertFalse(self.gate.enabled(view))
+        view._syntax = FakeSyntax("Python", "source.python")
+        view.settings().fire()
+        self.assertTrue(self.gate.enabled(view))
+        self.assertEqual(len(view.settings().callbacks[TriggerGate.SETTINGS_KEY]), 1)
+
+    def test_clear_reloads_languages(self):
+        view = FakeView(1, FakeSyntax("Rust", "source.rust"))
+        self.assertFalse(self.gate.enabled(view))
+        self.languages = ["rust"]
+        self.gate.clear()
+        self.assertTrue(self.gate.enabled(view))
+
+    def test_forget_unhooks_view(self):
+        view = FakeView(1, FakeSyntax("Python", "source.python"))
+        self.gate.enabled(view)
+        self.gate.forget(view)
+        self.assertEqual(view.settings().callbacks, {})
+
+
+class FakeLegResponse:
+
+    def __init__(self, url):
+        self.url = url
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestHedgedOpen(unittest.TestCase):
+    """`_open_hedged` with `_open_completion` replaced by a scripted server."""
+
+    def setUp(self):
+        self.behaviour = {}   # url -> (seconds until it answers, error or None)
+        self.opened = []
+        self.cancelled = []
+        self.lock = threading.Lock()
+        patcher = patch.object(suggest, "_open_completion", self._fake_open)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.timer = RequestTimer("suggest", stats=StageStats())
+        self.token = suggest.CancelToken()
+
+    def _fake_open(self, attempts, settings, timeout_s, token, timer):
+        url = attempts[0][0]
+        timer.endpoint = url
+        with self.lock:
+            self.opened.append(url)
+        delay, error = self.behaviour[url]
+        deadline = time.monotonic() + delay
+        while time.monotonic() < deadline:
+            if token.cancelled:
+                with self.lock:
+                    self.cancelled.append((url, token.reason))
+                raise RequestCancelled(token.reason)
+            time.sleep(0.002)
+        if error is not None:
+            raise error
+        return FakeLegResponse(url), "provider:" + url
+
+    def _legs(self):
+        primary = types.SimpleNamespace(endpoint="primary", model="local", settings={})
+        secondary = types.SimpleNamespace(endpoint="secondary", model="cloud", settings={})
+        return [(primary, [("primary", None, {})]), (secondary, [("secondary", None, {})])]
+
+    def _open(self, delay_s=0.05, stream=False):
+        return suggest._open_hedged(self._legs(), delay_s, 5.0, self.token, self.timer, stream)
+
+    def test_fast_primary_is_not_hedged(self):
+        self.behaviour = {"primary": (0.0, None), "secondary": (0.0, None)}
+        response, provider, upstream, deltas = self._open()
+        self.assertEqual((response.url, upstream.endpoint), ("primary", "primary"))
+        self.assertIsNone(deltas)
+        self.assertEqual(self.opened, ["primary"])
+        self.assertNotIn("hedge", self.timer.stages)
+
+    def test_stalled_primary_loses_to_secondary(self):
+        self.behaviour = {"primary": (2.0, None), "secondary": (0.0, None)}
+        response, provider, upstream, _deltas = self._open()
+        self.assertEqual((response.url, provider, upstream.model), ("secondary", "provider:secondary", "cloud"))
+        self.assertEqual((self.timer.endpoint, self.timer.model), ("secondary", "cloud"))
+        self.assertGreaterEqual(self.timer.stages["hedge"], 0.05)
+        deadline = time.monotonic() + 1.0
+        while not self.cancelled and time.monotonic() < deadline:
+            time.sleep(0.005)
+        self.assertEqual(self.cancelled, [("primary", "hedge lost")])
+
+    def test_failed_primary_fails_over_at_once(self):
+        self.behaviour = {"primary": (0.0, ValueError("boom")), "secondary": (0.0, None)}
+        start = time.monotonic()
+        response, _provider, _upstream, _deltas = self._open(delay_s=5.0)
+        self.assertEqual(response.url, "secondary")
+        self.assertLess(time.monotonic() - start, 1.0)
+
+    def test_every_leg_failing_raises_the_primary_error(self):
+        primary_error = ValueError("primary down")
+        self.behaviour = {"primary": (0.0, primary_error), "secondary": (0.0, ValueError("secondary down"))}
+        with self.assertRaises(ValueError) as caught:
+            self._open()
+        self.assertIs(caught.exception, primary_error)
+
+    def test_cancelling_the_request_cancels_both_legs(self):
+        self.behaviour = {"primary": (2.0, None), "secondary": (2.0, None)}
+        threading.Timer(0.15, lambda: self.token.cancel("superseded")).start()
+        with self.assertRaises(RequestCancelled):
+            self._open()
+        self.assertEqual(sorted(self.cancelled), [("primary", "superseded"), ("secondary", "superseded")])
+
+    def test_streamed_leg_answers_with_its_first_token(self):
+        # Headers arrive at once on both legs; the primary's first token does not.
+        self.behaviour = {"primary": (0.0, None), "secondary": (0.0, None)}
+
+        def stream_text(response, provider):
+            if response.url == "primary":
+                time.sleep(1.0)
+            yield response.url + " first"
+            yield " rest"
+
+        with patch.object(suggest, "iter_stream_text", stream_text):
+            response, _provider, _upstream, deltas = self._open(stream=True)
+        self.assertEqual(response.url, "secondary")
+        self.assertEqual("".join(deltas), "secondary first rest")
+
+    def test_hedge_delay(self):
+        self.assertEqual(hedge_delay({"hedge_delay_ms": 250}, "u", "m"), 0.25)
+        answers = StageStats()
+        with patch.object(suggest, "_answer_times", answers):
+            self.assertEqual(hedge_delay({}, "u", "m"), suggest.HEDGE_DEFAULT_DELAY_S)
+            for i in range(20):
+                answers.record("primary", "u", "m", {"answer": (i + 1) / 10.0})
+            self.assertEqual(hedge_delay({"hedge_delay_ms": 0}, "u", "m"), 1.9)
+
+    def test_secondary_settings(self):
+        settings = SecondarySettings({"endpoint": "a", "secondary_endpoint": "b", "api_key": "k", "stream": False})
+        self.assertEqual(settings.get("endpoint"), "b")
+        self.assertEqual(settings.get("api_key", ""), "")
+        self.assertIs(settings.get("stream", True), False)
+
+
+class TestCandidates(unittest.TestCase):
+
+    def setUp(self):
+        self.view = FakeView(900, FakeSyntax("Python", "source.python"))
+        self.addCleanup(suggest._states.pop, self.view.id(), None)
+
+    def test_rendered_suggestion_goes_first_and_duplicates_are_dropped(self):
+        candidates = ["sampled early", "main"]
+        state = suggest._get_state(self.view.id())
+        state.phantom_set = object()
+        suggest._add_candidates(self.view, candidates, ["main", "", "other", "sampled early"], main=True)
+        self.assertEqual(candidates, ["main", "sampled early", "other"])
+        self.assertIs(state.candidates, candidates)
+
+    def test_late_candidates_only_join_their_own_phantom(self):
+        state = suggest._get_state(self.view.id())
+        state.phantom_set = object()
+        state.candidates = ["current"]
+        stale = ["old"]
+        suggest._add_candidates(self.view, stale, ["late"])
+        self.assertEqual(state.candidates, ["current"])
+        self.assertEqual(stale, ["old", "late"])
+
+
+_working_sublime = None
+
+
+def working_sublime():
+    """The runnable `sublime` stub (see sublime_stub), without replacing this file's stubs.
+
+    The plugin modules were imported against the attribute stubs above, so
+    tests patch the stub into the modules they exercise.
+    """
+    global _working_sublime
+    if _working_sublime is None:
+        saved = {name: sys.modules.get(name) for name in ("sublime", "sublime_plugin")}
+        _working_sublime = sublime_stub.install()
+        sys.modules.update(saved)
+    return _working_sublime
+
+
+def wait_for(predicate, timeout_s=10.0):
+    deadline = time.monotonic() + timeout_s
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.001)
+    return True
+
+
+class TestEnterTrigger(unittest.TestCase):
+    """A plain Enter request through `CodeContinueSuggestCommand.run` and its worker."""
+
+    def setUp(self):
+        self.sublime = working_sublime()
+        for module in (suggest, snapshot):
+            patcher = patch.object(module, "sublime", self.sublime)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.server = MockLLMServer(reply="    return x + 1\n")
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        settings = self.sublime.load_settings("CodeContinue.sublime-settings")
+        saved = dict(settings)
+        self.addCleanup(lambda: (settings.clear(), settings.update(saved)))
+        settings.clear()
+        settings.update({
+            "endpoint": self.server.url("/v1/chat/completions"),
+            "model": "mock-coder",
+            "stream": False,
+            "completion_mode": "chat",
+            "completion_cache_size": 0,
+        })
+
+    def test_enter_request_shows_phantom(self):
+        view = self.sublime.View(text="def inc(x):\n    ", window=self.sublime.Window())
+        self.addCleanup(suggest._states.pop, view.id(), None)
+        command = suggest.CodeContinueSuggestCommand.__new__(suggest.CodeContinueSuggestCommand)
+        command.view = view
+        sublime_stub.ui_call(command.run, None)
+        state = suggest._states[view.id()]
+        self.assertTrue(wait_for(lambda: state.cancel_token is None))
+        sublime_stub.ui_drain()
+        shown = suggest._states.get(view.id())
+        self.assertTrue(shown is not None and shown.has_phantom)
+        self.assertEqual(shown.remaining_lines, ["return x + 1"])
+        prompt = self.server.requests[-1][2]["messages"][1]["content"]
+        self.assertTrue(prompt.endswith("def inc(x):\n    "))
+
+    def request_body(self, text, **overrides):
+        settings = self.sublime.load_settings("CodeContinue.sublime-settings")
+        settings.update(overrides)
+        view = self.sublime.View(text=text, window=self.sublime.Window())
+        self.addCleanup(suggest._states.pop, view.id(), None)
+        self.addCleanup(suggest._context_anchors.pop, view.id(), None)
+        command = suggest.CodeContinueSuggestCommand.__new__(suggest.CodeContinueSuggestCommand)
+        command.view = view
+        sublime_stub.ui_call(command.run, None)
+        state = suggest._states[view.id()]
+        self.assertTrue(wait_for(lambda: state.cancel_token is None))
+        sublime_stub.ui_drain()
+        return self.server.requests[-1][2]
+
+    def test_prompt_caching_splits_off_a_cacheable_head(self):
+        code = "".join("value_{0} = compute({0}, scale=2)\n".format(i) for i in range(200)) + "total = "
+        body = self.request_body(code, endpoint=self.server.url("/v1/messages"), provider="anthropic",
+                                 context_token_budget=4096)
+        head, tail = body["messages"][0]["content"]
+        self.assertEqual(head["cache_control"], {"type": "ephemeral"})
+        self.assertNotIn("cache_control", tail)
+        self.assertTrue(tail["text"].endswith("total = "))
+        self.assertEqual(body["system"][0]["text"], suggest.DEFAULT_SYSTEM_PROMPT)
+
+    def test_code_stays_contiguous_without_prompt_caching(self):
+        code = "".join("value_{0} = compute({0}, scale=2)\n".format(i) for i in range(200)) + "total = "
+        body = self.request_body(code, context_token_budget=4096)
+        self.assertTrue(body["messages"][1]["content"].startswith("Continue the following code:\nvalue_"))
+        # Too short to be cached: sent whole.
+        body = self.request_body(code, endpoint=self.server.url("/v1/messages"), provider="anthropic",
+                                 context_token_budget=1024)
+        self.assertIsInstance(body["messages"][0]["content"], str)
+
+    def test_slow_semantic_lookup_is_skipped(self):
+        def slow_lookup(*args):
+            time.sleep(1.0)
+            return [("far.py", 0, "def far_away(): pass")]
+
+        with patch.object(suggest, "embedding_index", return_value=object()), \
+                patch.object(suggest, "semantic_snippets", side_effect=slow_lookup):
+            start = time.monotonic()
+            body = self.request_body("def inc(x):\n    ")
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertNotIn("far_away", body["messages"][1]["content"])
+        with patch.object(suggest, "embedding_index", return_value=object()), \
+                patch.object(suggest, "semantic_snippets", return_value=[("far.py", 0, "def far_away(): pass")]):
+            body = self.request_body("def inc(x):\n    ")
+        self.assertIn("far_away", body["messages"][1]["content"])
+
+    def test_slow_stream_does_not_count_as_latency(self):
+        server = MockLLMServer(reply="    return x + 1\n", tokens_per_s=10)
+        server.__enter__()
+        self.addCleanup(server.__exit__, None, None, None)
+        settings = self.sublime.load_settings("CodeContinue.sublime-settings")
+        settings.update({"endpoint": server.url("/v1/chat/completions"), "stream": True})
+        scheduler = RequestScheduler()
+        view = self.sublime.View(text="def inc(x):\n    ", window=self.sublime.Window())
+        self.addCleanup(suggest._states.pop, view.id(), None)
+        command = suggest.CodeContinueSuggestCommand.__new__(suggest.CodeContinueSuggestCommand)
+        command.view = view
+        with patch.object(suggest, "_scheduler", scheduler):
+            sublime_stub.ui_call(command.run, None)
+            state = suggest._states[view.id()]
+            self.assertTrue(wait_for(lambda: state.cancel_token is None, timeout_s=5.0))
+        sublime_stub.ui_drain()
+        bucket = scheduler.bucket(settings.get("endpoint"))
+        self.assertIsNotNone(bucket.latency_s)
+        self.assertLess(bucket.latency_s, 0.15)  # the reply takes ~0.4 s to stream
+
+
+class TestSplitForCache(unittest.TestCase):
+
+    def test_short_context_is_all_tail(self):
+        self.assertEqual(suggest._split_for_cache("a\nb\n    "), ("", "a\nb\n    "))
+
+    def test_head_only_moves_in_steps(self):
+        lines = ["line {0}".format(i) for i in range(100)]
+        heads = set()
+        for end in range(60, 70):
+            code_before = "\n".join(lines[:end]) + "\n    "
+            head, tail = suggest._split_for_cache(code_before)
+            self.assertEqual(head + tail, code_before)
+            self.assertGreater(tail.count("\n"), suggest.CACHE_TAIL_MIN_LINES - 1)
+            heads.add(head)
+        self.assertEqual(len(heads), 1)
+
+
+class TestRetrievalDocs(unittest.TestCase):
+    """Open views feed BM25 retrieval from their buffer snapshots."""
+
+    def setUp(self):
+        self.sublime = working_sublime()
+        for module in (suggest, snapshot):
+            patcher = patch.object(module, "sublime", self.sublime)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.view = self.sublime.View(text="def parse_header(raw):\n    return raw.split(':')\n")
+        self.addCleanup(suggest._forget_for_retrieval, self.view)
+        self.addCleanup(snapshot.drop_snapshot, self.view)
+
+    def snippets(self):
+        found = suggest._retrieve_snippets(-1, "header = parse_header(", "", 0, 200)
+        return "".join(text for _name, _row, text in found)
+
+    def test_revert_replaces_stale_chunks(self):
+        sublime_stub.ui_call(suggest._track_for_retrieval, self.view)
+        self.assertIn("raw.split", self.snippets())
+        # A revert swaps the text without text-change deltas or a new change count.
+        self.view.text = "def parse_header(line):\n    return line.partition(':')\n"
+        listener = snapshot.SnapshotChangeListener()
+        listener.buffer = types.SimpleNamespace(id=self.view.buffer_id, primary_view=lambda: self.view)
+        sublime_stub.ui_call(listener.on_revert)
+        snippets = self.snippets()
+        self.assertIn("line.partition", snippets)
+        self.assertNotIn("raw.split", snippets)
+
+    def test_buffer_stays_indexed_until_its_last_view_closes(self):
+        sublime_stub.ui_call(suggest._track_for_retrieval, self.view)
+        listener = suggest.CodeContinueListener()
+        with patch.object(self.view, "clones", return_value=[self.sublime.View()]):
+            listener.on_close(self.view)
+        self.assertIn(self.view.buffer_id(), suggest._retrieval_docs)
+        self.assertIn(self.view.buffer_id(), snapshot._snapshots)
+        listener.on_close(self.view)
+        self.assertNotIn(self.view.buffer_id(), suggest._retrieval_docs)
+        self.assertNotIn(self.view.buffer_id(), snapshot._snapshots)
+
+
+class TestChain(unittest.TestCase):
+
+    def setUp(self):
+        self.sublime = working_sublime()
+        patcher = patch.object(suggest, "sublime", self.sublime)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.view = self.sublime.View(text="x = 1\n")
+        self.chain = suggest.Chain(len(self.view.text), "y = 2\nz = 3", "")
+
+    def move_to_end(self, typed):
+        self.view.text += typed
+        self.view.sel()[:] = [self.sublime.Region(len(self.view.text))]
+
+    def test_still_valid_while_typing_the_pending_text(self):
+        self.assertTrue(suggest._chain_still_valid(self.view, self.chain))
+        self.move_to_end("y = 2\nz")
+        self.assertTrue(suggest._chain_still_valid(self.view, self.chain))
+        self.move_to_end(" = 3\n    ")
+        self.assertTrue(suggest._chain_still_valid(self.view, self.chain))  # Enter after the last line
+
+    def test_invalid_once_the_buffer_diverges(self):
+        self.move_to_end("y = 5")
+        self.assertFalse(suggest._chain_still_valid(self.view, self.chain))
+        self.view.text = "x = 1\n"
+        self.view.sel()[:] = [self.sublime.Region(2)]
+        self.assertFalse(suggest._chain_still_valid(self.view, self.chain))  # cursor before the start
+        self.view.sel()[:] = [self.sublime.Region(6), self.sublime.Region(0)]
+        self.assertFalse(suggest._chain_still_valid(self.view, self.chain))
+
+    def test_start_chain_respects_setting_budget_and_running_chain(self):
+        settings = {"endpoint": "http://localhost", "chain_suggestions": False}
+        calls = []
+        self.view.run_command = lambda name, args=None: calls.append((name, args))
+        with patch.object(self.sublime, "load_settings", lambda name: settings), \
+                patch.object(suggest._scheduler, "admit", return_value=True) as admit:
+            suggest._start_chain(self.view)
+            settings["chain_suggestions"] = True
+            admit.return_value = False
+            suggest._start_chain(self.view)
+            admit.return_value = True
+            suggest._start_chain(self.view)
+            with patch.dict(suggest._chains, {self.view.id(): self.chain}):
+                suggest._start_chain(self.view)
+        self.assertEqual(calls, [("code_continue_suggest", {"chain": True})])
+
+
 if __name__ == "__main__":
     unittest.main()
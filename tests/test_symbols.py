@@ -0,0 +1,133 @@
+"""Tests for utils.symbols — the project symbol index."""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils.symbols import SymbolIndex, extract_symbols, format_related
+
+
+API_PY = '''import json
+
+
+class Client:
+    def __init__(self, url):
+        self.url = url
+
+    def fetch_user(self, user_id,
+                   include_groups=False):
+        return json.loads(self.url)
+
+
+def parse_config(path, strict=True):
+    return {}
+'''
+
+
+class TestExtractSymbols(unittest.TestCase):
+
+    def test_python_declarations(self):
+        symbols = extract_symbols(API_PY)
+        self.assertEqual([name for name, _line, _sig in symbols], ["Client", "__init__", "fetch_user", "parse_config"])
+        self.assertIn((
+            "fetch_user", 8, "def fetch_user(self, user_id, include_groups=False):"
+        ), symbols)
+
+    def test_c_statements_are_not_declarations(self):
+        text = "int add(int a, int b) {\n    return add(a, b);\n    } else if (a) {\n}\nwith open(p) as f:\n"
+        self.assertEqual(extract_symbols(text), [("add", 1, "int add(int a, int b)")])
+
+
+class TestSymbolIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        os.makedirs(os.path.join(self.root, "pkg"))
+        os.makedirs(os.path.join(self.root, "node_modules", "dep"))
+        self.api = self.write("pkg/api.py", API_PY)
+        self.write("node_modules/dep/index.js", "function parse_config(x) {}\n")
+        self.cache = os.path.join(self.root, ".cache", "symbols.json")
+
+    def write(self, relpath, text, mtime=None):
+        path = os.path.join(self.root, relpath)
+        with open(path, "w") as f:
+            f.write(text)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_related_signatures_near_cursor(self):
+        index = SymbolIndex([self.root])
+        self.assertEqual(index.refresh(), 1)  # node_modules is skipped
+        before = "config = parse_config(args.path)\nclient = Client(config['url'])\nuser = client.fetch_user("
+        related = index.related(before, ")\n", budget=200)
+        self.assertEqual(related[0], ("pkg/api.py", "def fetch_user(self, user_id, include_groups=False):"))
+        self.assertIn(("pkg/api.py", "def parse_config(path, strict=True):"), related)
+
+    def test_budget_and_visible_declarations(self):
+        index = SymbolIndex([self.root])
+        index.refresh()
+        self.assertEqual(index.related("x = parse_config(p)", "", budget=5), [])
+        visible = "def parse_config(path, strict=True):\n    return {}\nparse_config("
+        self.assertEqual(index.related(visible, "", budget=200), [])
+
+    def test_rescan_only_rereads_changed_files(self):
+        index = SymbolIndex([self.root])
+        index.refresh()
+        self.assertEqual(index.refresh(), 0)
+        self.write("pkg/api.py", "def parse_config(path):\n    pass\n", mtime=1)
+        self.write("pkg/extra.py", "def helper():\n    pass\n")
+        self.assertEqual(index.refresh(), 2)
+        self.assertEqual(index.related("parse_config(", "", 200), [("pkg/api.py", "def parse_config(path):")])
+        os.remove(self.api)
+        self.assertEqual(index.refresh(), 1)
+        self.assertEqual(index.related("parse_config(", "", 200), [])
+
+    def test_persisted_between_sessions(self):
+        index = SymbolIndex([self.root], self.cache)
+        index.refresh()
+        index.save()
+        restored = SymbolIndex([self.root], self.cache)
+        self.assertTrue(restored.load())
+        self.assertEqual(len(restored), len(index))
+        self.assertEqual(restored.refresh(), 0)
+        self.assertFalse(SymbolIndex([self.root, "/elsewhere"], self.cache).load())
+
+    def test_refresh_async_saves_and_reports(self):
+        done = threading.Event()
+        results = []
+        index = SymbolIndex([self.root], self.cache)
+        index.refresh_async(on_done=lambda *args: (results.append(args), done.set()))
+        self.assertTrue(done.wait(5))
+        self.assertEqual(results[0][0], 1)
+        self.assertIsNone(results[0][2])
+        self.assertTrue(os.path.exists(self.cache))
+
+    def test_update_file_ignores_other_folders(self):
+        index = SymbolIndex([os.path.join(self.root, "pkg")])
+        index.update_file(self.api)
+        self.assertEqual(len(index), 4)
+        index.update_file(os.path.join(self.root, "node_modules", "dep", "index.js"))
+        self.assertEqual(len(index), 4)
+
+
+class TestFormatRelated(unittest.TestCase):
+
+    def test_commented_block_groups_by_file(self):
+        block = format_related([("a.py", "def f(x):"), ("a.py", "def g():"), ("b.py", "class B:")], "#")
+        self.assertEqual(block, (
+            "# Related definitions elsewhere in the project:\n"
+            "# a.py:\n#   def f(x):\n#   def g():\n"
+            "# b.py:\n#   class B:\n"
+        ))
+        self.assertEqual(format_related([]), "")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,8 +8,15 @@ import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
 from utils.text_utils import (
+    build_context,
     clean_markdown_fences,
+    consume_typed_prefix,
     describe_code_selection,
+    estimate_tokens,
+    extend_to_anchor,
+    slice_around,
+    slice_lines,
+    splice_lines,
     strip_common_indent,
 )
 
@@ -230,6 +237,109 @@ class TestDescribeCodeSelection(unittest.TestCase):
         self.assertEqual(describe_code_selection("   \n\t  "), "selected code")
 
 
+class TestConsumeTypedPrefix(unittest.TestCase):
+    """consume_typed_prefix should trim matching keystrokes and flag divergence."""
+
+    def test_partial_first_line(self):
+        self.assertEqual(consume_typed_prefix("ret", ["return x", "y"]), ["urn x", "y"])
+
+    def test_full_first_line(self):
+        self.assertEqual(consume_typed_prefix("return x", ["return x", "y"]), ["", "y"])
+
+    def test_divergence(self):
+        self.assertIsNone(consume_typed_prefix("rex", ["return x"]))
+
+    def test_newline_skips_auto_indent(self):
+        lines = ["if x:", "    return 1", "return 2"]
+        self.assertEqual(consume_typed_prefix("if x:\n        ret", lines), ["urn 1", "return 2"])
+
+    def test_newline_before_line_finished_diverges(self):
+        self.assertIsNone(consume_typed_prefix("if\n", ["if x:", "pass"]))
+
+    def test_newline_past_last_line_diverges(self):
+        self.assertIsNone(consume_typed_prefix("x\n", ["x"]))
+
+    def test_empty_typed_is_noop(self):
+        self.assertEqual(consume_typed_prefix("", ["a", "b"]), ["a", "b"])
+
+
+class TestBuildContext(unittest.TestCase):
+    """build_context should respect the budget and keep whole lines."""
+
+    def setUp(self):
+        self.before = "\n".join("line_before_{0:02d}".format(i) for i in range(50)) + "\n    x = "
+        self.after = "1\n" + "\n".join("line_after_{0:02d}".format(i) for i in range(50))
+
+    def test_estimate_tokens(self):
+        self.assertEqual(estimate_tokens(""), 0)
+        self.assertGreater(estimate_tokens("a" * 400), estimate_tokens("a" * 40))
+
+    def test_keeps_cursor_line_and_whole_lines(self):
+        before, after = build_context(self.before, self.after, 60)
+        self.assertTrue(before.endswith("\n    x = "))
+        self.assertTrue(after.startswith("1"))
+        for line in before.split("\n")[:-1] + after.split("\n")[1:]:
+            self.assertRegex(line, r"^line_(before|after)_\d\d$")
+
+    def test_respects_budget(self):
+        before, after = build_context(self.before, self.after, 60)
+        self.assertLessEqual(estimate_tokens(before) + estimate_tokens(after), 60 + 2)
+
+    def test_weights_toward_prefix(self):
+        before, after = build_context(self.before, self.after, 120)
+        self.assertGreater(before.count("\n"), 2 * after.count("\n"))
+        before, after = build_context(self.before, self.after, 120, prefix_weight=1.0)
+        self.assertEqual(after, "1")
+
+    def test_unused_suffix_budget_goes_to_prefix(self):
+        before, after = build_context(self.before, "", 120)
+        full_before, _after = build_context(self.before, "", 120, prefix_weight=1.0)
+        self.assertEqual(before, full_before)
+
+    def test_everything_fits(self):
+        self.assertEqual(build_context(self.before, self.after, 100000), (self.before, self.after))
+
+    def test_extend_to_anchor(self):
+        lines = ["a = 1", "b = 2", "c = 3"]
+        self.assertEqual(extend_to_anchor("c = 3\nx", lines, 1, 100), "a = 1\nb = 2\nc = 3\nx")
+        self.assertEqual(extend_to_anchor("c = 3\nx", lines, 1, 3), "c = 3\nx")  # too costly: re-anchor
+        self.assertEqual(extend_to_anchor("b = 2\nc = 3\nx", lines[2:], 2, 100), "b = 2\nc = 3\nx")
+
+
+class TestSnapshotHelpers(unittest.TestCase):
+    """splice_lines should track edits; slice_* should cut windows out of lines."""
+
+    def _apply(self, text, a, b, new):
+        lines = text.split("\n")
+        def rowcol(pt):
+            return text[:pt].count("\n"), pt - (text.rfind("\n", 0, pt) + 1)
+        splice_lines(lines, *rowcol(a), *rowcol(b), new)
+        self.assertEqual("\n".join(lines), text[:a] + new + text[b:])
+
+    def test_splice_insert_and_delete(self):
+        text = "def f():\n    pass\n\nx = 1"
+        self._apply(text, 9, 9, "  ")
+        self._apply(text, 8, 8, "\n    y = 2")
+        self._apply(text, 4, 20, "")
+        self._apply(text, 0, len(text), "")
+        self._apply("", 0, 0, "a\nb\n")
+
+    def test_slice_around(self):
+        lines = ["aaaa", "bbbb", "cc|dd", "eeee", "ffff"]
+        before, after = slice_around(lines, 2, 2, 7)
+        self.assertEqual(before, "bbbb\ncc")
+        self.assertEqual(after, "|dd\neeee")
+
+    def test_slice_around_long_cursor_line(self):
+        before, after = slice_around(["x" * 100], 0, 50, 10)
+        self.assertEqual((len(before), len(after)), (10, 10))
+
+    def test_slice_lines(self):
+        lines = ["a", "b", "c|d", "e", "f"]
+        self.assertEqual(slice_lines(lines, 2, 1, 1, 1), ("b\nc", "|d\ne\n"))
+        self.assertEqual(slice_lines(lines, 2, 1, 5, 5), ("a\nb\nc", "|d\ne\nf"))
+
+
 if __name__ == "__main__":
     unittest.main()
 
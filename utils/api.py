@@ -2,10 +2,22 @@
 
 `settings` is duck-typed (anything with `.get(key, default)`), so callers can
 pass either a `sublime.Settings` object or a plain dict in tests.
+
+Completion requests go through `open_url`, which keeps per-host keep-alive
+connections in a shared `ConnectionPool` so repeated suggestions skip the TCP
+and TLS handshakes. A per-host circuit breaker (`endpoint_health`)
+makes requests to a server that keeps failing fail at once until a
+background probe reaches it again.
+`SlotAffinity` pins views to a llama.cpp server's KV-cache slots, which
+`format_payload` passes on as `id_slot`.
 """
 
 
 class OpenAIProvider:
+    # Can return several choices for one prompt ("n"); Ollama's native
+    # /api/chat cannot, and servers that ignore it return a single choice.
+    supports_n = True
+
     def build_headers(self, settings):
         headers = {"Content-Type": "application/json", "User-Agent": "Mozilla/5.0"}
         api_key = settings.get("api_key", "")
@@ -13,22 +25,102 @@ class OpenAIProvider:
             headers["Authorization"] = "Bearer {0}".format(api_key)
         return headers
 
-    def format_payload(self, model, messages, max_tokens, temperature, stream=False):
+    def format_payload(self, model, messages, max_tokens, temperature, stream=False, n=1, slot=None):
         payload = {
             "model": model,
-            "messages": messages,
+            "messages": [_joined(msg) for msg in messages],
             "max_tokens": max_tokens,
             "temperature": temperature
         }
         if stream:
             payload["stream"] = True
+        if n > 1:
+            payload["n"] = n
+        _pin_slot(payload, slot)
         return payload
 
     def parse_response(self, result_dict):
         return result_dict.get("choices", [{}])[0].get("message", {}).get("content", "").strip()
 
+    def parse_candidates(self, result_dict):
+        """Every choice of a (possibly `n` > 1) reply, in index order."""
+        choices = sorted(result_dict.get("choices") or [{}], key=lambda c: c.get("index", 0))
+        return [(c.get("message") or {}).get("content", "").strip() for c in choices]
+
+    def parse_stream_event(self, event):
+        """Return the text delta carried by one streamed chunk (may be "").
+
+        Handles OpenAI-style `choices[0].delta.content` and Ollama's native
+        NDJSON `message.content`.
+        """
+        if "error" in event:
+            raise ValueError("Stream error: {0}".format(event["error"]))
+        choices = event.get("choices")
+        if choices:
+            return (choices[0].get("delta") or {}).get("content") or ""
+        message = event.get("message")
+        if isinstance(message, dict):
+            return message.get("content") or ""
+        return ""
+
+    def parse_stream_choices(self, event):
+        """Return `[(choice index, text delta), ...]` for one streamed chunk."""
+        choices = event.get("choices")
+        if "error" in event or not choices:
+            return [(0, self.parse_stream_event(event))]
+        return [(c.get("index", 0), (c.get("delta") or {}).get("content") or "") for c in choices]
+
+
+def _joined(message):
+    """*message* with segmented content (a list of strings) joined into one string.
+
+    Callers may split a message into segments, most stable first, so that
+    providers with content-keyed caches can mark where the stable part ends.
+    """
+    if isinstance(message["content"], list):
+        return dict(message, content="".join(message["content"]))
+    return message
+
+
+def _pin_slot(payload, slot):
+    """Ask a llama.cpp server to keep the prompt's KV cache in *slot* (None: leave as is).
+
+    Other servers ignore the fields; vLLM and SGLang match cached
+    prefixes on their own.
+    """
+    if slot is not None:
+        payload["cache_prompt"] = True
+        payload["id_slot"] = slot
+
+
+# Shortest prompt prefix Anthropic will cache, in tokens: the first
+# (model name fragment, minimum) that matches, else the default.
+ANTHROPIC_MIN_CACHE_TOKENS = (("opus-4-5", 4096), ("haiku-4-5", 4096), ("haiku", 2048))
+ANTHROPIC_DEFAULT_MIN_CACHE_TOKENS = 1024
+
 
 class AnthropicProvider:
+    """Messages API. With *prompt_caching*, `format_payload` sets cache breakpoints.
+
+    The breakpoints sit on the system prompt, the first message (the chat's
+    code block), the message before the last one (the older history) and
+    the end of every segment but the last of a segmented message (the
+    stable head of a suggest prompt's code). The final message or segment
+    is the part that changes from one request to the next, so it is left
+    out.
+    """
+
+    def __init__(self, prompt_caching=False):
+        self.prompt_caching = prompt_caching
+
+    def min_cache_tokens(self, model):
+        """Tokens a prefix needs before *model* caches it; shorter ones are sent uncached."""
+        name = model.lower()
+        for fragment, tokens in ANTHROPIC_MIN_CACHE_TOKENS:
+            if fragment in name:
+                return tokens
+        return ANTHROPIC_DEFAULT_MIN_CACHE_TOKENS
+
     def build_headers(self, settings):
         headers = {
             "Content-Type": "application/json",
@@ -40,7 +132,9 @@ class AnthropicProvider:
             headers["x-api-key"] = api_key
         return headers
 
-    def format_payload(self, model, messages, max_tokens, temperature, stream=False):
+    def format_payload(self, model, messages, max_tokens, temperature, stream=False, n=1, slot=None):
+        # The Messages API has no "n"; callers sample extra candidates in parallel.
+        # Nor server slots: its prompt cache is keyed on content (see prompt_caching).
         payload = {
             "model": model,
             "max_tokens": max_tokens,
@@ -53,9 +147,21 @@ class AnthropicProvider:
         for msg in messages:
             if msg["role"] == "system":
                 payload["system"] = msg["content"]
+            elif self.prompt_caching and isinstance(msg["content"], list) and any(msg["content"]):
+                parts = [part for part in msg["content"] if part]
+                content = [_cached_text(part) for part in parts[:-1]] + [{"type": "text", "text": parts[-1]}]
+                anthropic_messages.append({"role": msg["role"], "content": content})
             else:
-                anthropic_messages.append(msg)
-                
+                anthropic_messages.append(_joined(msg))
+
+        if self.prompt_caching:
+            if payload.get("system"):
+                payload["system"] = [_cached_text(payload["system"])]
+            for i in {0, len(anthropic_messages) - 2}:
+                if 0 <= i < len(anthropic_messages) - 1 and isinstance(anthropic_messages[i]["content"], str):
+                    msg = anthropic_messages[i]
+                    anthropic_messages[i] = {"role": msg["role"], "content": [_cached_text(msg["content"])]}
+
         payload["messages"] = anthropic_messages
         return payload
 
@@ -65,24 +171,234 @@ class AnthropicProvider:
             return content[0].get("text", "").strip()
         return ""
 
+    def parse_stream_event(self, event):
+        """Return the text delta carried by one streamed event (may be "")."""
+        event_type = event.get("type")
+        if event_type == "content_block_delta":
+            return event.get("delta", {}).get("text", "")
+        if event_type == "error":
+            raise ValueError("Stream error: {0}".format(event.get("error")))
+        return ""
+
+
+def _cached_text(text):
+    """A text content block marked as the end of a cacheable prefix."""
+    return {"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}
+
+
+def parse_usage(result):
+    """Token counts from a response body or stream event, or None.
+
+    Returns a dict with any of "prompt" (all input tokens, cached ones
+    included), "cached" (read from the provider's prompt cache),
+    "written" (added to it) and "output". Understands Anthropic `usage`
+    (also inside `message_start`), OpenAI `usage.prompt_tokens_details`
+    and llama.cpp `timings`.
+    """
+    usage = result.get("usage")
+    if result.get("type") == "message_start":
+        usage = (result.get("message") or {}).get("usage")
+    out = {}
+    if isinstance(usage, dict):
+        if usage.get("input_tokens") is not None:
+            # Anthropic counts cache reads and writes apart from input_tokens.
+            read = usage.get("cache_read_input_tokens") or 0
+            written = usage.get("cache_creation_input_tokens") or 0
+            out.update(prompt=usage["input_tokens"] + read + written, cached=read, written=written)
+        elif usage.get("prompt_tokens") is not None:
+            out["prompt"] = usage["prompt_tokens"]
+            cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+            if cached is not None:
+                out["cached"] = cached
+        output = usage.get("output_tokens", usage.get("completion_tokens"))
+        if output is not None:
+            out["output"] = output
+    timings = result.get("timings")
+    if isinstance(timings, dict) and timings.get("cache_n") is not None:
+        out.setdefault("cached", timings["cache_n"])
+        out.setdefault("prompt", timings["cache_n"] + (timings.get("prompt_n") or 0))
+    return out or None
+
+
+def format_usage(usage):
+    """One-line summary of a `parse_usage` dict, for the log."""
+    parts = ["{0} prompt tokens".format(usage.get("prompt", "?"))]
+    if "cached" in usage:
+        cached = "{0} cached".format(usage["cached"])
+        if usage.get("prompt"):
+            cached += " ({0:.0%})".format(usage["cached"] / usage["prompt"])
+        parts.append(cached)
+    if usage.get("written"):
+        parts.append("{0} written to cache".format(usage["written"]))
+    if "output" in usage:
+        parts.append("{0} output".format(usage["output"]))
+    return ", ".join(parts)
+
+
+# Native fill-in-the-middle prompt formats: name -> (prompt template, stop strings).
+# Used when the server's `suffix` field is not enough (e.g. a plain
+# `/v1/completions` server that passes the prompt to the model verbatim).
+FIM_TEMPLATES = {
+    "qwen": (
+        "<|fim_prefix|>{prefix}<|fim_suffix|>{suffix}<|fim_middle|>",
+        ["<|endoftext|>", "<|fim_pad|>", "<|file_sep|>", "<|im_end|>"],
+    ),
+    "starcoder": (
+        "<fim_prefix>{prefix}<fim_suffix>{suffix}<fim_middle>",
+        ["<|endoftext|>", "<file_sep>"],
+    ),
+    "codellama": (
+        "<PRE> {prefix} <SUF>{suffix} <MID>",
+        ["<EOT>"],
+    ),
+    "deepseek": (
+        "<\uff5cfim\u2581begin\uff5c>{prefix}<\uff5cfim\u2581hole\uff5c>{suffix}<\uff5cfim\u2581end\uff5c>",
+        ["<\uff5cend\u2581of\u2581sentence\uff5c>", "<|EOT|>"],
+    ),
+    "codestral": (
+        "[SUFFIX]{suffix}[PREFIX]{prefix}",
+        ["</s>"],
+    ),
+}
+
+# Model-name fragments mapped to their FIM template for `fim_template: "auto"`.
+_FIM_MODEL_HINTS = (
+    ("qwen", "qwen"),
+    ("starcoder", "starcoder"),
+    ("codellama", "codellama"),
+    ("code-llama", "codellama"),
+    ("deepseek", "deepseek"),
+    ("codestral", "codestral"),
+)
+
+
+def detect_fim_template(model):
+    """Guess the FIM template name from a model ID, or None if unknown."""
+    model = (model or "").lower()
+    for hint, name in _FIM_MODEL_HINTS:
+        if hint in model:
+            return name
+    return None
+
+
+class FIMProvider:
+    """Fill-in-the-middle completions: the model sees the code after the cursor.
+
+    `api` selects the wire format: "completions" (OpenAI-style
+    `/v1/completions` with `prompt` / `suffix`), "infill" (llama.cpp
+    `/infill`) or "ollama" (`/api/generate` with `suffix`). With a `template`
+    the prompt is assembled from the model's own FIM tokens instead of
+    relying on the server's `suffix` support.
+    """
+
+    def __init__(self, api="completions", template=None):
+        self.api = api
+        self.template = template
+
+    @property
+    def supports_n(self):
+        return self.api == "completions"
+
+    def build_headers(self, settings):
+        return OpenAIProvider().build_headers(settings)
+
+    def format_payload(self, model, prefix, suffix, max_tokens, temperature, stream=False, n=1, slot=None):
+        if self.api == "infill":
+            payload = {
+                "input_prefix": prefix,
+                "input_suffix": suffix,
+                "n_predict": max_tokens,
+                "temperature": temperature,
+            }
+        elif self.api == "ollama":
+            payload = {
+                "model": model,
+                "prompt": prefix,
+                "suffix": suffix,
+                "stream": stream,
+                "options": {"num_predict": max_tokens, "temperature": temperature},
+            }
+        else:
+            payload = {
+                "model": model,
+                "max_tokens": max_tokens,
+                "temperature": temperature,
+            }
+            if self.template in FIM_TEMPLATES:
+                template, stop = FIM_TEMPLATES[self.template]
+                payload["prompt"] = template.format(prefix=prefix, suffix=suffix)
+                payload["stop"] = stop
+            else:
+                payload["prompt"] = prefix
+                payload["suffix"] = suffix
+            if n > 1:
+                payload["n"] = n
+        if self.api != "ollama":
+            _pin_slot(payload, slot)
+        if stream:
+            payload["stream"] = True
+        return payload
+
+    def parse_response(self, result_dict):
+        if self.api == "infill":
+            return result_dict.get("content", "").rstrip()
+        if self.api == "ollama":
+            return result_dict.get("response", "").rstrip()
+        return result_dict.get("choices", [{}])[0].get("text", "").rstrip()
+
+    def parse_candidates(self, result_dict):
+        """Every choice of a (possibly `n` > 1) reply, in index order."""
+        if self.api != "completions":
+            return [self.parse_response(result_dict)]
+        choices = sorted(result_dict.get("choices") or [{}], key=lambda c: c.get("index", 0))
+        return [c.get("text", "").rstrip() for c in choices]
+
+    def parse_stream_event(self, event):
+        """Return the text delta carried by one streamed chunk (may be "")."""
+        if "error" in event:
+            raise ValueError("Stream error: {0}".format(event["error"]))
+        if self.api == "infill":
+            return event.get("content") or ""
+        if self.api == "ollama":
+            return event.get("response") or ""
+        choices = event.get("choices")
+        if choices:
+            return choices[0].get("text") or ""
+        return ""
+
+    def parse_stream_choices(self, event):
+        """Return `[(choice index, text delta), ...]` for one streamed chunk."""
+        choices = event.get("choices")
+        if self.api != "completions" or "error" in event or not choices:
+            return [(0, self.parse_stream_event(event))]
+        return [(c.get("index", 0), c.get("text") or "") for c in choices]
+
 
 def get_provider(endpoint, settings=None):
     """Return the appropriate API provider for the endpoint."""
     if settings:
         provider_name = settings.get("provider", "").lower()
         if provider_name == "anthropic":
-            return AnthropicProvider()
+            return AnthropicProvider(settings.get("prompt_caching", True))
         elif provider_name == "openai":
             return OpenAIProvider()
 
     if "api.anthropic.com" in endpoint or "/v1/messages" in endpoint:
-        return AnthropicProvider()
+        return AnthropicProvider(settings.get("prompt_caching", True) if settings else False)
     
     return OpenAIProvider()
 
 
+import collections
+import http.client
+import io
 import json
+import socket
+import ssl
+import threading
+import time
 import urllib.error
+import urllib.parse
 import urllib.request
 
 
@@ -116,6 +432,73 @@ def normalize_endpoint(url):
     return "{0}/v1/chat/completions".format(url)
 
 
+def get_fim_endpoint(endpoint, fim_api="completions"):
+    """Derive the fill-in-the-middle endpoint from a chat endpoint.
+
+    Returns `(url, api)` where *api* is the `FIMProvider` wire format, or
+    `(None, None)` for Anthropic, which has no FIM API.
+
+    Examples:
+    - 'http://localhost:8000/v1/chat/completions' -> '.../v1/completions'
+    - 'http://localhost:8080/v1/chat/completions' with fim_api 'infill' -> 'http://localhost:8080/infill'
+    - 'http://localhost:11434/api/chat' -> 'http://localhost:11434/api/generate'
+    """
+    endpoint = normalize_endpoint(endpoint)
+    if not endpoint or "anthropic.com" in endpoint or endpoint.endswith("/messages"):
+        return None, None
+
+    if endpoint.endswith(("/api/chat", "/api/generate")):
+        return endpoint.rsplit("/", 1)[0] + "/generate", "ollama"
+
+    if fim_api == "infill":
+        parts = urllib.parse.urlsplit(endpoint)
+        return "{0}://{1}/infill".format(parts.scheme, parts.netloc), "infill"
+
+    if endpoint.endswith("/chat/completions"):
+        return endpoint[:-len("/chat/completions")] + "/completions", "completions"
+    return endpoint, "completions"
+
+
+def get_fim_provider(endpoint, settings, model=""):
+    """Return `(url, FIMProvider)` for the configured endpoint, or `(None, None)`.
+
+    `fim_template` is "auto" (guess from the model name, falling back to the
+    server's `suffix` field), "none", or one of `FIM_TEMPLATES`.
+    """
+    if settings.get("provider", "").lower() == "anthropic":
+        return None, None
+    url, api = get_fim_endpoint(endpoint, settings.get("fim_api", "completions"))
+    if url is None:
+        return None, None
+
+    template = settings.get("fim_template", "auto")
+    if template == "auto":
+        template = detect_fim_template(model)
+    elif template not in FIM_TEMPLATES:
+        template = None
+    return url, FIMProvider(api, template)
+
+
+def get_embeddings_endpoint(endpoint):
+    """Derive the OpenAI-style embeddings endpoint from a chat endpoint.
+
+    Returns "" for Anthropic, which has no embeddings API.
+
+    Examples:
+    - 'http://localhost:1234/v1/chat/completions' -> 'http://localhost:1234/v1/embeddings'
+    - 'http://localhost:11434/api/chat' -> 'http://localhost:11434/v1/embeddings'
+    """
+    endpoint = normalize_endpoint(endpoint)
+    if not endpoint or "anthropic.com" in endpoint or endpoint.endswith("/messages"):
+        return ""
+
+    if endpoint.endswith(("/api/chat", "/api/generate")):
+        return endpoint.rsplit("/api/", 1)[0] + "/v1/embeddings"
+    if endpoint.endswith("/chat/completions"):
+        return endpoint[:-len("/chat/completions")] + "/embeddings"
+    return endpoint
+
+
 def get_models_endpoint(endpoint):
     """Derive the models list endpoint from a chat/messages endpoint."""
     endpoint = normalize_endpoint(endpoint)
@@ -214,3 +597,653 @@ def test_endpoint_connectivity(endpoint, api_key="", timeout_s=3.0):
         return False, "Connection error: {0}".format(str(e)[:60])
 
 
+
+
+# Keep-alive pool limits. Idle connections older than POOL_IDLE_TIMEOUT_S are
+# closed on the next checkout; at most POOL_MAX_PER_HOST sockets (idle + busy)
+# are open to a single host at any time.
+POOL_IDLE_TIMEOUT_S = 30.0
+POOL_MAX_PER_HOST = 4
+
+# Errors raised by http.client when a reused keep-alive socket was closed by
+# the server while idle. The request never reached the server, so it is safe
+# to retry once on a fresh connection.
+_STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    BrokenPipeError,
+    ConnectionResetError,
+    ConnectionAbortedError,
+)
+
+
+class RequestCancelled(Exception):
+    """Raised when a request is aborted through its CancelToken."""
+
+
+def _shutdown_socket(conn):
+    sock = conn.sock
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class CancelToken:
+    """Lets another thread abort a request at any stage.
+
+    `open_url(..., cancel=token)` attaches the request's connection to the
+    token; `cancel()` then shuts the socket down, which unblocks the worker
+    thread wherever it is waiting (connect, first byte, streaming) and tells
+    the server the client is gone so it stops generating. The connection is
+    detached before it returns to the pool, so a late `cancel()` can never
+    touch a socket that is serving another request.
+    """
+
+    __slots__ = ("cancelled", "reason", "_closer", "_lock")
+
+    def __init__(self):
+        self.cancelled = False
+        self.reason = ""
+        self._closer = None
+        self._lock = threading.Lock()
+
+    def cancel(self, reason=""):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            self.reason = reason
+            if self._closer is not None:
+                self._closer()
+
+    def attach(self, closer):
+        """Register how to abort the live request; raises if already cancelled."""
+        with self._lock:
+            if self.cancelled:
+                raise RequestCancelled(self.reason)
+            self._closer = closer
+
+    def detach(self):
+        with self._lock:
+            self._closer = None
+
+
+class PooledResponse:
+    """Response wrapper that hands its connection back to the pool on close.
+
+    Mirrors the parts of the `urlopen` response API the plugin uses
+    (`read`, `readline`, `status`, `headers`, context-manager support).
+    """
+
+    def __init__(self, pool, key, conn, response, cancel=None):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._cancel = cancel
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self.connect_s = None  # seconds spent opening a new socket, None if reused
+        self.usage = None      # token counts, set by `iter_stream_text`
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, amt=None):
+        return self._response.read(amt)
+
+    def readline(self):
+        return self._response.readline()
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        if self._cancel is not None:
+            self._cancel.detach()
+        # Only a fully drained response leaves the socket ready for reuse.
+        reusable = self._response.isclosed() and not self._response.will_close
+        if self._cancel is not None and self._cancel.cancelled:
+            reusable = False
+        if not reusable:
+            self._response.close()
+        self._pool.release(self._key, conn, reusable)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class ConnectionPool:
+    """Per-host pool of keep-alive `http.client` connections.
+
+    Connections are keyed on (scheme, host, port). Checkout prefers the most
+    recently used idle socket, evicts sockets idle for longer than
+    `idle_timeout_s`, and blocks (up to the request timeout) when a host
+    already has `max_per_host` connections open. A single SSL context is
+    created lazily and shared by every HTTPS connection.
+    """
+
+    def __init__(self, max_per_host=POOL_MAX_PER_HOST, idle_timeout_s=POOL_IDLE_TIMEOUT_S):
+        self.max_per_host = max_per_host
+        self.idle_timeout_s = idle_timeout_s
+        self._cond = threading.Condition()
+        self._idle = {}    # key -> [(conn, last_used_monotonic)]
+        self._active = {}  # key -> number of checked-out connections
+        self._ssl_context = None
+
+    def _get_ssl_context(self):
+        if self._ssl_context is None:
+            self._ssl_context = ssl.create_default_context()
+        return self._ssl_context
+
+    def _new_connection(self, key, timeout_s):
+        scheme, host, port = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(
+                host, port, timeout=timeout_s, context=self._get_ssl_context()
+            )
+        return http.client.HTTPConnection(host, port, timeout=timeout_s)
+
+    def _evict_expired(self, now):
+        """Close idle connections past their idle timeout. Caller holds the lock."""
+        for key in list(self._idle):
+            fresh = []
+            for conn, last_used in self._idle[key]:
+                if now - last_used > self.idle_timeout_s:
+                    conn.close()
+                else:
+                    fresh.append((conn, last_used))
+            if fresh:
+                self._idle[key] = fresh
+            else:
+                del self._idle[key]
+
+    def acquire(self, key, timeout_s):
+        """Check out a connection for *key*.
+
+        Returns (conn, reused). Raises urllib.error.URLError if the host stays
+        at its connection cap for longer than *timeout_s*.
+        """
+        deadline = time.monotonic() + timeout_s
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._evict_expired(now)
+                idle = self._idle.get(key)
+                if idle:
+                    conn, _last_used = idle.pop()
+                    if not idle:
+                        del self._idle[key]
+                    self._active[key] = self._active.get(key, 0) + 1
+                    return conn, True
+                if self._active.get(key, 0) < self.max_per_host:
+                    self._active[key] = self._active.get(key, 0) + 1
+                    break
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise urllib.error.URLError(
+                        "connection pool exhausted for {0}:{1}".format(key[1], key[2])
+                    )
+                self._cond.wait(remaining)
+        return self._new_connection(key, timeout_s), False
+
+    def release(self, key, conn, reusable):
+        """Return a checked-out connection; closes it unless *reusable*."""
+        with self._cond:
+            self._active[key] = max(0, self._active.get(key, 0) - 1)
+            if reusable:
+                self._idle.setdefault(key, []).append((conn, time.monotonic()))
+            else:
+                conn.close()
+            self._cond.notify()
+
+    def close_all(self):
+        """Close every idle connection (busy ones close when released)."""
+        with self._cond:
+            for conns in self._idle.values():
+                for conn, _last_used in conns:
+                    conn.close()
+            self._idle.clear()
+
+    def request(self, url, data=None, headers=None, timeout_s=30.0, method=None, cancel=None):
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ("http", "https") or not parts.hostname:
+            raise urllib.error.URLError("unsupported URL: {0}".format(url))
+        port = parts.port or (443 if scheme == "https" else 80)
+        key = (scheme, parts.hostname, port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        method = method or ("POST" if data is not None else "GET")
+        headers = dict(headers or {})
+
+        for attempt in range(2):
+            if cancel is not None and cancel.cancelled:
+                raise RequestCancelled(cancel.reason)
+            conn, reused = self.acquire(key, timeout_s)
+            connect_s = None
+            try:
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout_s)
+                else:
+                    conn.timeout = timeout_s
+                    connect_start = time.monotonic()
+                    conn.connect()
+                    connect_s = time.monotonic() - connect_start
+                if cancel is not None:
+                    cancel.attach(lambda conn=conn: _shutdown_socket(conn))
+                conn.request(method, path, body=data, headers=headers)
+                response = conn.getresponse()
+            except _STALE_CONNECTION_ERRORS as e:
+                self._discard(key, conn, cancel)
+                if reused and attempt == 0:
+                    continue
+                raise urllib.error.URLError(e)
+            except (OSError, http.client.HTTPException) as e:
+                self._discard(key, conn, cancel)
+                raise urllib.error.URLError(e)
+            except BaseException:
+                self._discard(key, conn, cancel)
+                raise
+
+            pooled = PooledResponse(self, key, conn, response, cancel)
+            pooled.connect_s = connect_s
+            if response.status >= 400:
+                try:
+                    body = pooled.read()
+                finally:
+                    pooled.close()
+                raise urllib.error.HTTPError(
+                    url, response.status, response.reason, response.headers, io.BytesIO(body)
+                )
+            return pooled
+
+    def _discard(self, key, conn, cancel):
+        """Close a connection whose request failed; re-raise as cancelled if it was."""
+        if cancel is not None:
+            cancel.detach()
+        self.release(key, conn, False)
+        if cancel is not None and cancel.cancelled:
+            raise RequestCancelled(cancel.reason)
+
+
+_pool = ConnectionPool()
+
+
+def _uses_proxy(url):
+    """True when the environment routes *url* through an HTTP proxy."""
+    parts = urllib.parse.urlsplit(url)
+    proxies = urllib.request.getproxies()
+    if parts.scheme.lower() not in proxies:
+        return False
+    return not urllib.request.proxy_bypass(parts.hostname or "")
+
+
+# Circuit breaker tuning. A host that fails BREAKER_FAILURE_THRESHOLD requests
+# in a row is probed in the background, first after BREAKER_PROBE_INTERVAL_S,
+# backing off to BREAKER_MAX_PROBE_INTERVAL_S while it stays down.
+BREAKER_FAILURE_THRESHOLD = 3
+BREAKER_PROBE_INTERVAL_S = 2.0
+BREAKER_MAX_PROBE_INTERVAL_S = 30.0
+
+BREAKER_CLOSED = "closed"        # healthy: requests go through
+BREAKER_OPEN = "open"            # down: requests fail at once while probes run
+BREAKER_HALF_OPEN = "half-open"  # a probe got through: one trial request decides
+
+# Gateway errors mean the server behind a proxy is down; they count as outages.
+_OUTAGE_STATUS = (502, 503, 504)
+
+
+class EndpointUnavailable(urllib.error.URLError):
+    """Raised without touching the network while a host's breaker is open."""
+
+
+def is_outage_error(error):
+    """True for failures that mean the server is unreachable (not a bad request)."""
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code in _OUTAGE_STATUS
+    return isinstance(error, urllib.error.URLError) and not isinstance(error, EndpointUnavailable)
+
+
+def _host_key(url):
+    parts = urllib.parse.urlsplit(url)
+    scheme = parts.scheme.lower()
+    try:
+        port = parts.port or (443 if scheme == "https" else 80)
+    except ValueError:
+        port = None
+    return scheme, parts.hostname, port
+
+
+def host_label(url):
+    """`host:port` of *url*, for status messages."""
+    _scheme, host, port = _host_key(url)
+    return "{0}:{1}".format(host, port)
+
+
+class _Breaker:
+    __slots__ = ("state", "failures", "url", "probing", "trial")
+
+    def __init__(self, url):
+        self.state = BREAKER_CLOSED
+        self.failures = 0       # consecutive outage errors
+        self.url = url          # last URL requested, probed while open
+        self.probing = False    # a probe thread is running
+        self.trial = False      # a half-open trial request is in flight
+
+
+class EndpointHealth:
+    """Per-host circuit breaker for completion requests.
+
+    Closed while requests succeed. `failure_threshold` outage errors in a
+    row open it: `allow()` turns False, so callers can fail at once instead
+    of waiting out a connect timeout, and a background thread probes the
+    host with `test_endpoint_connectivity`, backing off while it stays
+    down. A successful probe half-opens the breaker and `acquire()` lets a
+    single trial request through, failing the others at once until the
+    trial closes the breaker again or reopens it.
+
+    *on_change(url, state)* is called, from whichever thread caused it,
+    whenever a breaker opens or closes.
+    """
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, probe_interval_s=BREAKER_PROBE_INTERVAL_S,
+                 max_probe_interval_s=BREAKER_MAX_PROBE_INTERVAL_S, probe=None, on_change=None):
+        self.failure_threshold = failure_threshold
+        self.probe_interval_s = probe_interval_s
+        self.max_probe_interval_s = max_probe_interval_s
+        self.probe = probe or (lambda url: test_endpoint_connectivity(url)[0])
+        self.on_change = on_change
+        self._breakers = {}  # (scheme, host, port) -> _Breaker
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def state(self, url):
+        with self._lock:
+            breaker = self._breakers.get(_host_key(url))
+            return breaker.state if breaker else BREAKER_CLOSED
+
+    def allow(self, url):
+        """False while *url*'s host is known to be down or being trialled."""
+        with self._lock:
+            breaker = self._breakers.get(_host_key(url))
+            return breaker is None or not (breaker.state == BREAKER_OPEN or breaker.trial)
+
+    def acquire(self, url):
+        """Like `allow`, but a half-open breaker's True claims its one trial.
+
+        The claim is given back by `note_success`, `note_failure` or, when
+        the request ended without saying anything about the host, `release`.
+        """
+        with self._lock:
+            breaker = self._breakers.get(_host_key(url))
+            if breaker is None or breaker.state == BREAKER_CLOSED:
+                return True
+            if breaker.state == BREAKER_OPEN or breaker.trial:
+                return False
+            breaker.trial = True
+            return True
+
+    def release(self, url):
+        """Give back a trial claimed by `acquire` without deciding it."""
+        with self._lock:
+            breaker = self._breakers.get(_host_key(url))
+            if breaker is not None:
+                breaker.trial = False
+
+    def note_success(self, url):
+        with self._lock:
+            breaker = self._breakers.get(_host_key(url))
+            if breaker is None:
+                return
+            recovered = breaker.state != BREAKER_CLOSED
+            breaker.state = BREAKER_CLOSED
+            breaker.failures = 0
+            breaker.trial = False
+        if recovered:
+            self._changed(url, BREAKER_CLOSED)
+
+    def note_failure(self, url):
+        key = _host_key(url)
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = self._breakers[key] = _Breaker(url)
+            breaker.url = url
+            breaker.failures += 1
+            breaker.trial = False
+            if breaker.state == BREAKER_OPEN:
+                return
+            if breaker.state == BREAKER_CLOSED and breaker.failures < self.failure_threshold:
+                return
+            breaker.state = BREAKER_OPEN
+            start_probe = not breaker.probing
+            breaker.probing = True
+            generation = self._generation
+        if start_probe:
+            threading.Thread(target=self._probe_loop, args=(key, generation), daemon=True).start()
+        self._changed(url, BREAKER_OPEN)
+
+    def probe_once(self, key):
+        """Probe an open breaker's host once; half-open it if reachable."""
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None or breaker.state != BREAKER_OPEN:
+                return True
+            url = breaker.url
+        if not self.probe(url):
+            return False
+        with self._lock:
+            if breaker.state == BREAKER_OPEN:
+                breaker.state = BREAKER_HALF_OPEN
+        return True
+
+    def _probe_loop(self, key, generation):
+        interval = self.probe_interval_s
+        try:
+            while True:
+                time.sleep(interval)
+                if self._generation != generation or self.probe_once(key):
+                    return
+                interval = min(self.max_probe_interval_s, interval * 2)
+        finally:
+            with self._lock:
+                breaker = self._breakers.get(key)
+                if breaker is not None and self._generation == generation:
+                    breaker.probing = False
+
+    def _changed(self, url, state):
+        if self.on_change is not None:
+            self.on_change(url, state)
+
+    def reset(self):
+        """Forget every breaker (e.g. after the endpoint setting changed)."""
+        with self._lock:
+            self._breakers.clear()
+            self._generation += 1
+
+
+endpoint_health = EndpointHealth()
+
+
+class SlotAffinity:
+    """Pins views to a server's KV-cache slots (llama.cpp `id_slot`).
+
+    A server only reuses its cache when the next prompt lands on the slot
+    that processed the previous one, so each view keeps its slot for as
+    long as possible; when there are more views than slots, the least
+    recently used view gives its slot up. Thread-safe.
+    """
+
+    def __init__(self, slots=4):
+        self.slots = max(1, slots)
+        self._owners = collections.OrderedDict()  # view key -> slot, least recently used first
+        self._lock = threading.Lock()
+
+    def resize(self, slots):
+        with self._lock:
+            self.slots = max(1, slots)
+            for key in [k for k, slot in self._owners.items() if slot >= self.slots]:
+                del self._owners[key]
+
+    def slot(self, key):
+        """The slot for *key*, taking the least recently used one if it has none."""
+        with self._lock:
+            slot = self._owners.pop(key, None)
+            if slot is None:
+                if len(self._owners) >= self.slots:
+                    _key, slot = self._owners.popitem(last=False)
+                else:
+                    used = set(self._owners.values())
+                    slot = next(i for i in range(self.slots) if i not in used)
+            self._owners[key] = slot
+            return slot
+
+    def forget(self, key):
+        with self._lock:
+            self._owners.pop(key, None)
+
+
+def open_url(url, data=None, headers=None, timeout_s=30.0, cancel=None, health=True):
+    """Send a request over a pooled keep-alive connection.
+
+    Drop-in replacement for `urllib.request.urlopen` as used by the suggest,
+    chat and edit flows: returns a context-manager response, raises
+    `urllib.error.HTTPError` for HTTP status >= 400 and `urllib.error.URLError`
+    for transport failures. Pass a `CancelToken` as *cancel* to make the
+    request abortable from another thread; a request cancelled before the
+    response arrives raises `RequestCancelled`. Requests that must go through
+    an environment proxy fall back to plain `urlopen` (cancellable only once
+    the response has started).
+
+    Outcomes feed `endpoint_health`: while the host's breaker is open, or
+    half-open with its trial request already in flight, this raises
+    `EndpointUnavailable` without touching the network. Side traffic to the
+    completion host (embeddings) passes health=False: it neither consults
+    nor trips the breaker, so a slow or missing route there cannot pause
+    suggestions.
+    """
+    if not health:
+        return _open(url, data, headers, timeout_s, cancel)
+    if not endpoint_health.acquire(url):
+        raise EndpointUnavailable("{0} is unreachable (retrying in the background)".format(host_label(url)))
+    try:
+        response = _open(url, data, headers, timeout_s, cancel)
+    except Exception as e:
+        if is_outage_error(e):
+            endpoint_health.note_failure(url)
+        elif isinstance(e, urllib.error.HTTPError):
+            endpoint_health.note_success(url)  # the server answered
+        else:
+            endpoint_health.release(url)  # e.g. cancelled: no verdict
+        raise
+    endpoint_health.note_success(url)
+    return response
+
+
+def _open(url, data, headers, timeout_s, cancel):
+    if _uses_proxy(url):
+        req = urllib.request.Request(url, data=data, headers=headers or {})
+        response = urllib.request.urlopen(req, timeout=timeout_s)
+        if cancel is not None:
+            try:
+                cancel.attach(response.close)
+            except RequestCancelled:
+                response.close()
+                raise
+        return response
+    return _pool.request(url, data=data, headers=headers, timeout_s=timeout_s, cancel=cancel)
+
+
+def iter_stream_text(response, provider, others=None):
+    """Yield text deltas from a completion response as they arrive.
+
+    Understands Server-Sent Events (OpenAI, Anthropic, LM Studio, vLLM,
+    llama.cpp) and newline-delimited JSON (Ollama). If the server ignored
+    `stream: true` and answered with a plain JSON body, the whole parsed
+    reply is yielded once.
+
+    With an `n` > 1 request, pass a dict as *others*: only the first
+    choice is yielded, and the text of the other choices is collected in
+    *others* (choice index -> text) by the time the stream ends.
+
+    Token counts the server reports (see `parse_usage`) are left on
+    `response.usage` once the stream ends.
+    """
+    multi = others is not None and hasattr(provider, "parse_stream_choices")
+    content_type = (response.headers.get("Content-Type") or "").lower()
+    if "text/event-stream" not in content_type and "ndjson" not in content_type:
+        result = json.loads(response.read().decode())
+        response.usage = parse_usage(result)
+        if not multi:
+            yield provider.parse_response(result)
+            return
+        candidates = provider.parse_candidates(result)
+        others.update(enumerate(candidates[1:], 1))
+        yield candidates[0]
+        return
+
+    data_lines = []
+    usage = None
+    while True:
+        raw = response.readline()
+        if raw:
+            line = raw.decode("utf-8", "replace").rstrip("\r\n")
+            if line.startswith("data:"):
+                data_lines.append(line[5:].lstrip())
+                continue
+            if line.startswith(("event:", "id:", "retry:", ":")):
+                continue
+            if line:
+                # NDJSON: every non-empty line is a complete event.
+                payload = line
+            elif data_lines:
+                payload = "\n".join(data_lines)
+                data_lines = []
+            else:
+                continue
+        elif data_lines:
+            # Stream closed without the blank line that terminates an SSE event.
+            payload = "\n".join(data_lines)
+            data_lines = []
+        else:
+            break
+
+        if payload == "[DONE]":
+            break
+        event = json.loads(payload)
+        if "usage" in event or "timings" in event or event.get("type") == "message_start":
+            counts = parse_usage(event)
+            if counts:
+                usage = dict(usage or (), **counts)
+                response.usage = usage
+        if multi:
+            delta = ""
+            for index, text in provider.parse_stream_choices(event):
+                if index == 0:
+                    delta += text
+                elif text:
+                    others[index] = others.get(index, "") + text
+        else:
+            delta = provider.parse_stream_event(event)
+        if delta:
+            yield delta
+        if event.get("done") is True or event.get("stop") is True or event.get("type") == "message_stop":
+            break
+
+    # Drain the chunked-encoding trailer so the connection can go back to the pool.
+    response.read()
+
+
+def close_idle_connections():
+    """Close all idle pooled connections (called when the plugin unloads)."""
+    _pool.close_all()
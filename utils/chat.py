@@ -1,15 +1,21 @@
-"""Chat-about-selection feature: opens a split-pane Markdown chat view."""
+"""Chat-about-selection feature: opens a split-pane Markdown chat view.
+
+Replies are streamed into the view as they are generated; the Stop Generating
+command closes the connection of the reply in flight.
+"""
 
 import json
 import threading
 import urllib.error
-import urllib.request
 
 import sublime
 import sublime_plugin
 
-from .api import get_provider
+from .api import CancelToken, format_usage, get_provider, iter_stream_text, open_url
+from .embeddings import SNIPPETS_TITLE, embedding_index, semantic_snippets
 from .log import _log
+from .metrics import RequestTimer
+from .retrieval import format_snippets
 from .text_utils import describe_code_selection
 
 
@@ -32,9 +38,12 @@ class ChatState:
         "file_name",
         "requesting",
         "provider",
+        "stream",
+        "cancel_token",
+        "related",
     )
 
-    def __init__(self, history, endpoint, model, timeout_s, headers, code, lang, file_name, provider):
+    def __init__(self, history, endpoint, model, timeout_s, headers, code, lang, file_name, provider, stream=True):
         self.history = history
         self.endpoint = endpoint
         self.model = model
@@ -45,6 +54,9 @@ class ChatState:
         self.file_name = file_name
         self.requesting = False  # True while an API call is in-flight
         self.provider = provider
+        self.stream = stream
+        self.cancel_token = None  # CancelToken of the reply in flight
+        self.related = ""  # project chunks near the selection, for the first message
 
 
 # chat_view.id() -> ChatState
@@ -70,6 +82,11 @@ CHAT_SYSTEM_PROMPT = (
 )
 
 INPUT_SEPARATOR = "\n---\n\n### 👤 You *(press Enter to send)*\n\n> "
+REPLY_HEADER = "\n---\n\n### 🤖 CodeContinue\n\n"
+
+# Streamed reply text is buffered and appended to the chat view at most once
+# per interval instead of once per token.
+CHAT_FLUSH_INTERVAL_MS = 60
 
 
 def _chat_view_append(chat_view, text):
@@ -141,8 +158,45 @@ def _chat_remove_thinking(chat_view):
             chat_view.set_read_only(True)
 
 
+class _ChatReplyWriter:
+    """Coalesces streamed reply chunks into timed appends on the UI thread.
+
+    The worker thread calls `push()` per chunk; the first push in a quiet
+    period schedules a single `flush()` CHAT_FLUSH_INTERVAL_MS later, which
+    appends everything collected so far.
+    """
+
+    def __init__(self, chat_view):
+        self.chat_view = chat_view
+        self.started = False
+        self._chunks = []
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    def push(self, text):
+        with self._lock:
+            self._chunks.append(text)
+            if self._scheduled:
+                return
+            self._scheduled = True
+        sublime.set_timeout(self.flush, CHAT_FLUSH_INTERVAL_MS)
+
+    def flush(self):
+        with self._lock:
+            text = "".join(self._chunks)
+            self._chunks = []
+            self._scheduled = False
+        if self.chat_view.id() not in _states or not text:
+            return
+        if not self.started:
+            self.started = True
+            _chat_remove_thinking(self.chat_view)
+            _chat_view_append(self.chat_view, REPLY_HEADER)
+        _chat_view_append(self.chat_view, text)
+
+
 def _chat_do_api_call(chat_view, state):
-    """Send conversation history to LLM and render the response in the chat view."""
+    """Send conversation history to LLM and stream the response into the chat view."""
     cvid = chat_view.id()
 
     if not state.endpoint or not state.model:
@@ -150,69 +204,114 @@ def _chat_do_api_call(chat_view, state):
         state.requesting = False
         return
 
-    data = state.provider.format_payload(state.model, state.history, 2048, 0.5)
+    data = state.provider.format_payload(state.model, state.history, 2048, 0.5, stream=state.stream)
+
+    _log("Chat: Sending request to {0} (stream: {1})", state.endpoint, state.stream)
 
-    _log("Chat: Sending request to {0}".format(state.endpoint))
+    writer = _ChatReplyWriter(chat_view)
+    token = CancelToken()
+    state.cancel_token = token
+    timer = RequestTimer("chat", state.endpoint, state.model)
+
+    def finish(reply, notice=""):
+        """Flush the last chunks, record the reply and reopen the input area.
+
+        Only a complete reply (no *notice*) is recorded in the stage stats.
+        """
+        if reply:
+            state.history.append({"role": "assistant", "content": reply})
+
+        def show_end():
+            if cvid not in _states:
+                return
+            writer.flush()
+            if not writer.started:
+                _chat_remove_thinking(chat_view)
+            if writer.started:
+                _chat_view_append(chat_view, "\n")
+            if notice:
+                _chat_view_append(chat_view, notice)
+            _chat_show_input_area(chat_view)
+            state.requesting = False
+            if reply and not notice:
+                timer.lap("render")
+                timer.finish()
+
+        sublime.set_timeout(show_end, 0)
 
     def do_request():
+        parts = []
+        timer.lap("dispatch")
         try:
-            req = urllib.request.Request(
-                state.endpoint,
-                data=json.dumps(data).encode(),
-                headers=state.headers,
-            )
-            with urllib.request.urlopen(req, timeout=state.timeout_s) as response:
-                result = json.loads(response.read().decode())
-                reply = state.provider.parse_response(result)
-
-                if reply:
-                    state.history.append({"role": "assistant", "content": reply})
-
-                    def show_reply():
-                        if cvid not in _states:
-                            return
-                        _chat_remove_thinking(chat_view)
-                        _chat_view_append(chat_view, "\n---\n\n### 🤖 CodeContinue\n\n" + reply + "\n")
-                        _chat_show_input_area(chat_view)
-                        state.requesting = False
-
-                    sublime.set_timeout(show_reply, 0)
-                else:
-                    def show_empty():
-                        if cvid not in _states:
-                            return
-                        _chat_remove_thinking(chat_view)
-                        _chat_view_append(chat_view, "\n⚠ Empty response from model.\n")
-                        _chat_show_input_area(chat_view)
-                        state.requesting = False
-                    sublime.set_timeout(show_empty, 0)
+            body = json.dumps(data).encode()
+            timer.lap("serialize")
+            with open_url(state.endpoint, body, state.headers, state.timeout_s, cancel=token) as response:
+                timer.lap_response(response)
+                for delta in iter_stream_text(response, state.provider):
+                    parts.append(delta)
+                    writer.push(delta)
+                    if token.cancelled:
+                        break
+            timer.lap("download")
+            usage = getattr(response, "usage", None)
+            if usage:
+                _log("Chat: Usage: {0}", format_usage(usage))
+
+            reply = "".join(parts).strip()
+            if token.cancelled:
+                _log("Chat: Generation stopped by user")
+                finish(reply, "\n⏹ *Stopped.*\n")
+            elif reply:
+                finish(reply)
+            else:
+                finish("", "\n⚠ Empty response from model.\n")
 
         except urllib.error.URLError as e:
-            _log("Chat: Network error: {0}".format(str(e)[:100]))
-            def show_net_err():
-                if cvid not in _states:
-                    return
-                _chat_remove_thinking(chat_view)
-                _chat_view_append(chat_view, "\n⚠ Network error: {0}\n".format(str(e)[:100]))
-                _chat_show_input_area(chat_view)
-                state.requesting = False
-            sublime.set_timeout(show_net_err, 0)
+            if token.cancelled:
+                _log("Chat: Generation stopped by user")
+                finish("".join(parts).strip(), "\n⏹ *Stopped.*\n")
+                return
+            _log("Chat: Network error: {0}", str(e)[:100])
+            finish("", "\n⚠ Network error: {0}\n".format(str(e)[:100]))
         except Exception as e:
-            _log("Chat: Error: {0}".format(str(e)[:100]))
-            def show_gen_err():
-                if cvid not in _states:
-                    return
-                _chat_remove_thinking(chat_view)
-                _chat_view_append(chat_view, "\n⚠ Error: {0}\n".format(str(e)[:100]))
-                _chat_show_input_area(chat_view)
-                state.requesting = False
-            sublime.set_timeout(show_gen_err, 0)
+            if token.cancelled:
+                _log("Chat: Generation stopped by user")
+                finish("".join(parts).strip(), "\n⏹ *Stopped.*\n")
+                return
+            _log("Chat: Error: {0}", str(e)[:100])
+            finish("", "\n⚠ Error: {0}\n".format(str(e)[:100]))
+        finally:
+            state.cancel_token = None
 
     thread = threading.Thread(target=do_request)
     thread.daemon = True
     thread.start()
 
 
+def _chat_stop(state):
+    """Ask an in-flight reply to stop; returns True if one was running."""
+    if not state or not state.requesting:
+        return False
+    token = state.cancel_token
+    if token is not None:
+        token.cancel("stopped")
+    return True
+
+
+def _chat_find_related(state, index, budget, exclude):
+    """Look up project chunks near the selection while the user types the first message."""
+    def run():
+        try:
+            snippets = semantic_snippets(index, state.code, budget, exclude)
+        except (OSError, ValueError, KeyError) as e:
+            _log("Chat: Semantic retrieval failed: {0}", e)
+            return
+        state.related = format_snippets(snippets, title=SNIPPETS_TITLE)
+        _log("Chat: {0} related chunks from {1}", len(snippets), index)
+
+    threading.Thread(target=run, name="CodeContinue chat retrieval", daemon=True).start()
+
+
 def _chat_send_message(chat_view):
     """Extract user input, format it, and send to LLM."""
     cvid = chat_view.id()
@@ -230,10 +329,11 @@ def _chat_send_message(chat_view):
     # First user message includes selected code context
     if len(state.history) <= 1:
         content = (
+            "{4}"
             "Here is the selected code from `{0}` ({1}):\n\n"
             "```{1}\n{2}\n```\n\n"
             "{3}"
-        ).format(state.file_name, state.lang, state.code, user_text)
+        ).format(state.file_name, state.lang, state.code, user_text, state.related + "\n" if state.related else "")
     else:
         content = user_text
 
@@ -264,7 +364,7 @@ class ChatEventListener(sublime_plugin.EventListener):
         if vid not in _states:
             return
 
-        _states.pop(vid, None)
+        _chat_stop(_states.pop(vid, None))
 
         window = sublime.active_window()
         if window and window.id() in _original_layouts:
@@ -339,9 +439,16 @@ class CodeContinueChatCommand(sublime_plugin.TextCommand):
             lang=lang,
             file_name=base_name,
             provider=provider,
+            stream=settings.get("stream", True),
         )
         _states[cvid] = state
 
+        index = embedding_index(window, settings, sublime.cache_path())
+        budget = settings.get("embedding_context_tokens", 384)
+        if index is not None and budget > 0:
+            first, last = view.rowcol(view.sel()[0].begin())[0], view.rowcol(view.sel()[-1].end())[0]
+            _chat_find_related(state, index, budget, (view.file_name(), first, last))
+
         description = describe_code_selection(selected_text, lang)
         greeting = "Hi, I see you have selected {0}; how can I help?".format(description)
 
@@ -369,3 +476,29 @@ class CodeContinueChatCommand(sublime_plugin.TextCommand):
                 return True
         return False
 
+
+
+class CodeContinueStopGeneratingCommand(sublime_plugin.WindowCommand):
+    """Stop the chat reply that is currently being generated.
+
+    Closes the HTTP connection so the server stops generating; the partial
+    reply stays in the chat and in the conversation history.
+    """
+
+    def _target(self):
+        view = self.window.active_view()
+        if view is not None and view.id() in _states:
+            return _states[view.id()]
+        for view in self.window.views():
+            state = _states.get(view.id())
+            if state and state.requesting:
+                return state
+        return None
+
+    def run(self):
+        if not _chat_stop(self._target()):
+            sublime.status_message("CodeContinue: Nothing is being generated")
+
+    def is_enabled(self):
+        state = self._target()
+        return bool(state and state.requesting)
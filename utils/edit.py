@@ -1,19 +1,113 @@
-"""Inline edit / refactor feature: Prompts for instruction and replaces selection."""
+"""Inline edit / refactor feature: Prompts for instruction and replaces selection.
 
+The rewrite streams into a block phantom below the selection while the model
+is generating. The selection is anchored with `view.add_regions` so it tracks
+buffer edits, and the finished rewrite replaces it in a single undoable step.
+`CodeContinue: Cancel Edit` drops the connection and discards the preview.
+"""
+
+import html
 import json
 import threading
 import urllib.error
-import urllib.request
 
 import sublime
 import sublime_plugin
 
-from .api import get_provider
+from .api import CancelToken, format_usage, get_provider, iter_stream_text, open_url
 from .log import _log, _log_error
+from .metrics import RequestTimer
 from .text_utils import clean_markdown_fences
 from .settings import is_endpoint_configured, show_endpoint_config_panel
 
 
+EDIT_REGION_KEY = "code_continue_edit"
+
+# Streamed rewrite text is re-rendered into the preview at most once per interval.
+EDIT_PREVIEW_INTERVAL_MS = 80
+
+
+class EditState:
+    """Per-view state for a streaming edit.
+
+    Accessed via the module-level ``_states`` dict, keyed on ``view.id()``.
+    """
+
+    __slots__ = (
+        "phantom_set",
+        "cancel_token",
+        "text",
+        "render_scheduled",
+        "lock",
+    )
+
+    def __init__(self, phantom_set):
+        self.phantom_set = phantom_set  # sublime.PhantomSet holding the preview
+        self.cancel_token = CancelToken()
+        self.text = ""                  # rewrite received so far
+        self.render_scheduled = False   # a preview refresh is already queued
+        self.lock = threading.Lock()
+
+
+# view.id() -> EditState
+_states = {}
+
+
+def _preview_html(text):
+    body = html.escape(text).replace(" ", "&nbsp;").replace("\n", "<br>")
+    return (
+        '<div style="border-left: 2px solid color(var(--bluish) alpha(0.7)); '
+        'padding-left: 0.5rem; color: color(var(--foreground) alpha(0.75))">{0}</div>'
+    ).format(body or "…")
+
+
+def _render_preview(view, state):
+    """Redraw the preview phantom below the anchored selection (UI thread)."""
+    with state.lock:
+        state.render_scheduled = False
+        text = state.text
+    if _states.get(view.id()) is not state:
+        return
+    regions = view.get_regions(EDIT_REGION_KEY)
+    if not regions:
+        return
+    end = regions[-1].end()
+    state.phantom_set.update([sublime.Phantom(
+        sublime.Region(end, end),
+        _preview_html(clean_markdown_fences(text) or text.strip()),
+        sublime.LAYOUT_BLOCK,
+    )])
+
+
+def _selection_survives(view):
+    """True unless the anchored selection was deleted.
+
+    `get_regions` keeps regions whose text is gone, collapsed to a point,
+    so an emptied list is not the signal; empty regions are.
+    """
+    return any(not region.empty() for region in view.get_regions(EDIT_REGION_KEY))
+
+
+def _end_edit(view, state):
+    """Remove the preview and the anchored regions if *state* is still current."""
+    if _states.get(view.id()) is not state:
+        return
+    _states.pop(view.id(), None)
+    state.phantom_set.update([])
+    view.erase_regions(EDIT_REGION_KEY)
+    view.settings().erase("code_continue_edit_active")
+
+
+def _cancel_edit(view):
+    """Abort the streaming edit in *view*; returns True if one was running."""
+    state = _states.get(view.id())
+    if not state:
+        return False
+    state.cancel_token.cancel("cancelled")
+    _end_edit(view, state)
+    return True
+
+
 class CodeContinueEditCommand(sublime_plugin.TextCommand):
     """Prompt for instruction and rewrite selected code inline."""
 
@@ -27,6 +121,7 @@ class CodeContinueEditCommand(sublime_plugin.TextCommand):
         endpoint = settings.get("endpoint", "")
         model = settings.get("model", "")
         timeout_ms = settings.get("timeout_ms", 30000) / 1000.0
+        stream = settings.get("stream", True)
 
         if not is_endpoint_configured(settings):
             sublime.status_message("CodeContinue: Endpoint not configured.")
@@ -51,9 +146,46 @@ class CodeContinueEditCommand(sublime_plugin.TextCommand):
             if not instruction:
                 return
 
-            sublime.status_message("CodeContinue: Editing...")
+            _cancel_edit(view)
+            regions = [r for r in view.sel() if not r.empty()]
+            if not regions:
+                sublime.status_message("CodeContinue: No text selected for editing")
+                return
+            view.add_regions(EDIT_REGION_KEY, regions, "region.bluish", "", sublime.DRAW_NO_FILL)
+            view.settings().set("code_continue_edit_active", True)
+            state = EditState(sublime.PhantomSet(view, EDIT_REGION_KEY))
+            _states[view.id()] = state
+            _render_preview(view, state)
+
+            sublime.status_message("CodeContinue: Editing... (run 'CodeContinue: Cancel Edit' to abort)")
+
+            def schedule_preview():
+                with state.lock:
+                    if state.render_scheduled:
+                        return
+                    state.render_scheduled = True
+                sublime.set_timeout(lambda: _render_preview(view, state), EDIT_PREVIEW_INTERVAL_MS)
+
+            timer = RequestTimer("edit", endpoint, model)
+
+            def apply_reply(reply):
+                if _states.get(view.id()) is not state:
+                    return
+                if _selection_survives(view):
+                    view.run_command("code_continue_replace_selection", {"text": reply, "region_key": EDIT_REGION_KEY})
+                    sublime.status_message("CodeContinue: Edit applied")
+                    timer.lap("render")
+                    timer.finish()
+                else:
+                    sublime.status_message("CodeContinue: Edit discarded; the selection was deleted")
+                _end_edit(view, state)
+
+            def fail(msg):
+                sublime.status_message(msg)
+                _end_edit(view, state)
 
             def do_api_call():
+                timer.lap("dispatch")
                 prompt = (
                     "Rewrite the following code based on this instruction: {0}\n\n"
                     "Code:\n{1}"
@@ -63,34 +195,50 @@ class CodeContinueEditCommand(sublime_plugin.TextCommand):
                     {"role": "system", "content": "You are a code refactoring expert. Output ONLY the rewritten code without any markdown formatting, backticks, explanations, comments, or inline comments (unless requested by the user). Write clean code."},
                     {"role": "user", "content": prompt}
                 ]
-                
+
                 provider = get_provider(endpoint, settings)
-                data = provider.format_payload(model, messages, 2048, 0.3)
+                data = provider.format_payload(model, messages, 2048, 0.3, stream=stream)
+                token = state.cancel_token
 
-                _log("Edit: Sending request to {0}".format(endpoint))
+                _log("Edit: Sending request to {0} (stream: {1})", endpoint, stream)
                 try:
-                    req = urllib.request.Request(
-                        endpoint,
-                        data=json.dumps(data).encode(),
-                        headers=provider.build_headers(settings),
-                    )
-                    with urllib.request.urlopen(req, timeout=timeout_ms) as response:
-                        result = json.loads(response.read().decode())
-                        reply = provider.parse_response(result)
-
-                        if reply:
-                            reply = clean_markdown_fences(reply)
-                            sublime.set_timeout(lambda: view.run_command("code_continue_replace_selection", {"text": reply}), 0)
-                            sublime.set_timeout(lambda: sublime.status_message("CodeContinue: Edit applied"), 0)
-                        else:
-                            sublime.set_timeout(lambda: sublime.status_message("CodeContinue: Empty response from model"), 0)
+                    body = json.dumps(data).encode()
+                    timer.lap("serialize")
+                    with open_url(endpoint, body, provider.build_headers(settings), timeout_ms, cancel=token) as response:
+                        timer.lap_response(response)
+                        for delta in iter_stream_text(response, provider):
+                            if token.cancelled:
+                                break
+                            with state.lock:
+                                state.text += delta
+                            schedule_preview()
+                    timer.lap("download")
+                    usage = getattr(response, "usage", None)
+                    if usage:
+                        _log("Edit: Usage: {0}", format_usage(usage))
+
+                    if token.cancelled:
+                        _log("Edit: Cancelled by user")
+                        return
+                    reply = clean_markdown_fences(state.text)
+                    timer.lap("sanitize")
+                    if reply:
+                        sublime.set_timeout(lambda: apply_reply(reply), 0)
+                    else:
+                        sublime.set_timeout(lambda: fail("CodeContinue: Empty response from model"), 0)
 
                 except urllib.error.URLError as e:
-                    _log_error("Edit: Network error: {0}".format(str(e)[:200]))
-                    sublime.set_timeout(lambda: sublime.status_message("CodeContinue: Network error - {0}".format(str(e)[:50])), 0)
+                    if token.cancelled:
+                        _log("Edit: Cancelled by user")
+                        return
+                    _log_error("Edit: Network error: {0}", str(e)[:200])
+                    sublime.set_timeout(lambda: fail("CodeContinue: Network error - {0}".format(str(e)[:50])), 0)
                 except Exception as e:
-                    _log_error("Edit: Error: {0}".format(str(e)[:200]))
-                    sublime.set_timeout(lambda: sublime.status_message("CodeContinue: Error - {0}".format(str(e)[:50])), 0)
+                    if token.cancelled:
+                        _log("Edit: Cancelled by user")
+                        return
+                    _log_error("Edit: Error: {0}", str(e)[:200])
+                    sublime.set_timeout(lambda: fail("CodeContinue: Error - {0}".format(str(e)[:50])), 0)
 
             threading.Thread(target=do_api_call, daemon=True).start()
 
@@ -103,14 +251,36 @@ class CodeContinueEditCommand(sublime_plugin.TextCommand):
         return False
 
 
+class CodeContinueCancelEditCommand(sublime_plugin.TextCommand):
+    """Abort the streaming edit in this view and discard its preview."""
+
+    def run(self, edit):
+        if _cancel_edit(self.view):
+            sublime.status_message("CodeContinue: Edit cancelled")
+
+    def is_enabled(self):
+        return self.view.id() in _states
+
+
+class EditEventListener(sublime_plugin.EventListener):
+    """Abort a streaming edit when its view is closed."""
+
+    def on_close(self, view):
+        _cancel_edit(view)
+
+
 class CodeContinueReplaceSelectionCommand(sublime_plugin.TextCommand):
-    """Helper command to replace the selection with text."""
+    """Helper command to replace the selection (or the regions stored under
+    *region_key*) with text."""
 
-    def run(self, edit, text=""):
+    def run(self, edit, text="", region_key=""):
         if not text:
             return
 
-        regions = list(self.view.sel())
+        if region_key:
+            regions = self.view.get_regions(region_key)
+        else:
+            regions = list(self.view.sel())
         regions.reverse()
         for region in regions:
             if not region.empty():
@@ -0,0 +1,559 @@
+"""Optional semantic retrieval: project chunks embedded through `/v1/embeddings`.
+
+Lexical matching (retrieval.py) misses code that is related but spelled
+differently. An `EmbeddingIndex` splits the project's source files into
+chunks (the same boundaries as the BM25 index), embeds them through the
+configured endpoint, and keeps the vectors in a `VectorStore`: unit-length
+float32 rows in a flat file, memory-mapped for search. Queries embed the
+code around the cursor (or the chat selection) and return the nearest
+chunks.
+
+Chunks are keyed on a hash of their content, so a rescan only embeds
+chunks whose text changed, in batches sent concurrently. Below
+IVF_MIN_ROWS vectors search is brute force; above it an inverted-file
+index (vectors grouped under sampled centroids) narrows a query to the
+nearest lists, and at most MAX_SCAN_ROWS of their members are scored.
+Dot products are pure Python, so that cap is what bounds query time on
+big projects, at the cost of recall past it.
+
+`embedding_index` keeps one index per project and embeddings setup, shared
+by inline suggestions and chat. No Sublime imports: callers pass the cache
+directory and set `on_refresh` to hear about background refreshes.
+"""
+
+import array
+import concurrent.futures
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import mmap
+import operator
+import os
+import random
+import threading
+import time
+
+from .api import OpenAIProvider, get_embeddings_endpoint, open_url
+from .retrieval import TOP_K, split_chunks
+from .symbols import MAX_FILE_BYTES, MAX_FILES, relative_path, source_files
+from .text_utils import estimate_tokens
+
+
+INDEX_VERSION = 1
+
+# Inputs per /v1/embeddings request, and requests in flight at once. Kept
+# below api.POOL_MAX_PER_HOST so a re-embed against the completion host
+# leaves pooled connections free for suggestions and chat.
+EMBED_BATCH_SIZE = 32
+EMBED_CONCURRENCY = 2
+
+# Longest chunk text sent for embedding.
+MAX_CHUNK_CHARS = 2000
+MAX_CHUNKS = 50000
+
+# Vectors from which search goes through the IVF lists; a query scores the
+# centroids and then the members of the nearest IVF_PROBE_SHARE of lists.
+IVF_MIN_ROWS = 1024
+IVF_PROBE_SHARE = 0.1
+IVF_MIN_PROBES = 4
+
+# Most vectors a query scores; members of the probed lists past it, taken
+# nearest list first, are skipped.
+MAX_SCAN_ROWS = 2048
+
+# The file is rewritten without dead rows once they outnumber live ones.
+COMPACT_DEAD_SHARE = 0.5
+
+# Heading of the prompt block (`retrieval.format_snippets`).
+SNIPPETS_TITLE = "Related code elsewhere in the project:"
+
+_mul = operator.mul
+
+
+def embed_texts(url, model, headers, texts, timeout_s=30.0, cancel=None):
+    """Embed *texts* with one OpenAI-style `/v1/embeddings` request.
+
+    Returns one list of floats per input, in input order.
+    """
+    body = json.dumps({"model": model, "input": texts}).encode("utf-8")
+    # Outside endpoint_health: the embeddings route failing says nothing
+    # about the completion endpoint on the same host.
+    with open_url(url, body, headers, timeout_s, cancel, health=False) as response:
+        result = json.loads(response.read().decode("utf-8"))
+    data = sorted(result.get("data") or [], key=lambda item: item.get("index", 0))
+    if len(data) != len(texts):
+        raise ValueError("Expected {0} embeddings, got {1}".format(len(texts), len(data)))
+    return [item["embedding"] for item in data]
+
+
+def normalize(vector):
+    """*vector* scaled to unit length, as a float32 array."""
+    norm = math.sqrt(sum(map(_mul, vector, vector))) or 1.0
+    return array.array("f", [x / norm for x in vector])
+
+
+def chunk_hash(model, text):
+    return hashlib.sha1("{0}\x00{1}".format(model, text).encode("utf-8", "replace")).hexdigest()
+
+
+class VectorStore:
+    """Fixed-width float32 rows appended to *path* and memory-mapped for reads.
+
+    Not thread-safe on its own; `EmbeddingIndex` serialises access.
+    """
+
+    def __init__(self, path, dim=0):
+        self.path = path
+        self.dim = dim
+        self._file = None
+        self._map = None
+        self._view = None   # memoryview of _map cast to float32
+        self.rows = 0
+        self._open()
+
+    def _open(self):
+        self.close()
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        self.rows = size // (4 * self.dim) if self.dim else 0
+        if self.rows:
+            self._file = open(self.path, "rb")
+            self._map = mmap.mmap(self._file.fileno(), self.rows * 4 * self.dim, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._map).cast("f")
+
+    def close(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def append(self, vectors):
+        """Append unit-length rows; returns the index of the first one."""
+        first = self.rows
+        self.close()  # Windows cannot resize a mapped file
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "ab") as f:
+            f.truncate(first * 4 * self.dim)  # drop a partial row left by a crash
+            for vector in vectors:
+                f.write(vector.tobytes())
+        self._open()
+        return first
+
+    def row(self, index):
+        return self._view[index * self.dim:(index + 1) * self.dim]
+
+    def rewrite(self, indexes):
+        """Keep only the rows in *indexes* (in that order); returns old -> new row."""
+        data = b"".join(self.row(i).tobytes() for i in indexes)
+        self.close()
+        tmp = self.path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self.path)
+        self._open()
+        return {old: new for new, old in enumerate(indexes)}
+
+    def reset(self, dim):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.dim = dim
+        self.rows = 0
+
+
+class EmbeddingIndex:
+    """Embedded chunks of the source files under *folders*.
+
+    *directory* holds `vectors.f32` and `index.json`. *embed(texts)* returns
+    one vector per text; it is called from worker threads during a refresh.
+    Thread-safe.
+    """
+
+    def __init__(self, folders, directory, model, embed):
+        self.folders = tuple(folders)
+        self.directory = directory
+        self.model = model
+        self.embed = embed
+        self.refreshed_at = None    # time.monotonic() of the last finished refresh
+        self._store = VectorStore(os.path.join(directory, "vectors.f32"))
+        self._files = {}            # abs path -> (mtime, [(hash, first row, last row)])
+        self._rows = {}             # chunk hash -> store row
+        self._locations = {}        # store row -> (abs path, first row, last row)
+        self._ivf = None            # (centroid rows, {centroid row: [rows]}, live rows at build)
+        self._dirty = False         # changed since the last save
+        self._loaded = False
+        self._refreshing = False
+        self._again = False         # a refresh was requested while one ran
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def describe(self):
+        return "{0} chunks in {1} files{2}".format(len(self._rows), len(self._files), " (IVF)" if self._ivf else "")
+
+    __str__ = describe  # lets _log format it lazily
+
+    # -- persistence -----------------------------------------------------------
+
+    def load(self):
+        """Read the saved metadata if it matches the folders, model and vectors."""
+        self._loaded = True
+        try:
+            with open(os.path.join(self.directory, "index.json"), encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if (data.get("version") != INDEX_VERSION or data.get("model") != self.model
+                or tuple(data.get("folders", ())) != self.folders):
+            return False
+        with self._lock:
+            self._store.close()
+            self._store = VectorStore(self._store.path, data.get("dim", 0))
+            rows = data.get("rows", {})
+            if any(row >= self._store.rows for row in rows.values()):
+                return False
+            self._rows = rows
+            self._files = {path: (mtime, [tuple(c) for c in chunks]) for path, (mtime, chunks) in data["files"].items()}
+            ivf = data.get("ivf")
+            if ivf:
+                self._ivf = (ivf[0], {int(k): v for k, v in ivf[1].items()}, ivf[2])
+            self._locate()
+        return True
+
+    def save(self):
+        with self._lock:
+            self._dirty = False
+            data = {
+                "version": INDEX_VERSION,
+                "model": self.model,
+                "folders": list(self.folders),
+                "dim": self._store.dim,
+                "rows": self._rows,
+                "files": {path: [mtime, chunks] for path, (mtime, chunks) in self._files.items()},
+                "ivf": list(self._ivf) if self._ivf else None,
+            }
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, "index.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(path + ".tmp", path)
+
+    def close(self):
+        with self._lock:
+            self._store.close()
+
+    # -- refresh ---------------------------------------------------------------
+
+    def _chunk_file(self, path):
+        """[(hash, first row, last row, text)] for one file, or None if unreadable."""
+        try:
+            if os.path.getsize(path) > MAX_FILE_BYTES:
+                return []
+            with open(path, encoding="utf-8", errors="replace") as f:
+                lines = f.read().split("\n")
+        except OSError:
+            return None
+        header = relative_path(path, self.folders) + "\n"
+        chunks = []
+        for start, text in split_chunks(lines):
+            text = header + text[:MAX_CHUNK_CHARS]
+            chunks.append((chunk_hash(self.model, text), start, start + text.count("\n") - 1, text))
+        return chunks
+
+    def refresh(self):
+        """Re-chunk changed files and embed the chunks not seen before.
+
+        Returns the number of chunks embedded. Raises what *embed* raises;
+        vectors embedded before the error are kept.
+        """
+        with self._lock:
+            known = {path: entry[0] for path, entry in self._files.items()}
+            have = set(self._rows)
+        changed_files = {}
+        seen = set()
+        for count, path in enumerate(source_files(self.folders)):
+            if count == MAX_FILES:
+                break
+            seen.add(path)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            if known.get(path) != mtime:
+                chunks = self._chunk_file(path)
+                if chunks is not None:
+                    changed_files[path] = (mtime, chunks)
+
+        pending = {}
+        for _mtime, chunks in changed_files.values():
+            for digest, _first, _last, text in chunks:
+                if digest not in have and len(have) + len(pending) < MAX_CHUNKS:
+                    pending.setdefault(digest, text)
+        embedded = self._embed_pending(list(pending.items()))
+
+        with self._lock:
+            for path, (mtime, chunks) in changed_files.items():
+                # Chunks past MAX_CHUNKS stay unembedded until their file changes.
+                self._files[path] = (mtime, [
+                    (digest, first, last) for digest, first, last, _text in chunks if digest in self._rows])
+            for path in set(known) - seen:
+                self._files.pop(path, None)
+            if changed_files or len(seen) != len(known):
+                self._dirty = True
+                self._collect_garbage()
+                self._locate()
+            self.refreshed_at = time.monotonic()
+        return embedded
+
+    def _locate(self):
+        """Rebuild the row -> chunk location map (lock held)."""
+        self._locations = {
+            self._rows[digest]: (path, first, last)
+            for path, (_mtime, chunks) in self._files.items()
+            for digest, first, last in chunks
+            if digest in self._rows
+        }
+
+    def _embed_pending(self, pending):
+        """Embed (hash, text) pairs in concurrent batches, storing each batch as it lands."""
+        if not pending:
+            return 0
+        batches = [pending[i:i + EMBED_BATCH_SIZE] for i in range(0, len(pending), EMBED_BATCH_SIZE)]
+        embedded = 0
+        with concurrent.futures.ThreadPoolExecutor(EMBED_CONCURRENCY) as pool:
+            futures = {pool.submit(self.embed, [text for _digest, text in batch]): batch for batch in batches}
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    batch = futures[future]
+                    vectors = [normalize(v) for v in future.result()]
+                    with self._lock:
+                        self._add_vectors([digest for digest, _text in batch], vectors)
+                    embedded += len(batch)
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
+        return embedded
+
+    def _add_vectors(self, digests, vectors):
+        """Append vectors (lock held); a new dimension starts the store over."""
+        if vectors and len(vectors[0]) != self._store.dim:
+            self._store.reset(len(vectors[0]))
+            self._rows.clear()
+            self._files.clear()
+            self._ivf = None
+        self._dirty = True
+        first = self._store.append(vectors)
+        for offset, digest in enumerate(digests):
+            self._rows[digest] = first + offset
+        if self._ivf is not None:
+            centroids, lists, _built = self._ivf
+            for row in range(first, first + len(vectors)):
+                lists[self._nearest(centroids, self._store.row(row).tolist())].append(row)
+
+    def _collect_garbage(self):
+        """Drop rows no file uses; compact and re-cluster when needed (lock held)."""
+        live = {digest for _mtime, chunks in self._files.values() for digest, _first, _last in chunks}
+        for digest in set(self._rows) - live:
+            del self._rows[digest]
+        if self._store.rows and len(self._rows) < self._store.rows * (1 - COMPACT_DEAD_SHARE):
+            order = sorted(self._rows, key=self._rows.get)
+            moved = self._store.rewrite([self._rows[d] for d in order])
+            self._rows = {digest: moved[row] for digest, row in self._rows.items()}
+            self._ivf = None
+        if len(self._rows) < IVF_MIN_ROWS:
+            self._ivf = None
+        elif self._ivf is None or len(self._rows) > 2 * self._ivf[2]:
+            self._build_ivf()
+
+    def _build_ivf(self):
+        """Group the live rows under sqrt(n) centroids sampled from them (lock held)."""
+        rows = sorted(self._rows.values())
+        count = int(math.sqrt(len(rows)))
+        centroids = sorted(random.Random(len(rows)).sample(rows, count))
+        lists = {c: [] for c in centroids}
+        for row in rows:
+            lists[self._nearest(centroids, self._store.row(row).tolist())].append(row)
+        self._ivf = (centroids, lists, len(rows))
+
+    def _nearest(self, centroids, vector):
+        store = self._store
+        return max(centroids, key=lambda c: sum(map(_mul, vector, store.row(c))))
+
+    def refresh_async(self, min_interval_s=0.0, on_done=None):
+        """Load, refresh and save on a background thread.
+
+        While a refresh runs, another request is remembered and run after
+        it. Otherwise does nothing when the last refresh finished less than
+        *min_interval_s* ago. *on_done(embedded, seconds, error)* runs on
+        the refresh thread.
+        """
+        with self._lock:
+            if self._refreshing:
+                self._again = True
+                return
+            if self.refreshed_at is not None and time.monotonic() - self.refreshed_at < min_interval_s:
+                return
+            self._refreshing = True
+
+        def run():
+            while True:
+                start = time.monotonic()
+                embedded, error = 0, None
+                try:
+                    if not self._loaded:
+                        self.load()
+                    embedded = self.refresh()
+                except Exception as e:
+                    error = e
+                    with self._lock:
+                        self.refreshed_at = time.monotonic()  # retry after the interval
+                try:
+                    if self._dirty:
+                        self.save()
+                except OSError as e:
+                    error = error or e
+                if on_done is not None:
+                    on_done(embedded, time.monotonic() - start, error)
+                with self._lock:
+                    if not self._again or error is not None:
+                        self._refreshing = self._again = False
+                        return
+                    self._again = False
+
+        threading.Thread(target=run, name="CodeContinue embeddings", daemon=True).start()
+
+    # -- search ----------------------------------------------------------------
+
+    def search(self, vector, k, exclude=None):
+        """The *k* chunks nearest to *vector*: [(score, path, first row, last row)].
+
+        *exclude* is (path, first row, last row) of text already in the prompt.
+        """
+        query = normalize(vector).tolist()
+        with self._lock:
+            store = self._store
+            if not self._rows or len(query) != store.dim:
+                return []
+            if self._ivf is not None:
+                centroids, lists, _built = self._ivf
+                probes = max(IVF_MIN_PROBES, int(len(centroids) * IVF_PROBE_SHARE))
+                nearest = heapq.nlargest(probes, centroids, key=lambda c: sum(map(_mul, query, store.row(c))))
+                candidates = list(itertools.islice((row for c in nearest for row in lists[c]), MAX_SCAN_ROWS))
+            else:
+                candidates = list(self._rows.values())
+            scored = heapq.nlargest(k * 2, ((sum(map(_mul, query, store.row(row))), row) for row in candidates))
+            locations = self._locations
+        out = []
+        for score, row in scored:
+            location = locations.get(row)
+            if location is None:
+                continue
+            path, first, last = location
+            if exclude is not None and path == exclude[0] and first <= exclude[2] and last >= exclude[1]:
+                continue
+            out.append((score, path, first, last))
+        return out[:k]
+
+    def snippets(self, vector, budget, exclude=None, top_k=TOP_K):
+        """Nearest chunks that fit *budget* tokens: [(relpath, first row, text)].
+
+        The text is read back from the file; a chunk whose file changed
+        since it was indexed is skipped until the next refresh.
+        """
+        out = []
+        used = 0
+        for _score, path, first, last in self.search(vector, top_k * 2, exclude):
+            with self._lock:
+                mtime = self._files.get(path, (None,))[0]
+            try:
+                if os.path.getmtime(path) != mtime:
+                    continue
+                with open(path, encoding="utf-8", errors="replace") as f:
+                    text = "\n".join(f.read().split("\n")[first:last + 1]).rstrip()
+            except OSError:
+                continue
+            cost = estimate_tokens(text) + last - first + 8
+            if used + cost > budget:
+                continue
+            used += cost
+            out.append((relative_path(path, self.folders), first, text))
+            if len(out) == top_k:
+                break
+        return out
+
+
+# (folders, model, url) -> EmbeddingIndex
+_embedding_indexes = {}
+
+# Re-embed changed files at most this often (on use).
+EMBEDDING_RESCAN_INTERVAL_S = 60.0
+
+# Embedding the query holds up the request, so it gets a short timeout.
+EMBEDDING_QUERY_TIMEOUT_S = 2.0
+
+# Called as on_refresh(index, embedded, seconds, error) when a background
+# refresh started here ends (on the refresh thread).
+on_refresh = None
+
+
+def _refresh(index, min_interval_s):
+    def on_done(embedded, seconds, error):
+        if on_refresh is not None:
+            on_refresh(index, embedded, seconds, error)
+    index.refresh_async(min_interval_s, on_done)
+
+
+def embedding_index(window, settings, cache_dir):
+    """The embedding index for *window*'s project folders, or None (UI thread).
+
+    None unless `embedding_model` is set and there is an embeddings
+    endpoint (`embedding_endpoint`, or one derived from `endpoint`).
+    Created on first use under *cache_dir*; changed files are re-embedded
+    in the background when the last refresh is older than
+    EMBEDDING_RESCAN_INTERVAL_S.
+    """
+    model = settings.get("embedding_model", "")
+    folders = tuple(window.folders()) if window else ()
+    if not model or not folders:
+        return None
+    url = settings.get("embedding_endpoint", "") or get_embeddings_endpoint(settings.get("endpoint", ""))
+    if not url:
+        return None
+    key = (folders, model, url)
+    index = _embedding_indexes.get(key)
+    if index is None:
+        digest = hashlib.sha1("\n".join(key[0] + key[1:]).encode("utf-8", "replace")).hexdigest()[:16]
+        directory = os.path.join(cache_dir, "CodeContinue", "embeddings", digest)
+        index = _embedding_indexes[key] = EmbeddingIndex(folders, directory, model, None)
+    # Rebuilt on every use so a changed api_key applies to the next batch.
+    index.embed = functools.partial(embed_texts, url, model, OpenAIProvider().build_headers(settings))
+    _refresh(index, EMBEDDING_RESCAN_INTERVAL_S)
+    return index
+
+
+def refresh_embedding_indexes():
+    """Re-embed the changed files of every index in use (e.g. after a save)."""
+    for index in list(_embedding_indexes.values()):
+        if index.embed is not None:
+            _refresh(index, 0.0)
+
+
+def semantic_snippets(index, query, budget, exclude=None, cancel=None):
+    """Chunks of *index* nearest to the text *query* (worker thread).
+
+    Returns [(relpath, start_row, text)]; raises what the embeddings
+    request raises, including `RequestCancelled` once *cancel* fires.
+    """
+    if not len(index):
+        return []
+    vector = index.embed([query], timeout_s=EMBEDDING_QUERY_TIMEOUT_S, cancel=cancel)[0]
+    return index.snippets(vector, budget, exclude)
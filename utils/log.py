@@ -2,21 +2,190 @@
 
 `_log` is gated by the `debug` setting so users opt in to chatter.
 `_log_error` always prints — failures should be visible without enabling debug.
+
+Both take a `str.format` template plus arguments and only format when the
+record will actually be emitted, so a disabled `_log` costs one comparison:
+
+    _log("Parsed response: {0}", result)
+
+The level is read from the settings once and cached (settings.py refreshes
+it on change). Emitted records are printed to the console and kept in a
+bounded ring buffer that `CodeContinue: Show Log` dumps to a panel; with
+`log_file` on, a background writer also flushes them to a rotating file
+under Sublime's cache directory, off the UI and worker threads.
+`CodeContinue: Show Performance Stats` shows the stage timings collected
+by metrics.py the same way.
 """
 
+import collections
+import logging
+import logging.handlers
+import os
+import threading
 import time
 
 import sublime
+import sublime_plugin
+
+from .metrics import format_report
+
+
+DEBUG = 10
+ERROR = 40
+_LEVEL_NAMES = {DEBUG: "", ERROR: "ERROR: "}
+
+# Records kept for `CodeContinue: Show Log`.
+RING_SIZE = 1000
+
+# Rotating log file: size per file and number of old files kept.
+LOG_FILE_BYTES = 512 * 1024
+LOG_FILE_BACKUPS = 2
+
+# How often the writer wakes to flush when records trickle in.
+FLUSH_INTERVAL_S = 1.0
+
+# Minimum level emitted; 0 until the settings have been read.
+_UNCONFIGURED = 0
+_level = _UNCONFIGURED
+_log_file = False
 
+_ring = collections.deque(maxlen=RING_SIZE)
+_pending = collections.deque(maxlen=RING_SIZE)  # records not yet written to the file
+_writer = None
+_writer_lock = threading.Lock()
 
-def _log(msg):
-    settings = sublime.load_settings("CodeContinue.sublime-settings")
-    if settings.get("debug", False):
-        ts = time.strftime('%H:%M:%S')
-        print("CodeContinue [{0}] {1}".format(ts, msg))
 
+def configure_logging(settings):
+    """Cache the level and file sink from *settings* (duck-typed `.get()`)."""
+    global _level, _log_file
+    _log_file = bool(settings.get("log_file", False))
+    _level = DEBUG if settings.get("debug", False) else ERROR
 
-def _log_error(msg):
+
+def _debug_enabled():
+    """True when `_log` records are emitted; for guarding costly arguments."""
+    if _level == _UNCONFIGURED:
+        configure_logging(sublime.load_settings("CodeContinue.sublime-settings"))
+    return _level <= DEBUG
+
+
+def _emit(level, fmt, args):
+    if _level == _UNCONFIGURED:
+        configure_logging(sublime.load_settings("CodeContinue.sublime-settings"))
+    if level < _level:
+        return
+    msg = fmt.format(*args) if args else fmt
+    line = "CodeContinue [{0}] {1}{2}".format(time.strftime('%H:%M:%S'), _LEVEL_NAMES[level], msg)
+    print(line)
+    _ring.append(line)
+    if _log_file:
+        _pending.append(line)
+        writer = _ensure_writer()
+        if level >= ERROR:
+            writer.wake()
+
+
+def _log(fmt, *args):
+    if _level <= DEBUG:
+        _emit(DEBUG, fmt, args)
+
+
+def _log_error(fmt, *args):
     """Always prints, regardless of the debug setting."""
-    ts = time.strftime('%H:%M:%S')
-    print("CodeContinue [{0}] ERROR: {1}".format(ts, msg))
+    _emit(ERROR, fmt, args)
+
+
+def recent_log_lines():
+    """Snapshot of the ring buffer, oldest first."""
+    return list(_ring)
+
+
+def log_file_path():
+    return os.path.join(sublime.cache_path(), "CodeContinue", "CodeContinue.log")
+
+
+class _LogWriter(threading.Thread):
+    """Drains `_pending` into a rotating file.
+
+    Wakes every `FLUSH_INTERVAL_S` (immediately for errors) and writes
+    whatever accumulated in one batch.
+    """
+
+    def __init__(self, path):
+        super().__init__(name="CodeContinue log writer", daemon=True)
+        self.path = path
+        self._event = threading.Event()
+        self._stopped = False
+
+    def wake(self):
+        self._event.set()
+
+    def stop(self):
+        self._stopped = True
+        self._event.set()
+
+    def run(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(
+                self.path, maxBytes=LOG_FILE_BYTES, backupCount=LOG_FILE_BACKUPS, encoding="utf-8")
+        except OSError as e:
+            print("CodeContinue: log file disabled ({0})".format(e))
+            return
+        try:
+            while True:
+                self._event.wait(FLUSH_INTERVAL_S)
+                self._event.clear()
+                while _pending:
+                    handler.emit(logging.makeLogRecord({"msg": _pending.popleft()}))
+                handler.flush()
+                if self._stopped:
+                    return
+        finally:
+            handler.close()
+
+
+def _ensure_writer():
+    global _writer
+    writer = _writer
+    if writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = _LogWriter(log_file_path())
+                _writer.start()
+            writer = _writer
+    return writer
+
+
+def stop_log_writer():
+    """Flush and stop the file writer (plugin unload)."""
+    global _writer
+    with _writer_lock:
+        writer, _writer = _writer, None
+    if writer is not None:
+        writer.stop()
+        writer.join(2.0)
+
+
+def _show_output_panel(window, name, text):
+    panel = window.create_output_panel(name)
+    panel.set_read_only(False)
+    panel.run_command("append", {"characters": text})
+    panel.set_read_only(True)
+    window.run_command("show_panel", {"panel": "output." + name})
+
+
+class CodeContinueShowLogCommand(sublime_plugin.WindowCommand):
+    """Dump the recent log records into an output panel."""
+
+    def run(self):
+        lines = recent_log_lines()
+        text = "\n".join(lines) + "\n" if lines else 'No log records yet. Enable "debug" to record more.\n'
+        _show_output_panel(self.window, "code_continue_log", text)
+
+
+class CodeContinueShowPerformanceStatsCommand(sublime_plugin.WindowCommand):
+    """Show p50/p95/p99 per request stage, endpoint and model."""
+
+    def run(self):
+        _show_output_panel(self.window, "code_continue_stats", format_report())
@@ -0,0 +1,185 @@
+"""Per-stage latency instrumentation for suggest, chat and edit requests.
+
+A `RequestTimer` follows one request through its stages with
+`time.monotonic()`; `finish()` files the stage times, plus the total, into
+rolling windows keyed on (flow, endpoint, model). `format_report()` renders
+p50/p95/p99 per stage for `CodeContinue: Show Performance Stats`.
+
+Stages, in request order (a flow records the ones that apply to it):
+
+- dispatch:  trigger (Enter, command) until the worker thread starts
+- context:   reading the context window and computing the cache key
+- hedge:     waiting on the primary endpoint before a hedged request
+- serialize: building and JSON-encoding the payload
+- connect:   TCP/TLS connect (only when no pooled connection was reused)
+- ttfb:      request sent until the response headers arrive
+- download:  reading the body, or the whole stream
+- parse:     decoding the JSON reply
+- sanitize:  cleaning the completion (fences, cache insert)
+- render:    until the result is drawn on the UI thread
+
+No Sublime imports.
+"""
+
+import collections
+import math
+import threading
+import time
+
+
+STAGES = ("dispatch", "context", "hedge", "serialize", "connect", "ttfb", "download", "parse", "sanitize", "render", "total")
+
+# Samples kept per stage; percentiles describe roughly the last WINDOW requests.
+WINDOW = 512
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted, non-empty list."""
+    rank = max(1, int(math.ceil(pct / 100.0 * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+class LatencyWindow:
+    """The last `size` samples of one stage, in seconds."""
+
+    __slots__ = ("samples",)
+
+    def __init__(self, size=WINDOW):
+        self.samples = collections.deque(maxlen=size)
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def summary(self):
+        """Return (count, p50, p95, p99) in seconds, or None when empty."""
+        if not self.samples:
+            return None
+        values = sorted(self.samples)
+        return len(values), percentile(values, 50), percentile(values, 95), percentile(values, 99)
+
+
+class StageStats:
+    """Rolling stage windows keyed on (flow, endpoint, model). Thread-safe."""
+
+    def __init__(self, size=WINDOW):
+        self.size = size
+        self._windows = {}  # (flow, endpoint, model) -> {stage: LatencyWindow}
+        self._lock = threading.Lock()
+
+    def record(self, flow, endpoint, model, stages):
+        with self._lock:
+            windows = self._windows.setdefault((flow, endpoint, model), {})
+            for stage, seconds in stages.items():
+                window = windows.get(stage)
+                if window is None:
+                    window = windows[stage] = LatencyWindow(self.size)
+                window.add(seconds)
+
+    def summary(self, flow, endpoint, model, stage):
+        with self._lock:
+            window = self._windows.get((flow, endpoint, model), {}).get(stage)
+            return window.summary() if window else None
+
+    def clear(self):
+        with self._lock:
+            self._windows.clear()
+
+    def format_report(self):
+        with self._lock:
+            keys = sorted(self._windows)
+            rows = {key: {stage: w.summary() for stage, w in self._windows[key].items()} for key in keys}
+        if not keys:
+            return "No requests timed yet.\n"
+        out = []
+        for flow, endpoint, model in keys:
+            out.append("{0}  {1}  {2}".format(flow, endpoint or "-", model or "-"))
+            out.append("  {0:<10}{1:>6}{2:>10}{3:>10}{4:>10}".format("stage", "n", "p50 ms", "p95 ms", "p99 ms"))
+            stages = rows[(flow, endpoint, model)]
+            for stage in STAGES:
+                summary = stages.get(stage)
+                if summary is None:
+                    continue
+                count, p50, p95, p99 = summary
+                out.append("  {0:<10}{1:>6}{2:>10.1f}{3:>10.1f}{4:>10.1f}".format(
+                    stage, count, p50 * 1000, p95 * 1000, p99 * 1000))
+            out.append("")
+        return "\n".join(out)
+
+
+_stats = StageStats()
+
+
+def format_report():
+    return _stats.format_report()
+
+
+def stage_summary(flow, endpoint, model, stage):
+    """(count, p50, p95, p99) in seconds for one stage, or None."""
+    return _stats.summary(flow, endpoint, model, stage)
+
+
+class RequestTimer:
+    """Times the stages of one request.
+
+    `lap(stage)` charges the time since the previous lap to *stage*, so
+    calling it at the end of each stage partitions the request. Safe to
+    hand from a worker to the UI thread, but not to use from both at once.
+    """
+
+    __slots__ = ("flow", "endpoint", "model", "start", "stages", "_last", "_stats")
+
+    def __init__(self, flow, endpoint="", model="", start=None, stats=None):
+        self.flow = flow
+        self.endpoint = endpoint
+        self.model = model
+        self.start = time.monotonic() if start is None else start
+        self.stages = {}
+        self._last = self.start
+        self._stats = _stats if stats is None else stats
+
+    def lap(self, stage):
+        now = time.monotonic()
+        self.stages[stage] = self.stages.get(stage, 0.0) + (now - self._last)
+        self._last = now
+
+    def lap_response(self, response):
+        """End the request-to-headers stage, split into connect and TTFB.
+
+        Pooled responses carry `connect_s` when a new socket was opened;
+        the rest of the wait (pool checkout, request write, server think
+        time) is time to first byte.
+        """
+        now = time.monotonic()
+        elapsed = now - self._last
+        connect = getattr(response, "connect_s", None)
+        if connect:
+            self.stages["connect"] = self.stages.get("connect", 0.0) + connect
+            elapsed -= connect
+        self.stages["ttfb"] = self.stages.get("ttfb", 0.0) + max(0.0, elapsed)
+        self._last = now
+
+    def fork(self, idle_stage=None):
+        """A copy that times one of several concurrent attempts.
+
+        With *idle_stage*, the time since the last lap is charged to that
+        stage in the copy first (the copy starts its own laps from now).
+        """
+        other = RequestTimer(self.flow, self.endpoint, self.model, self.start, self._stats)
+        other.stages = dict(self.stages)
+        other._last = self._last
+        if idle_stage:
+            other.lap(idle_stage)
+        return other
+
+    def adopt(self, other):
+        """Continue from *other*, a fork whose attempt won."""
+        self.endpoint = other.endpoint
+        self.model = other.model
+        self.stages = dict(other.stages)
+        self._last = other._last
+
+    def finish(self):
+        """Record the stages and the total into the shared windows."""
+        stages = dict(self.stages)
+        stages["total"] = time.monotonic() - self.start
+        self._stats.record(self.flow, self.endpoint, self.model, stages)
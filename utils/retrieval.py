@@ -0,0 +1,262 @@
+"""BM25 snippet retrieval over the open views.
+
+Each open document is split into chunks at top-level declarations (so an
+edit only changes the chunks around it), and every chunk's terms go into an
+in-memory inverted index. `ChunkIndex.snippets` scores chunks with BM25
+against the identifiers near the cursor and returns the best few that fit a
+token cap, for the suggest prompt.
+
+Re-indexing a document replaces only the chunks whose text changed, and a
+query costs one pass over the postings of its terms, so both stay in the
+low milliseconds for a few dozen open files.
+
+No Sublime imports.
+"""
+
+import collections
+import heapq
+import keyword
+import math
+import re
+import threading
+
+from .text_utils import estimate_tokens
+
+
+# Chunks start at an unindented line once they have MIN_CHUNK_LINES lines,
+# and are cut at MAX_CHUNK_LINES regardless.
+MIN_CHUNK_LINES = 4
+MAX_CHUNK_LINES = 30
+
+# Most snippets added to one prompt.
+TOP_K = 4
+
+# BM25 term-frequency saturation and length normalisation.
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Terms in more than this share of the chunks are skipped (they barely move
+# BM25 scores), and terms in more than SCAN_SHARE only add to chunks the
+# rarer terms matched, so a query never walks every posting of a common word.
+# Below SMALL_INDEX_CHUNKS chunks every term is scored in full.
+COMMON_SHARE = 0.25
+SCAN_SHARE = 0.02
+SMALL_INDEX_CHUNKS = 256
+
+# How far around the cursor query terms are collected, in characters.
+QUERY_BEFORE_CHARS = 1000
+QUERY_AFTER_CHARS = 300
+
+_IDENTIFIER_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+_WORD_PART_RE = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+")
+
+# First characters of unindented lines that continue a chunk (closing brackets).
+_NOT_CHUNK_STARTS = frozenset(("", " ", "\t", "}", ")", "]"))
+
+_STOP_TERMS = frozenset(k.lower() for k in keyword.kwlist) | frozenset((
+    "self", "cls", "this", "super", "function", "const", "let", "var", "new",
+    "null", "undefined", "void", "int", "str", "string", "bool", "public",
+    "private", "static", "func", "struct", "impl", "pub", "mut", "get", "set",
+))
+
+
+def terms(text):
+    """Counter of index terms in *text*.
+
+    Identifiers are lowercased; snake_case and camelCase names also
+    contribute their parts, so `fetchUser` matches `fetch_user`.
+    """
+    counts = collections.Counter()
+    for identifier in _IDENTIFIER_RE.findall(text):
+        lower = identifier.lower()
+        if len(lower) >= 3 and lower not in _STOP_TERMS:
+            counts[lower] += 1
+        parts = _WORD_PART_RE.findall(identifier)
+        if len(parts) > 1:
+            for part in parts:
+                part = part.lower()
+                if len(part) >= 3 and part not in _STOP_TERMS and part != lower:
+                    counts[part] += 1
+    return counts
+
+
+def split_chunks(lines):
+    """Split a document into [(start_row, text)] chunks.
+
+    Boundaries depend only on nearby lines, so inserting or deleting text
+    leaves the other chunks' text unchanged. Blank chunks are dropped.
+    """
+    chunks = []
+    start = 0
+    for row, line in enumerate(lines):
+        size = row - start
+        if size >= MAX_CHUNK_LINES or (size >= MIN_CHUNK_LINES and line[:1] not in _NOT_CHUNK_STARTS and line.strip()):
+            chunks.append((start, "\n".join(lines[start:row])))
+            start = row
+    chunks.append((start, "\n".join(lines[start:])))
+    return [(start, text.rstrip()) for start, text in chunks if text.strip()]
+
+
+def format_snippets(snippets, comment="", title="Related code from other open files:"):
+    """Render (name, start_row, text) snippets as a prompt block under *title*.
+
+    With *comment* (a line-comment marker) every line, code included, is
+    commented out, for prompts that must stay valid code (FIM prefixes).
+    """
+    if not snippets:
+        return ""
+    prefix = comment + " " if comment else ""
+    out = [prefix + title]
+    for name, start_row, text in snippets:
+        out.append("{0}--- {1}, line {2} ---".format(prefix, name, start_row + 1))
+        out.extend(prefix + line for line in text.split("\n"))
+    return "\n".join(out) + "\n"
+
+
+class Chunk:
+    __slots__ = ("doc_id", "start", "end", "text", "length", "counts")
+
+    def __init__(self, doc_id, start, text, counts):
+        self.doc_id = doc_id
+        self.start = start                    # first row
+        self.end = start + text.count("\n")   # last row
+        self.text = text
+        self.length = sum(counts.values())    # document length for BM25
+        self.counts = counts                  # term -> frequency
+
+
+class ChunkIndex:
+    """Inverted index over the chunks of several documents. Thread-safe."""
+
+    def __init__(self):
+        self._chunks = {}       # chunk id -> Chunk
+        self._lengths = {}      # chunk id -> Chunk.length, for scoring
+        self._postings = {}     # term -> {chunk id: term frequency}
+        self._docs = {}         # doc id -> {chunk text: chunk id}
+        self._names = {}        # doc id -> display name
+        self._versions = {}     # doc id -> version of the indexed text
+        self._total_length = 0
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._chunks)
+
+    def version(self, doc_id):
+        """The version passed to the last `update` of *doc_id*, or None."""
+        return self._versions.get(doc_id)
+
+    def _add(self, chunk):
+        chunk_id = self._next_id
+        self._next_id += 1
+        self._chunks[chunk_id] = chunk
+        self._lengths[chunk_id] = chunk.length
+        self._total_length += chunk.length
+        for term, count in chunk.counts.items():
+            self._postings.setdefault(term, {})[chunk_id] = count
+        return chunk_id
+
+    def _remove(self, chunk_id):
+        chunk = self._chunks.pop(chunk_id)
+        del self._lengths[chunk_id]
+        self._total_length -= chunk.length
+        for term in chunk.counts:
+            postings = self._postings[term]
+            del postings[chunk_id]
+            if not postings:
+                del self._postings[term]
+
+    def update(self, doc_id, name, lines, version):
+        """Re-index *doc_id* from *lines*; only changed chunks are re-tokenized.
+
+        Returns the number of chunks added or removed.
+        """
+        split = split_chunks(lines)
+        with self._lock:
+            self._names[doc_id] = name
+            self._versions[doc_id] = version
+            old = self._docs.get(doc_id, {})
+            new = {}
+            changed = 0
+            for start, text in split:
+                if text in new:
+                    continue
+                chunk_id = old.pop(text, None)
+                if chunk_id is None:
+                    chunk_id = self._add(Chunk(doc_id, start, text, terms(text)))
+                    changed += 1
+                else:
+                    chunk = self._chunks[chunk_id]
+                    chunk.start, chunk.end = start, start + (chunk.end - chunk.start)
+                new[text] = chunk_id
+            for chunk_id in old.values():
+                self._remove(chunk_id)
+                changed += 1
+            self._docs[doc_id] = new
+        return changed
+
+    def remove(self, doc_id):
+        with self._lock:
+            for chunk_id in self._docs.pop(doc_id, {}).values():
+                self._remove(chunk_id)
+            self._names.pop(doc_id, None)
+            self._versions.pop(doc_id, None)
+
+    def search(self, query, limit, exclude=None):
+        """Top *limit* (score, chunk id) pairs for the Counter *query*.
+
+        *exclude* is (doc_id, first_row, last_row): chunks overlapping those
+        rows are already in the prompt and are skipped.
+        """
+        with self._lock:
+            count = len(self._chunks)
+            if not count:
+                return []
+            average = self._total_length / count or 1.0
+            small = count <= SMALL_INDEX_CHUNKS
+            lengths = self._lengths
+            scores = collections.defaultdict(float)
+            # Rarest terms first, so common ones can be scored against their matches.
+            postings_lists = sorted(filter(None, map(self._postings.get, query)), key=len)
+            for postings in postings_lists:
+                df = len(postings)
+                if not small and df > count * COMMON_SHARE:
+                    break
+                idf = math.log(1.0 + (count - df + 0.5) / (df + 0.5))
+                if small or df <= count * SCAN_SHARE or not scores:
+                    matches = postings.items()
+                else:
+                    matches = [(chunk_id, postings[chunk_id]) for chunk_id in scores if chunk_id in postings]
+                for chunk_id, tf in matches:
+                    scores[chunk_id] += idf * tf * (BM25_K1 + 1) / (
+                        tf + BM25_K1 * (1 - BM25_B + BM25_B * lengths[chunk_id] / average))
+            if exclude is not None:
+                doc_id, first, last = exclude
+                for chunk_id in self._docs.get(doc_id, {}).values():
+                    chunk = self._chunks[chunk_id]
+                    if chunk.start <= last and chunk.end >= first:
+                        scores.pop(chunk_id, None)
+            return heapq.nlargest(limit, ((score, chunk_id) for chunk_id, score in scores.items()))
+
+    def snippets(self, code_before, code_after, budget, exclude=None, top_k=TOP_K):
+        """The best chunks for the code around the cursor, within *budget* tokens.
+
+        Returns [(name, start_row, text)] for `format_snippets`, best first.
+        """
+        query = terms(code_before[-QUERY_BEFORE_CHARS:] + "\n" + code_after[:QUERY_AFTER_CHARS])
+        used = estimate_tokens(format_snippets([("", 0, "")]))
+        out = []
+        for _score, chunk_id in self.search(query, top_k * 3, exclude):
+            with self._lock:
+                chunk = self._chunks.get(chunk_id)
+                name = self._names.get(chunk.doc_id, "") if chunk is not None else ""
+            if chunk is None:
+                continue
+            cost = estimate_tokens(chunk.text) + chunk.end - chunk.start + 8
+            if used + cost > budget:
+                continue
+            used += cost
+            out.append((name, chunk.start, chunk.text))
+            if len(out) == top_k:
+                break
+        return out
@@ -0,0 +1,199 @@
+"""Per-endpoint request scheduling for inline suggestions.
+
+Each endpoint gets a `TokenBucket` whose refill rate is learned: it creeps
+up while requests succeed, is capped by what the observed latency says the
+server can keep up with, and halves on HTTP 429 (honouring Retry-After).
+Triggers that arrive while a bucket is empty are not dropped; the latest one
+per view is queued and replayed once a token is available.
+
+No Sublime imports: callers own the timers.
+"""
+
+import email.utils
+import threading
+import time
+
+
+# Requests a server is assumed to work on at once when deriving a rate
+# ceiling from latency (superseded requests are cancelled, so some overlap
+# is normal).
+LATENCY_CONCURRENCY = 2.0
+
+# The latency ceiling never goes below this many requests per second (the
+# old fixed per-view limit); only 429s push an endpoint slower.
+LATENCY_MIN_RATE = 1.0
+
+
+class TokenBucket:
+    """Request budget for one endpoint.
+
+    Holds up to `capacity` tokens, refilled at `rate` tokens per second.
+    The rate grows additively after each success, up to the ceiling implied
+    by the latency EMA and `max_rate`, and is cut in half on a 429. The
+    latency fed in is time to first byte, so a long generation does not
+    count as the server being slow to take requests.
+    """
+
+    def __init__(self, rate=2.0, capacity=3.0, min_rate=0.05, max_rate=20.0, increase=0.25, alpha=0.2):
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.alpha = alpha
+        self.tokens = capacity
+        self.latency_s = None      # EMA of request latency, once observed
+        self.blocked_until = 0.0   # Retry-After deadline (monotonic)
+        self._updated = None
+
+    def _refill(self, now):
+        if self._updated is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, now=None):
+        """Take a token. Returns 0.0 on success, else the seconds until one is due."""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+    def _ceiling(self):
+        if self.latency_s:
+            return min(self.max_rate, max(LATENCY_MIN_RATE, LATENCY_CONCURRENCY / self.latency_s))
+        return self.max_rate
+
+    def note_success(self, latency_s):
+        if self.latency_s is None:
+            self.latency_s = latency_s
+        else:
+            self.latency_s += self.alpha * (latency_s - self.latency_s)
+        self.rate = min(self._ceiling(), self.rate + self.increase)
+
+    def note_rate_limited(self, retry_after_s=None, now=None):
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        self.rate = max(self.min_rate, self.rate / 2.0)
+        self.tokens = 0.0
+        if retry_after_s:
+            self.blocked_until = max(self.blocked_until, now + retry_after_s)
+
+
+def parse_retry_after(value, now=None):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date)."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when is None:
+        return None
+    now = time.time() if now is None else now
+    return max(0.0, when.timestamp() - now)
+
+
+class RequestScheduler:
+    """Token buckets keyed on endpoint, plus one queued trigger per key.
+
+    Thread-safe: triggers come from the UI thread, feedback from workers.
+    """
+
+    def __init__(self, bucket_factory=TokenBucket):
+        self._bucket_factory = bucket_factory
+        self._buckets = {}
+        self._queued = {}          # key -> latest trigger waiting for a token
+        self._max_rate = None      # user cap in requests/second, if any
+        self._lock = threading.Lock()
+
+    def bucket(self, endpoint):
+        with self._lock:
+            return self._bucket(endpoint)
+
+    def _bucket(self, endpoint):
+        bucket = self._buckets.get(endpoint)
+        if bucket is None:
+            bucket = self._buckets[endpoint] = self._bucket_factory()
+            self._apply_cap(bucket)
+        return bucket
+
+    def _apply_cap(self, bucket):
+        if self._max_rate:
+            bucket.max_rate = self._max_rate
+            bucket.rate = min(bucket.rate, bucket.max_rate)
+
+    def configure(self, max_requests_per_minute=0):
+        """Set a hard cap for every bucket; 0 leaves the rates purely learned.
+
+        Cheap to call on every use. Only a changed cap resets the buckets,
+        so the learned rates survive unrelated settings changes.
+        """
+        max_rate = max_requests_per_minute / 60.0 if max_requests_per_minute > 0 else None
+        with self._lock:
+            if max_rate == self._max_rate:
+                return
+            self._max_rate = max_rate
+            self._buckets.clear()
+
+    def submit(self, endpoint, key, trigger, now=None):
+        """Admit *trigger* for *endpoint* or queue it as *key*'s latest one.
+
+        Returns `(delay_s, first)`. A delay of 0.0 means the caller may run
+        *trigger* now (anything queued for *key* is dropped as superseded).
+        Otherwise it replaced whatever *key* had queued, and *first* tells
+        the caller whether to arm a timer for `resume` (False when one is
+        already armed for this key).
+        """
+        with self._lock:
+            delay = self._bucket(endpoint).try_acquire(now)
+            if delay == 0.0:
+                self._queued.pop(key, None)
+                return 0.0, False
+            first = key not in self._queued
+            self._queued[key] = trigger
+            return delay, first
+
+    def resume(self, endpoint, key, now=None):
+        """Called by the timer armed after `submit`.
+
+        Returns `(trigger, delay_s)`: the queued trigger to run now (delay
+        0.0), or None and the delay before trying again.
+        """
+        with self._lock:
+            if key not in self._queued:
+                return None, 0.0
+            delay = self._bucket(endpoint).try_acquire(now)
+            if delay > 0.0:
+                return None, delay
+            return self._queued.pop(key), 0.0
+
+    def admit(self, endpoint, now=None):
+        """Take a token for a background request that should never wait or queue."""
+        with self._lock:
+            return self._bucket(endpoint).try_acquire(now) == 0.0
+
+    def discard(self, key):
+        with self._lock:
+            self._queued.pop(key, None)
+
+    def note_success(self, endpoint, latency_s):
+        with self._lock:
+            self._bucket(endpoint).note_success(latency_s)
+
+    def note_rate_limited(self, endpoint, retry_after_s=None):
+        with self._lock:
+            self._bucket(endpoint).note_rate_limited(retry_after_s)
+
+    def describe(self, endpoint):
+        with self._lock:
+            bucket = self._bucket(endpoint)
+            return "{0:.2f} req/s, {1:.1f} tokens".format(bucket.rate, bucket.tokens)
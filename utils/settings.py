@@ -4,14 +4,39 @@ import threading
 import sublime
 import sublime_plugin
 
-from .api import normalize_endpoint, fetch_models, test_endpoint_connectivity
-from .log import _log
+from .api import close_idle_connections, endpoint_health, normalize_endpoint, fetch_models, test_endpoint_connectivity
+from .log import _log, configure_logging, stop_log_writer
 
 
 # Module-level globals used across the first-run setup dialog callbacks.
 _setup_endpoint = None
 _setup_model = None
 
+# Callbacks run whenever CodeContinue.sublime-settings changes (caches that
+# derive from settings register here to invalidate themselves).
+_settings_listeners = []
+
+
+def on_settings_change(callback):
+    """Register *callback* to run whenever the CodeContinue settings change.
+
+    Safe to call at import time: nothing touches the Sublime API until
+    plugin_loaded hooks the settings object.
+    """
+    _settings_listeners.append(callback)
+
+
+def _notify_settings_change():
+    for callback in list(_settings_listeners):
+        callback()
+
+
+def _configure_logging():
+    configure_logging(sublime.load_settings("CodeContinue.sublime-settings"))
+
+
+on_settings_change(_configure_logging)
+
 
 def is_endpoint_configured(settings):
     """Return True when the configured endpoint looks like a real URL.
@@ -46,9 +71,9 @@ def _prompt_for_model(window, settings, default_model, on_done, on_cancel):
 
             if not is_ok:
                 sublime.status_message("CodeContinue: ⚠ {0}".format(msg))
-                _log("Endpoint connectivity: {0}".format(msg))
+                _log("Endpoint connectivity: {0}", msg)
             else:
-                _log("Endpoint connectivity: OK ({0} models found)".format(len(models)))
+                _log("Endpoint connectivity: OK ({0} models found)", len(models))
 
             if models:
                 options = list(models)
@@ -102,7 +127,7 @@ def show_endpoint_config_panel(view):
         if norm_endpoint:
             settings.set("endpoint", norm_endpoint)
             _save_settings()
-            _log("Configuration: endpoint saved ({0})".format(norm_endpoint))
+            _log("Configuration: endpoint saved ({0})", norm_endpoint)
 
             current_model = settings.get("model", "gpt-3.5-turbo")
 
@@ -137,6 +162,9 @@ def show_endpoint_config_panel(view):
 def plugin_loaded():
     """Sublime calls this hook when the plugin is loaded."""
     settings = sublime.load_settings("CodeContinue.sublime-settings")
+    settings.clear_on_change("code_continue")
+    settings.add_on_change("code_continue", _notify_settings_change)
+    configure_logging(settings)
 
     endpoint = settings.get("endpoint", "").strip()
     model = settings.get("model", "").strip()
@@ -146,6 +174,14 @@ def plugin_loaded():
         sublime.set_timeout(show_setup_dialog, 500)
 
 
+def plugin_unloaded():
+    """Sublime calls this hook before the plugin is unloaded or reloaded."""
+    sublime.load_settings("CodeContinue.sublime-settings").clear_on_change("code_continue")
+    close_idle_connections()
+    endpoint_health.reset()
+    stop_log_writer()
+
+
 def show_setup_dialog():
     """First-run setup: prompt for endpoint, then model, then optional API key.
 
@@ -183,7 +219,7 @@ def on_endpoint_entered(endpoint):
     settings = sublime.load_settings("CodeContinue.sublime-settings")
     settings.set("endpoint", norm_endpoint)
     _save_settings()
-    _log("Setup: endpoint saved incrementally ({0})".format(norm_endpoint))
+    _log("Setup: endpoint saved incrementally ({0})", norm_endpoint)
 
     window = sublime.active_window()
     if not window:
@@ -277,7 +313,7 @@ def _finish_setup(settings):
     endpoint = settings.get("endpoint", "")
     model = settings.get("model", "")
 
-    _log("CodeContinue: Configuration saved. Endpoint: {0}, Model: {1}".format(endpoint, model))
+    _log("CodeContinue: Configuration saved. Endpoint: {0}, Model: {1}", endpoint, model)
     sublime.message_dialog(
         "CodeContinue configured successfully!\n\nEndpoint: {0}\nModel: {1}\n\nPress Tab to accept suggestions once keybindings are configured.".format(
             endpoint, model
@@ -308,7 +344,7 @@ class CodeContinueConfigureCommand(sublime_plugin.TextCommand):
             if norm_endpoint:
                 settings.set("endpoint", norm_endpoint)
                 _save_settings()
-                _log("Configure: endpoint saved incrementally ({0})".format(norm_endpoint))
+                _log("Configure: endpoint saved incrementally ({0})", norm_endpoint)
 
                 current_model = settings.get("model", "gpt-3.5-turbo")
 
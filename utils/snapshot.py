@@ -0,0 +1,110 @@
+"""Per-buffer document snapshots for building suggestion context.
+
+A `DocumentSnapshot` mirrors one buffer as a list of lines. It is read from
+the buffer once, on first use, and from then on kept in sync by
+`SnapshotChangeListener` from the text-change deltas Sublime reports, so the
+suggest worker can slice context out of it off the UI thread in O(window).
+"""
+
+import threading
+
+import sublime
+import sublime_plugin
+
+from .log import _log
+from .text_utils import splice_lines
+
+
+class DocumentSnapshot:
+    """Line list mirroring one buffer.
+
+    `lines`, `change_count` and `reads` are only touched with `lock` held:
+    the UI thread applies edits while suggest workers read windows out of
+    it, and workers compare `change_count` with the count at trigger time to
+    tell whether the buffer moved on in between. `reads` counts full re-reads,
+    which can replace the text without moving the change count (revert).
+    """
+
+    __slots__ = ("lines", "change_count", "reads", "lock")
+
+    def __init__(self):
+        self.lines = None       # [str] or None until first read
+        self.change_count = -1  # view.change_count() the lines correspond to
+        self.reads = 0          # times the lines were read from the buffer
+        self.lock = threading.Lock()
+
+    def apply(self, changes, change_count):
+        """Replay text-change deltas (UI thread)."""
+        with self.lock:
+            if self.lines is None:
+                return
+            for change in changes:
+                splice_lines(self.lines, change.a.row, change.a.col, change.b.row, change.b.col, change.str)
+            self.change_count = change_count
+
+    def sync(self, view, force=False):
+        """Re-read the buffer if the snapshot is missing or stale (UI thread).
+
+        Cheap when already in sync; *force* re-reads regardless. Must run on
+        the UI thread so no edit can land between reading the buffer and
+        recording its change count. Returns the change count the lines now
+        match.
+        """
+        change_count = view.change_count()
+        with self.lock:
+            if force or self.lines is None or self.change_count != change_count:
+                _log("Snapshot: reading buffer {0} ({1} chars)", view.buffer_id(), view.size())
+                self.lines = view.substr(sublime.Region(0, view.size())).split("\n")
+                self.change_count = change_count
+                self.reads += 1
+        return change_count
+
+
+# buffer id -> DocumentSnapshot
+_snapshots = {}
+
+
+def get_snapshot(view):
+    """Return the snapshot for *view*'s buffer, creating an empty one if needed."""
+    buffer_id = view.buffer_id()
+    snapshot = _snapshots.get(buffer_id)
+    if snapshot is None:
+        snapshot = _snapshots[buffer_id] = DocumentSnapshot()
+    return snapshot
+
+
+def drop_snapshot(view):
+    """Forget *view*'s buffer snapshot (rebuilt lazily if a clone still needs it)."""
+    _snapshots.pop(view.buffer_id(), None)
+
+
+class SnapshotChangeListener(sublime_plugin.TextChangeListener):
+    """Keeps buffer snapshots in sync with edits."""
+
+    def on_text_changed(self, changes):
+        snapshot = _snapshots.get(self.buffer.id())
+        if snapshot is None:
+            return
+        view = self.buffer.primary_view()
+        if view is None:
+            return
+        snapshot.apply(changes, view.change_count())
+
+    def on_revert(self):
+        self._reread()
+
+    def on_reload(self):
+        self._reread()
+
+    def _reread(self):
+        # Revert and reload replace the text without reporting changes. The
+        # snapshot is re-read in place, not dropped, so holders of it (the
+        # retrieval index) see the new text too.
+        snapshot = _snapshots.get(self.buffer.id())
+        if snapshot is None:
+            return
+        view = self.buffer.primary_view()
+        if view is None:
+            _snapshots.pop(self.buffer.id(), None)
+            return
+        snapshot.sync(view, force=True)
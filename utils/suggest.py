@@ -5,49 +5,97 @@ EventListener / TextCommand classes here directly, but only because
 codeContinue.py imports them into the top-level package namespace.
 """
 
+import collections
+import concurrent.futures
+import hashlib
 import html
+import itertools
 import json
+import os
+import queue
 import threading
 import time
 import urllib.error
-import urllib.request
 
 import sublime
 import sublime_plugin
 
-from .api import get_provider
-from .log import _log, _log_error
-from .settings import is_endpoint_configured, show_endpoint_config_panel
-from .text_utils import clean_markdown_fences, strip_common_indent
+from .api import (
+    BREAKER_OPEN,
+    CancelToken,
+    RequestCancelled,
+    SlotAffinity,
+    endpoint_health,
+    format_usage,
+    get_fim_provider,
+    get_provider,
+    host_label,
+    iter_stream_text,
+    open_url,
+    parse_usage,
+)
+from . import embeddings
+from .embeddings import SNIPPETS_TITLE, embedding_index, refresh_embedding_indexes, semantic_snippets
+from .log import _debug_enabled, _log, _log_error
+from .metrics import RequestTimer, StageStats
+from .scheduler import RequestScheduler, parse_retry_after
+from .settings import is_endpoint_configured, on_settings_change, show_endpoint_config_panel
+from .retrieval import QUERY_AFTER_CHARS, QUERY_BEFORE_CHARS, ChunkIndex, format_snippets
+from .snapshot import drop_snapshot, get_snapshot
+from .symbols import SymbolIndex, format_related
+from .text_utils import (
+    CHARS_PER_TOKEN,
+    build_context,
+    clean_markdown_fences,
+    consume_typed_prefix,
+    estimate_tokens,
+    extend_to_anchor,
+    slice_around,
+    slice_lines,
+    strip_common_indent,
+)
 
 
 class SuggestState:
     """Per-view state for the inline-suggestion flow.
 
     Replaces the former module-level dicts/sets (``phantoms``,
-    ``last_request_time``, ``pending_requests``, ``suppress_clear``,
-    ``accept_grace_until``).  Accessed via the module-level ``_states`` dict,
-    keyed on ``view.id()``.
+    ``pending_requests``, ``suppress_clear``, ``accept_grace_until``).
+    Accessed via the module-level ``_states`` dict, keyed on ``view.id()``.
     """
 
     __slots__ = (
         "phantom_set",
         "remaining_lines",
         "common_prefix",
-        "last_request_time",
         "pending_request_id",
         "suppress_clear",
         "accept_grace_until",
+        "anchor",
+        "streaming",
+        "stream_lines",
+        "consumed",
+        "pending_newline",
+        "cancel_token",
+        "candidates",
+        "candidate_index",
     )
 
     def __init__(self):
         self.phantom_set = None        # sublime.PhantomSet or None
         self.remaining_lines = None    # [str] or None
         self.common_prefix = ""        # stripped indent prefix
-        self.last_request_time = 0.0   # wall-clock timestamp of last request
         self.pending_request_id = None # (vid, cursor, timestamp) or None
         self.suppress_clear = False    # True while an accept is in-flight
         self.accept_grace_until = 0.0  # wall-clock deadline
+        self.anchor = None             # buffer point the phantom is drawn at
+        self.streaming = False         # True while a streamed reply is still arriving
+        self.stream_lines = 0          # completed streamed lines already rendered
+        self.consumed = False          # True once any phantom line was accepted
+        self.pending_newline = False   # next streamed line starts below the cursor line
+        self.cancel_token = None       # CancelToken of the request in flight
+        self.candidates = None         # [str] alternatives for the phantom, or None
+        self.candidate_index = 0       # which of `candidates` is showing
 
     @property
     def has_phantom(self):
@@ -70,6 +118,934 @@ def _drop_state(vid):
     _states.pop(vid, None)
 
 
+# reason -> number of in-flight requests aborted for that reason
+_cancel_counts = {}
+
+# view.id() -> [CancelToken] of extra-candidate requests still running
+_sample_tokens = {}
+
+
+def _cancel_request(vid, reason):
+    """Abort *vid*'s in-flight request by closing its connection.
+
+    Frees the server slot immediately instead of letting it generate a
+    completion nobody will see. Returns True if a request was cancelled.
+    """
+    for sample_token in _sample_tokens.pop(vid, ()):
+        sample_token.cancel(reason)
+    state = _states.get(vid)
+    token = state.cancel_token if state else None
+    if token is None or token.cancelled:
+        return False
+    state.cancel_token = None
+    token.cancel(reason)
+    _cancel_counts[reason] = _cancel_counts.get(reason, 0) + 1
+    if _debug_enabled():
+        _log(
+            "Cancelled in-flight request ({0}); cancellations so far: total {1} ({2})",
+            reason,
+            sum(_cancel_counts.values()),
+            ", ".join("{0} {1}".format(k, v) for k, v in sorted(_cancel_counts.items())),
+        )
+    return True
+
+
+def _is_current(vid, request_id):
+    """True while *request_id* is still the request the view is waiting for."""
+    state = _states.get(vid)
+    return state is not None and state.pending_request_id == request_id
+
+
+DEFAULT_SYSTEM_PROMPT = (
+    "You are a code completion expert. Output ONLY the code continuation "
+    "without any markdown formatting, backticks, explanations, comments, or "
+    "inline comments. Write clean code without any commentary. "
+    "Do NOT include the <CURSOR_HERE> marker in your response."
+)
+
+
+class CompletionCache:
+    """In-memory LRU of finished completions keyed on the normalized prompt.
+
+    Entries are evicted least-recently-used first once either `max_entries`
+    or `max_bytes` is exceeded, and expire `ttl_s` seconds after they were
+    stored. Thread-safe: worker threads store results while the UI thread
+    looks them up.
+    """
+
+    def __init__(self, max_entries=64, max_bytes=256 * 1024, ttl_s=300.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()  # key -> (completion, stored_at)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(*parts):
+        """Hash the request parts (provider, model, system prompt, context...)."""
+        digest = hashlib.sha1()
+        for part in parts:
+            digest.update(str(part).encode("utf-8", "replace"))
+            digest.update(b"\x00")
+        return digest.hexdigest()
+
+    def get(self, key, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[1] > self.ttl_s:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def peek(self, key, now=None):
+        """Like `get`, but without counting a hit or miss or touching LRU order."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or now - entry[1] > self.ttl_s:
+                return None
+            return entry[0]
+
+    def put(self, key, completion, now=None):
+        if self.max_entries <= 0 or len(completion) > self.max_bytes:
+            return
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (completion, now)
+            self._bytes += len(completion)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        completion, _stored_at = self._entries.pop(key)
+        self._bytes -= len(completion)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def describe(self):
+        lookups = self.hits + self.misses
+        rate = 100.0 * self.hits / lookups if lookups else 0.0
+        return "{0}/{1} hits ({2:.0f}%), {3} entries".format(self.hits, lookups, rate, len(self._entries))
+
+    __str__ = describe  # lets _log format it lazily
+
+
+_completion_cache = CompletionCache()
+on_settings_change(_completion_cache.clear)
+
+# Share of the context budget spent on the code before the cursor in FIM mode.
+FIM_PREFIX_WEIGHT = 0.75
+
+
+# With kv_cache_affinity (or prompt_caching) the context may grow by this
+# share of the prefix budget to keep starting on the previous request's
+# first row.
+CONTEXT_ANCHOR_SLACK = 0.25
+
+# With Anthropic prompt caching, the chat prompt sends the code before the
+# cursor as a head, cut every CACHE_HEAD_STEP_LINES lines from the context
+# start, and the tail after it (at least CACHE_TAIL_MIN_LINES lines). The
+# head only changes every few Enters, so it stays a cacheable prefix
+# between them.
+CACHE_HEAD_STEP_LINES = 32
+CACHE_TAIL_MIN_LINES = 8
+
+
+def _split_for_cache(code_before):
+    """Split *code_before* into (head, tail) for the cacheable prompt layout.
+
+    The head is "" when the context is too short to be worth caching.
+    """
+    lines = code_before.split("\n")
+    cut = (len(lines) - 1 - CACHE_TAIL_MIN_LINES) // CACHE_HEAD_STEP_LINES * CACHE_HEAD_STEP_LINES
+    if cut <= 0:
+        return "", code_before
+    return "\n".join(lines[:cut]) + "\n", "\n".join(lines[cut:])
+
+
+def _read_context(snapshot, change_count, row, col, budget, prefix_weight, max_lines, insert="", anchor=None):
+    """Return (code_before, code_after) around (row, col), or None if stale.
+
+    Runs on the worker thread against the buffer snapshot; returns None
+    when the buffer changed after the request was triggered. With a token
+    budget only a window the budget could fill is sliced out, so a huge
+    file or a minified line costs no more than a small one; otherwise the
+    legacy fixed window of *max_lines* lines is used. *insert* is text
+    treated as already typed at the cursor: a newline for an idle prefetch,
+    the rest of the phantom for a chained request. With *anchor* (a row)
+    the context keeps starting there while that costs little extra (see
+    `extend_to_anchor`).
+    """
+    above = None
+    with snapshot.lock:
+        if snapshot.change_count != change_count:
+            return None
+        if budget > 0:
+            reach = int(budget * CHARS_PER_TOKEN) + 1
+            before, after = slice_around(snapshot.lines, row, col, reach)
+            if anchor is not None and 0 <= anchor < row:
+                above = snapshot.lines[anchor:row]
+        else:
+            above = max(0, max_lines // 2 - insert.count("\n"))
+            before, after = slice_lines(snapshot.lines, row, col, above, max_lines // 2)
+            return before + insert, after
+    code_before, code_after = build_context(before + insert, after, budget, prefix_weight)
+    if above:
+        covered = code_before.count("\n") - insert.count("\n")
+        code_before = extend_to_anchor(code_before, above, covered, budget * prefix_weight * CONTEXT_ANCHOR_SLACK)
+    return code_before, code_after
+
+
+# view.id() -> time.monotonic() of the last Enter, the start of the dispatch stage.
+_trigger_times = {}
+
+# Per-endpoint request budget; replaces the old fixed 1 s per-view limit.
+_scheduler = RequestScheduler()
+
+
+def _configured_scheduler(settings):
+    """`_scheduler` with the max_requests_per_minute cap applied.
+
+    The cap is read on use rather than on settings changes, so it holds
+    from startup.
+    """
+    _scheduler.configure(settings.get("max_requests_per_minute", 0))
+    return _scheduler
+
+
+def _note_request_failure(endpoint, error):
+    """Feed a failed request back into the scheduler (429 slows the endpoint down)."""
+    if getattr(error, "code", None) == 429:
+        headers = getattr(error, "headers", None)
+        retry_after = parse_retry_after(headers.get("Retry-After") if headers else None)
+        _scheduler.note_rate_limited(endpoint, retry_after)
+        _log("Rate limited by {0} (retry after {1}); now {2}", endpoint, retry_after, _scheduler.describe(endpoint))
+
+
+def _on_endpoint_health(url, state):
+    """Breaker transitions get one status message each (any thread)."""
+    if state == BREAKER_OPEN:
+        msg = "CodeContinue: {0} is not responding; suggestions paused until it is back".format(host_label(url))
+    else:
+        msg = "CodeContinue: {0} is responding again".format(host_label(url))
+    _log("{0}", msg)
+    sublime.set_timeout(lambda: sublime.status_message(msg), 0)
+
+
+endpoint_health.on_change = _on_endpoint_health
+on_settings_change(endpoint_health.reset)
+
+
+def _resume_trigger(view, endpoint):
+    """Timer armed for a trigger that was queued behind the endpoint's budget."""
+    vid = view.id()
+    state = _states.get(vid)
+    sel = view.sel()
+    line_start = view.line(sel[0].b).begin() if len(sel) == 1 else None
+    if (state and state.has_phantom) or line_start is None or view.substr(sublime.Region(line_start, sel[0].b)).strip():
+        # A suggestion is already showing, or the user kept typing on the new line.
+        _scheduler.discard(vid)
+        return
+    trigger, delay = _scheduler.resume(endpoint, vid)
+    if trigger is None:
+        if delay > 0.0:
+            sublime.set_timeout(lambda: _resume_trigger(view, endpoint), int(delay * 1000) + 1)
+        return
+    _log("Running queued trigger")
+    view.run_command("code_continue_suggest")
+
+
+# tuple(window.folders()) -> SymbolIndex; windows on the same folders share one.
+_symbol_indexes = {}
+
+# Rescan the project for changed files at most this often (on use).
+SYMBOL_RESCAN_INTERVAL_S = 60.0
+
+
+def _log_symbol_scan(index):
+    def on_done(changed, seconds, error):
+        if error is not None:
+            _log("Symbol index scan failed: {0}", error)
+        else:
+            _log("Symbol index: {0}; {1} files changed, scanned in {2:.2f}s", index, changed, seconds)
+    return on_done
+
+
+def _symbol_index(view):
+    """The symbol index for *view*'s project folders, or None (UI thread).
+
+    Created and loaded on first use; rescanned in the background when the
+    last scan is older than SYMBOL_RESCAN_INTERVAL_S.
+    """
+    window = view.window()
+    folders = tuple(window.folders()) if window else ()
+    if not folders:
+        return None
+    index = _symbol_indexes.get(folders)
+    if index is None:
+        digest = hashlib.sha1("\n".join(folders).encode("utf-8", "replace")).hexdigest()[:16]
+        path = os.path.join(sublime.cache_path(), "CodeContinue", "symbols", digest + ".json")
+        index = _symbol_indexes[folders] = SymbolIndex(folders, path)
+    index.refresh_async(SYMBOL_RESCAN_INTERVAL_S, _log_symbol_scan(index))
+    return index
+
+
+def _log_embedding_scan(index, embedded, seconds, error):
+    if error is not None:
+        _log("Embedding index refresh failed: {0}", error)
+    else:
+        _log("Embedding index: {0}; {1} chunks embedded in {2:.2f}s", index, embedded, seconds)
+
+
+embeddings.on_refresh = _log_embedding_scan
+
+
+def _line_comment(view, point):
+    """The syntax's line-comment marker at *point* ("#", "//"...), or None."""
+    variables = {v.get("name"): v.get("value", "") for v in view.meta_info("shellVariables", point) or ()}
+    for name, value in sorted(variables.items()):
+        if name.startswith("TM_COMMENT_START") and "TM_COMMENT_END" + name[len("TM_COMMENT_START"):] not in variables:
+            return value.strip() or None
+    return None
+
+
+# Longest a suggestion waits for its semantic lookup (query embedding and
+# search) once the other related context is ready. A slower lookup is left
+# out of that request instead of holding it up.
+SEMANTIC_WAIT_S = 0.05
+
+
+def _semantic_lookup(index, query, budget, exclude, cancel):
+    """Start `semantic_snippets` on its own thread; returns its Future."""
+    future = concurrent.futures.Future()
+
+    def run():
+        try:
+            future.set_result(semantic_snippets(index, query, budget, exclude, cancel))
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, name="CodeContinue semantic lookup", daemon=True).start()
+    return future
+
+
+def _related_prompt(related, comment=""):
+    """The prompt block for (signatures, snippets, semantic) from `related_context`."""
+    signatures, snippets, semantic = related
+    return (format_related(signatures, comment) + format_snippets(snippets, comment)
+            + format_snippets(semantic, comment, SNIPPETS_TITLE))
+
+
+# Chunks of the open views, for BM25 snippet retrieval (retrieval_context_tokens).
+_chunk_index = ChunkIndex()
+
+# buffer id -> (display name, DocumentSnapshot) of the buffers in _chunk_index
+_retrieval_docs = {}
+
+# Buffers larger than this are not indexed.
+MAX_RETRIEVAL_VIEW_CHARS = 1024 * 1024
+
+
+def _track_for_retrieval(view):
+    """Index *view*'s buffer for snippet retrieval from now on (UI thread).
+
+    The index is filled from the buffer snapshot, which the text-change
+    listener keeps current (re-reading it on revert and reload), so this
+    only reads the buffer the first time.
+    """
+    if view.settings().get("is_widget") or view.is_scratch() or view.size() > MAX_RETRIEVAL_VIEW_CHARS:
+        return
+    snapshot = get_snapshot(view)
+    snapshot.sync(view)
+    name = os.path.basename(view.file_name() or "") or view.name() or "untitled"
+    _retrieval_docs[view.buffer_id()] = (name, snapshot)
+
+
+def _forget_for_retrieval(view):
+    if _retrieval_docs.pop(view.buffer_id(), None) is not None:
+        _chunk_index.remove(view.buffer_id())
+
+
+def _retrieve_snippets(buffer_id, code_before, code_after, row, budget):
+    """BM25 snippets from the open views for the context around *row* (worker thread).
+
+    Buffers edited or re-read since the last query are re-indexed first;
+    chunks of the current buffer that overlap the context are left out.
+    """
+    for doc_id, (name, snapshot) in list(_retrieval_docs.items()):
+        with snapshot.lock:
+            version = (snapshot.reads, snapshot.change_count)
+            if snapshot.lines is None or version == _chunk_index.version(doc_id):
+                continue
+            lines = list(snapshot.lines)
+        _chunk_index.update(doc_id, name, lines, version)
+    exclude = (buffer_id, row - code_before.count("\n"), row + code_after.count("\n"))
+    return _chunk_index.snippets(code_before, code_after, budget, exclude)
+
+
+# HTTP statuses meaning "this server has no such FIM endpoint / format".
+FIM_FALLBACK_STATUS = (400, 404, 405, 501)
+
+# FIM URLs that rejected a request; they get the chat prompt from then on.
+_fim_unsupported = set()
+on_settings_change(_fim_unsupported.clear)
+
+
+def _open_completion(attempts, settings, timeout_s, token, timer):
+    """Open the first of *attempts* the server accepts.
+
+    Each attempt is `(url, provider, payload)`. When every attempt but the
+    last is a FIM request, a rejection with one of `FIM_FALLBACK_STATUS`
+    marks that URL unsupported and the next attempt (the chat prompt) is
+    sent instead. Returns `(response, provider)`. *timer* gets the
+    serialize, connect and TTFB stages, keyed on the URL that answered.
+    """
+    for i, (url, provider, payload) in enumerate(attempts):
+        _log("Sending request to endpoint {0} (timeout: {1:.1f}s, stream: {2})", url, timeout_s, payload.get("stream", False))
+        try:
+            body = json.dumps(payload).encode()
+            timer.lap("serialize")
+            timer.endpoint = url
+            response = open_url(url, body, provider.build_headers(settings), timeout_s, cancel=token)
+            timer.lap_response(response)
+            return response, provider
+        except urllib.error.HTTPError as e:
+            if i == len(attempts) - 1 or e.code not in FIM_FALLBACK_STATUS:
+                raise
+            _fim_unsupported.add(url)
+            _log("FIM request rejected (HTTP {0}); using the chat prompt for {1} from now on", e.code, url)
+
+
+# URLs that answered an `n` > 1 request with a single choice; extra
+# candidates for them come from parallel requests instead.
+_n_unsupported = set()
+on_settings_change(_n_unsupported.clear)
+
+
+def _asks_n(url, provider):
+    """True when one request to *url* can return several candidates."""
+    return (getattr(provider, "supports_n", False) and url not in _n_unsupported
+            and not url.endswith(("/api/chat", "/api/generate")))
+
+
+# host -> SlotAffinity of that server's KV-cache slots (kv_cache_affinity).
+_kv_slots = {}
+
+# view.id() -> first row of the last context sent, where the next one starts if it can.
+_context_anchors = {}
+
+
+def _kv_slot(url, vid, slots):
+    """The server slot *url*'s requests for view *vid* are pinned to."""
+    affinity = _kv_slots.get(host_label(url))
+    if affinity is None:
+        affinity = _kv_slots.setdefault(host_label(url), SlotAffinity(slots))
+    elif affinity.slots != slots:
+        affinity.resize(slots)
+    return affinity.slot(vid)
+
+
+def _log_usage(label, usage):
+    """Log the token counts of a reply (prompt-cache hits show up here)."""
+    if usage:
+        _log("{0} usage: {1}", label, format_usage(usage))
+
+
+def _sample_candidates(view, attempts, settings, timeout_s, count, candidates):
+    """Fetch *count* more candidates in parallel, one request each.
+
+    For servers that cannot return several choices per request. Results
+    are merged into *candidates* on the UI thread; the requests are
+    cancelled along with the view's next request.
+    """
+    tokens = _sample_tokens.setdefault(view.id(), [])
+
+    def sample(token):
+        timer = RequestTimer("candidate")
+        try:
+            response, provider = _open_completion(attempts, settings, timeout_s, token, timer)
+            with response:
+                raw_body = response.read()
+            timer.lap("download")
+            result = json.loads(raw_body.decode())
+            text = clean_markdown_fences(provider.parse_response(result))
+            timer.lap("parse")
+            _log_usage("Candidate", parse_usage(result))
+            timer.finish()
+        except Exception as e:
+            if not token.cancelled:
+                _log("Candidate request failed: {0:.200}", str(e))
+            return
+        if text:
+            sublime.set_timeout(lambda: _add_candidates(view, candidates, [text]), 0)
+
+    for _ in range(count):
+        token = CancelToken()
+        tokens.append(token)
+        threading.Thread(target=sample, args=(token,), daemon=True).start()
+
+
+class Upstream:
+    """One endpoint/model pair an inline suggestion can be requested from."""
+
+    __slots__ = ("endpoint", "model", "settings", "provider", "fim_url", "fim_provider")
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.endpoint = settings.get("endpoint", "")
+        self.model = settings.get("model", "")
+        self.provider = get_provider(self.endpoint, settings)
+        # Fill-in-the-middle sends the code after the cursor too; servers
+        # without a FIM endpoint fall back to the chat prompt.
+        self.fim_url, self.fim_provider = None, None
+        if settings.get("completion_mode", "chat") == "fim":
+            self.fim_url, self.fim_provider = get_fim_provider(self.endpoint, settings, self.model)
+            if self.fim_url in _fim_unsupported:
+                self.fim_url, self.fim_provider = None, None
+
+
+class SecondarySettings:
+    """The settings as the secondary endpoint sees them.
+
+    `secondary_endpoint`, `secondary_model`, `secondary_api_key` and
+    `secondary_provider` stand in for their primary counterparts; every
+    other setting is shared.
+    """
+
+    KEYS = {
+        "endpoint": "secondary_endpoint",
+        "model": "secondary_model",
+        "api_key": "secondary_api_key",
+        "provider": "secondary_provider",
+    }
+
+    def __init__(self, settings):
+        self._settings = settings
+
+    def get(self, key, default=None):
+        return self._settings.get(self.KEYS.get(key, key), default)
+
+
+# Hedge delay while the primary has too few samples for a p95.
+HEDGE_DEFAULT_DELAY_S = 1.0
+HEDGE_MIN_SAMPLES = 8
+HEDGE_MIN_DELAY_S = 0.05
+
+# How long the primary takes to produce its first token (its whole reply
+# when not streaming), keyed on ("primary", url, model), stage "answer".
+_answer_times = StageStats()
+
+
+def hedge_delay(settings, url, model):
+    """Seconds the primary gets to answer before the secondary is asked too.
+
+    `hedge_delay_ms` > 0 is used as is; 0 adapts to the p95 of the
+    primary's recent time to first token.
+    """
+    delay_ms = settings.get("hedge_delay_ms", 0)
+    if delay_ms > 0:
+        return delay_ms / 1000.0
+    summary = _answer_times.summary("primary", url, model, "answer")
+    if summary is None or summary[0] < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY_S
+    return max(HEDGE_MIN_DELAY_S, summary[2])
+
+
+def _open_answer(upstream, attempts, timeout_s, token, timer, stream):
+    """Open one leg and wait for its first token.
+
+    Streaming servers send headers before the model has produced
+    anything, so a streamed leg only counts as answered once the first
+    delta arrives. Returns `(response, provider, deltas)`; *deltas*
+    replays that first delta and continues the stream (None when not
+    streaming).
+    """
+    response, provider = _open_completion(attempts, upstream.settings, timeout_s, token, timer)
+    if not stream:
+        return response, provider, None
+    try:
+        deltas = iter_stream_text(response, provider)
+        first = next(deltas, None)
+    except BaseException:
+        response.close()
+        raise
+    return response, provider, itertools.chain(() if first is None else (first,), deltas)
+
+
+def _open_hedged(legs, delay_s, timeout_s, token, timer, stream=False):
+    """Race the primary against the secondary; the first to answer wins.
+
+    *legs* is `[(upstream, attempts), ...]`, primary first. The secondary
+    is sent once the primary has been silent for *delay_s*, or straight
+    away if the primary fails. The loser is cancelled, and its response is
+    closed if it arrives anyway. Each leg is timed on a fork of *timer*;
+    the winner's fork is adopted. Returns `(response, provider, upstream,
+    deltas)` (see `_open_answer`), or raises the primary's error when
+    every leg fails.
+    """
+    results = queue.Queue()
+    lock = threading.Lock()
+    tokens = []
+    winner = []
+
+    def start(i):
+        upstream, attempts = legs[i]
+        leg_token = CancelToken()
+        leg_timer = timer.fork("hedge" if i else None)
+        leg_timer.model = upstream.model
+        with lock:
+            tokens.append(leg_token)
+        if token.cancelled:
+            leg_token.cancel(token.reason)
+
+        def run():
+            sent = time.monotonic()
+            try:
+                opened = _open_answer(upstream, attempts, timeout_s, leg_token, leg_timer, stream)
+            except Exception as e:
+                results.put((i, e, None))
+                return
+            if i == 0:
+                _answer_times.record("primary", attempts[0][0], upstream.model, {"answer": time.monotonic() - sent})
+            with lock:
+                lost = bool(winner)
+                if not lost:
+                    results.put((i, None, opened + (leg_timer,)))
+            if lost:
+                opened[0].close()
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def cancel_legs():
+        with lock:
+            live = list(tokens)
+        for leg_token in live:
+            leg_token.cancel(token.reason)
+
+    # Cancelling the request cancels every leg, including the winner while
+    # its response is being read.
+    token.attach(cancel_legs)
+    start(0)
+    started, errors = 1, {}
+    while True:
+        try:
+            i, error, opened = results.get(timeout=delay_s if started < len(legs) else None)
+        except queue.Empty:
+            _log("Primary silent for {0:.0f} ms; hedging to {1}", delay_s * 1000, legs[1][0].endpoint)
+            start(1)
+            started += 1
+            continue
+        if error is None:
+            break
+        errors[i] = error
+        if started < len(legs) and not token.cancelled:
+            _log("Primary failed ({0:.200}); trying {1}", str(error), legs[1][0].endpoint)
+            start(1)
+            started += 1
+        elif len(errors) == started:
+            raise errors.get(0, error)
+
+    response, provider, deltas, leg_timer = opened
+    with lock:
+        winner.append(i)
+        late = []
+        while not results.empty():
+            late.append(results.get_nowait())
+        losers = [t for j, t in enumerate(tokens) if j != i]
+    for _j, _error, other in late:
+        if other is not None:
+            other[0].close()
+    for leg_token in losers:
+        leg_token.cancel("hedge lost")
+    timer.adopt(leg_timer)
+    if started > 1:
+        _log("Hedged request won by {0}", legs[i][0].endpoint)
+    return response, provider, legs[i][0], deltas
+
+
+def normalize_context(code_before):
+    """Drop the cursor line's trailing indentation so equivalent prompts share a key.
+
+    Enter, backspace, Enter can leave different auto-indent whitespace on
+    the new line while the code the model sees is the same.
+    """
+    return code_before.rstrip(" \t")
+
+
+# Line endings after which the idle trigger fires sooner: Enter is likely next.
+BLOCK_OPENERS = (":", "{", "=>")
+
+
+class AdaptiveDebounce:
+    """Idle-trigger delay that follows typing cadence and endpoint latency.
+
+    The user counts as paused after about twice their usual gap between
+    keystrokes; a slow endpoint shortens that wait by up to half so the
+    prefetch gets a head start. Both inputs are exponential moving averages.
+    """
+
+    def __init__(self, min_ms=150, max_ms=800, alpha=0.2):
+        self.min_ms = min_ms
+        self.max_ms = max_ms
+        self.alpha = alpha
+        self.cadence_ms = 200.0   # typical gap between keystrokes
+        self.latency_ms = 800.0   # typical time for a completion to arrive
+        self._last_keystroke = None
+
+    def note_keystroke(self, now=None):
+        now = time.monotonic() if now is None else now
+        if self._last_keystroke is not None:
+            gap_ms = (now - self._last_keystroke) * 1000.0
+            if gap_ms < 2000.0:  # longer gaps are pauses, not cadence
+                self.cadence_ms += self.alpha * (gap_ms - self.cadence_ms)
+        self._last_keystroke = now
+
+    def note_latency(self, seconds):
+        self.latency_ms += self.alpha * (seconds * 1000.0 - self.latency_ms)
+
+    def delay_ms(self, block_opener=False):
+        pause_ms = 2.0 * self.cadence_ms
+        delay = pause_ms - min(0.25 * self.latency_ms, pause_ms / 2.0)
+        if block_opener:
+            delay /= 2.0
+        return int(min(self.max_ms, max(self.min_ms, delay)))
+
+
+_debounce = AdaptiveDebounce()
+
+
+class BackgroundRequest:
+    """A request that only fills the completion cache.
+
+    An Enter-triggered request for the same cache key joins it through
+    `_inflight` instead of sending its own.
+    """
+
+    __slots__ = ("token", "key", "done")
+
+    label = "Background request"
+    flow = "background"  # metrics flow name
+
+    def __init__(self):
+        self.token = CancelToken()
+        self.key = None                  # cache key, once the worker computed it
+        self.done = threading.Event()    # set when the request finished either way
+
+
+class Prefetch(BackgroundRequest):
+    """Idle-typing prefetch of the line after the cursor's, as if Enter were pressed."""
+
+    __slots__ = ("row", "line")
+
+    label = "Idle prefetch"
+    flow = "prefetch"
+
+    def __init__(self, row, line):
+        super().__init__()
+        self.row = row                   # row of the line being completed
+        self.line = line                 # that line's text at trigger time
+
+
+class Chain(BackgroundRequest):
+    """Follow-up request started while the last phantom lines are accepted.
+
+    It completes the buffer as it will look once *pending* (phantom text not
+    accepted yet) is in, continued on a new line at *indent*.
+    """
+
+    __slots__ = ("start", "pending", "indent")
+
+    label = "Chained request"
+    flow = "chain"
+
+    def __init__(self, start, pending, indent):
+        super().__init__()
+        self.start = start               # cursor when the chain was started
+        self.pending = pending           # text the remaining accepts will insert
+        self.indent = indent             # indentation of the line after it
+
+    @property
+    def end_point(self):
+        return self.start + len(self.pending)
+
+
+# view.id() -> Prefetch in flight for that view
+_prefetches = {}
+
+# view.id() -> Chain in flight for that view
+_chains = {}
+
+# cache key -> BackgroundRequest in flight, so an Enter-triggered request can join it
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+# view.id() -> counter bumped on every edit; stale idle timers see a newer value
+_idle_generation = {}
+
+
+def _idle_candidate(view):
+    """Return (row, line) when the cursor ends a non-blank line, else None."""
+    sel = view.sel()
+    if len(sel) != 1 or not sel[0].empty():
+        return None
+    cursor = sel[0].b
+    line_region = view.line(cursor)
+    if cursor != line_region.end():
+        return None
+    line = view.substr(line_region)
+    if not line.strip():
+        return None
+    return view.rowcol(cursor)[0], line
+
+
+def _prefetch_still_valid(view, prefetch):
+    """True while an edit leaves *prefetch*'s cache key unchanged.
+
+    That is: its line is untouched and the cursor is still at the end of it,
+    or on a fresh whitespace-only line right below (Enter plus auto-indent).
+    """
+    sel = view.sel()
+    if len(sel) != 1 or not sel[0].empty():
+        return False
+    cursor = sel[0].b
+    if view.substr(view.line(view.text_point(prefetch.row, 0))) != prefetch.line:
+        return False
+    row = view.rowcol(cursor)[0]
+    if row == prefetch.row:
+        return cursor == view.line(cursor).end()
+    return row == prefetch.row + 1 and not view.substr(view.line(cursor)).strip()
+
+
+def _note_edit_for_prefetch(view, settings):
+    """Cancel a prefetch the edit invalidated and re-arm the idle timer."""
+    vid = view.id()
+    prefetch = _prefetches.get(vid)
+    if prefetch is not None and not _prefetch_still_valid(view, prefetch):
+        _prefetches.pop(vid, None)
+        prefetch.token.cancel("buffer edited")
+        _log("Cancelled idle prefetch (buffer edited)")
+
+    if not settings.get("idle_trigger", False):
+        return
+    _debounce.note_keystroke()
+    generation = _idle_generation.get(vid, 0) + 1
+    _idle_generation[vid] = generation
+    candidate = _idle_candidate(view)
+    if candidate is None:
+        return
+    delay = _debounce.delay_ms(candidate[1].rstrip().endswith(BLOCK_OPENERS))
+    sublime.set_timeout(lambda: _idle_fire(view, generation), delay)
+
+
+def _idle_fire(view, generation):
+    vid = view.id()
+    if _idle_generation.get(vid) != generation:
+        return  # typed again since the timer was armed
+    state = _states.get(vid)
+    if state and (state.has_phantom or state.cancel_token is not None):
+        return
+    if vid in _prefetches or _idle_candidate(view) is None:
+        return
+    settings = sublime.load_settings("CodeContinue.sublime-settings")
+    if not _configured_scheduler(settings).admit(settings.get("endpoint", "")):
+        _log("Idle prefetch skipped; endpoint budget spent")
+        return
+    view.run_command("code_continue_suggest", {"prefetch": True})
+
+
+def _chain_still_valid(view, chain):
+    """True while the buffer is heading where *chain* assumed it would.
+
+    Everything between the chain's start and the cursor must be the start
+    of its pending text, optionally followed by Enter plus indentation
+    (the Enter-triggered request then joins the chain).
+    """
+    sel = view.sel()
+    if len(sel) != 1 or not sel[0].empty():
+        return False
+    cursor = sel[0].b
+    if cursor < chain.start:
+        return False
+    typed = view.substr(sublime.Region(chain.start, cursor))
+    if chain.pending.startswith(typed):
+        return True
+    extra = typed[len(chain.pending):]
+    return typed.startswith(chain.pending) and extra.startswith("\n") and not extra.strip()
+
+
+def _check_chain(view):
+    """Cancel *view*'s chained request once the user went elsewhere."""
+    chain = _chains.get(view.id())
+    if chain is not None and not _chain_still_valid(view, chain):
+        del _chains[view.id()]
+        chain.token.cancel("diverged")
+        _log("Cancelled chained request (buffer or cursor diverged)")
+
+
+def _apply_chain(view, chain, completion):
+    """Show a finished chained completion (UI thread).
+
+    Appended to the phantom while lines are still to be accepted, or shown
+    below the last accepted line if the user is already there.
+    """
+    vid = view.id()
+    if _chains.get(vid) is not chain:
+        return
+    del _chains[vid]
+    if not _chain_still_valid(view, chain):
+        return
+
+    lines = completion.split("\n")
+    if not lines[0].startswith((" ", "\t")):
+        lines[0] = chain.indent + lines[0]
+    state = _states.get(vid)
+    cursor = view.sel()[0].b
+    if state and state.has_phantom and state.remaining_lines and not state.streaming:
+        state.remaining_lines.extend(lines)
+        state.phantom_set.update([_make_phantom(state.anchor, state.remaining_lines)])
+        _log("Chained completion appended to the phantom")
+    elif cursor == chain.end_point and not (state and (state.has_phantom or state.cancel_token)):
+        state = _get_state(vid)
+        state.phantom_set = sublime.PhantomSet(view)
+        state.remaining_lines = [""] + lines
+        state.common_prefix = ""
+        state.anchor = cursor
+        state.consumed = True
+        state.phantom_set.update([_make_phantom(cursor, state.remaining_lines)])
+        view.set_status('code_continue_visible', 'true')
+        _log("Chained completion shown below the accepted lines")
+
+
+def _start_chain(view):
+    """Kick off the follow-up request after an accept (UI thread)."""
+    if view.id() in _chains:
+        return
+    settings = sublime.load_settings("CodeContinue.sublime-settings")
+    if not settings.get("chain_suggestions", False):
+        return
+    if not _configured_scheduler(settings).admit(settings.get("endpoint", "")):
+        _log("Chained request skipped; endpoint budget spent")
+        return
+    view.run_command("code_continue_suggest", {"chain": True})
+
+
 LANGUAGE_ALIASES = {
     "cpp": {"cpp", "c++", "c"},
     "c++": {"cpp", "c++", "c"},
@@ -104,55 +1080,210 @@ def is_syntax_supported(syntax, trigger_langs):
     return False
 
 
+class TriggerGate:
+    """Answers "are suggestions enabled in this view?" in O(1).
+
+    `on_text_command` and `on_modified` run for every keystroke in every
+    view, so the answer is cached at three levels: the normalised
+    `trigger_language` list, a per-syntax table, and a per-view entry.
+    View entries are dropped when that view's settings change (a syntax
+    change is one); everything is dropped when the plugin settings change.
+    UI thread only.
+    """
+
+    SETTINGS_KEY = "code_continue_trigger_gate"
+
+    def __init__(self, load_languages):
+        self._load_languages = load_languages  # () -> trigger_language list
+        self._languages = None                 # cached trigger_language
+        self._by_syntax = {}                   # (scope, name) -> bool
+        self._by_view = {}                     # view.id() -> bool
+
+    def clear(self):
+        self._languages = None
+        self._by_syntax.clear()
+        self._by_view.clear()
+
+    def enabled(self, view):
+        vid = view.id()
+        enabled = self._by_view.get(vid)
+        if enabled is None:
+            enabled = self._by_view[vid] = self._syntax_enabled(view.syntax())
+            view_settings = view.settings()
+            view_settings.clear_on_change(self.SETTINGS_KEY)
+            view_settings.add_on_change(self.SETTINGS_KEY, lambda: self._by_view.pop(vid, None))
+        return enabled
+
+    def _syntax_enabled(self, syntax):
+        if not syntax:
+            return False
+        key = (getattr(syntax, "scope", ""), getattr(syntax, "name", ""))
+        enabled = self._by_syntax.get(key)
+        if enabled is None:
+            if self._languages is None:
+                self._languages = list(self._load_languages() or [])
+            enabled = self._by_syntax[key] = is_syntax_supported(syntax, self._languages)
+        return enabled
+
+    def forget(self, view):
+        if self._by_view.pop(view.id(), None) is not None:
+            view.settings().clear_on_change(self.SETTINGS_KEY)
+
+
+_trigger_gate = TriggerGate(
+    lambda: sublime.load_settings("CodeContinue.sublime-settings").get("trigger_language", [])
+)
+on_settings_change(_trigger_gate.clear)
+
+
+def _type_through(view, state):
+    """Trim what the user just typed off the head of the phantom.
+
+    Returns True while the typed text still matches the suggestion, in which
+    case the phantom moves to the cursor and any stream keeps running.
+    """
+    sel = view.sel()
+    if len(sel) != 1 or not sel[0].empty() or state.anchor is None:
+        return False
+    cursor = sel[0].b
+    if cursor <= state.anchor:
+        return False
+    typed = view.substr(sublime.Region(state.anchor, cursor))
+    remaining = consume_typed_prefix(typed, state.remaining_lines or [])
+    if remaining is None:
+        return False
+
+    # Same bookkeeping as an accept: later lines get their stripped indent
+    # back, and streamed lines are appended rather than re-rendered.
+    if len(remaining) > 1 and state.common_prefix:
+        remaining = remaining[:1] + [state.common_prefix + ln for ln in remaining[1:]]
+    state.common_prefix = ""
+    state.consumed = True
+    state.anchor = cursor
+    _log("Type-through matched {0} chars; keeping suggestion", len(typed))
+
+    if remaining == [""] and state.streaming:
+        # Current line typed out; further lines are still arriving below it.
+        remaining = []
+        state.pending_newline = True
+    if not "\n".join(remaining):
+        if state.streaming:
+            state.remaining_lines = []
+            state.phantom_set.update([])
+        else:
+            clear_phantoms(view)
+        return True
+    state.remaining_lines = remaining
+    state.phantom_set.update([_make_phantom(cursor, remaining)])
+    return True
+
+
 class CodeContinueListener(sublime_plugin.EventListener):
     def on_modified(self, view):
-        # Clear any phantom suggestion when the user modifies text
-        # (skip clearing if we're currently accepting a suggestion).
+        # Clear any phantom suggestion and abort any request in flight when
+        # the user modifies text (skip if we're currently accepting a suggestion).
+        # Typing the suggested text keeps the phantom and the request alive.
         vid = view.id()
+        _check_chain(view)
         state = _states.get(vid)
-        if state and state.has_phantom:
-            if state.suppress_clear:
-                return
-            if time.time() < state.accept_grace_until:
-                return
+        if (not state or not state.has_phantom) and _trigger_gate.enabled(view):
+            _note_edit_for_prefetch(view, sublime.load_settings("CodeContinue.sublime-settings"))
+        if not state or state.suppress_clear:
+            return
+        if time.time() < state.accept_grace_until:
+            return
+        if state.has_phantom and _type_through(view, state):
+            return
+        _cancel_request(vid, "buffer edited")
+        if state.has_phantom:
             clear_phantoms(view)
-        return
+
+    def on_selection_modified(self, view):
+        # A request is only useful while the cursor stays where it will be shown.
+        _check_chain(view)
+        state = _states.get(view.id())
+        if not state or state.cancel_token is None or state.suppress_clear:
+            return
+        if time.time() < state.accept_grace_until:
+            return
+        sel = view.sel()
+        if len(sel) != 1 or sel[0].b != state.anchor:
+            _cancel_request(view.id(), "cursor moved")
+
+    def on_load(self, view):
+        # Views opened in the background are never activated.
+        if sublime.load_settings("CodeContinue.sublime-settings").get("retrieval_context_tokens", 0) > 0:
+            _track_for_retrieval(view)
+
+    def on_activated(self, view):
+        if sublime.load_settings("CodeContinue.sublime-settings").get("retrieval_context_tokens", 0) > 0:
+            _track_for_retrieval(view)
+
+    def on_post_save_async(self, view):
+        for index in list(_symbol_indexes.values()):
+            index.update_file(view.file_name())
+        refresh_embedding_indexes()
+
+    def on_close(self, view):
+        _cancel_request(view.id(), "view closed")
+        _drop_state(view.id())
+        if not view.clones():
+            # The snapshot and the retrieval entry belong to the buffer,
+            # which stays open while a clone shows it.
+            drop_snapshot(view)
+            _forget_for_retrieval(view)
+        _context_anchors.pop(view.id(), None)
+        for affinity in list(_kv_slots.values()):
+            affinity.forget(view.id())
+        _trigger_gate.forget(view)
+        _idle_generation.pop(view.id(), None)
+        _trigger_times.pop(view.id(), None)
+        for registry in (_prefetches, _chains):
+            job = registry.pop(view.id(), None)
+            if job is not None:
+                job.token.cancel("view closed")
 
     def on_text_command(self, view, command_name, args):
         """Trigger suggestion when the user inserts a newline (presses Enter)."""
-        settings = sublime.load_settings("CodeContinue.sublime-settings")
-        trigger_langs = settings.get("trigger_language", [])
-        if not is_syntax_supported(view.syntax(), trigger_langs):
+        # Runs for every text command: reject on the cheap checks first.
+        if command_name != "insert" or not args or args.get("characters") != "\n":
+            return
+        if not _trigger_gate.enabled(view):
             return
 
-        if command_name == "insert" and args and args.get("characters") == "\n":
-            _log("Enter pressed; evaluating trigger")
-            vid = view.id()
-            state = _states.get(vid)
-            if state and state.has_phantom:
-                if state.remaining_lines and len(state.remaining_lines) > 0:
-                    _log("Enter ignored because cached suggestion exists")
-                    return
-                _log("Enter ignored because phantom already visible")
-                return
-            now = time.time()
-            st = _get_state(vid)
-            if now - st.last_request_time < 1.0:
-                _log("Enter ignored due to rate limit <1000ms")
+        _log("Enter pressed; evaluating trigger")
+        vid = view.id()
+        state = _states.get(vid)
+        if state and state.has_phantom:
+            if state.remaining_lines and len(state.remaining_lines) > 0:
+                _log("Enter ignored because cached suggestion exists")
                 return
-            st.last_request_time = now
+            _log("Enter ignored because phantom already visible")
+            return
+        _trigger_times[vid] = time.monotonic()
+        settings = sublime.load_settings("CodeContinue.sublime-settings")
+        endpoint = settings.get("endpoint", "")
+        delay, first = _configured_scheduler(settings).submit(endpoint, vid, "enter")
+        if delay == 0.0:
             # Slight delay so the cursor has moved to the new line
             sublime.set_timeout(lambda: view.run_command("code_continue_suggest"), 50)
+        elif first:
+            _log("Endpoint budget spent ({0}); queueing trigger for {1:.0f}ms",
+                 _scheduler.describe(endpoint), delay * 1000)
+            sublime.set_timeout(lambda: _resume_trigger(view, endpoint), int(delay * 1000) + 50)
+        else:
+            _log("Endpoint budget spent; replaced the queued trigger")
 
 
 class CodeContinueSuggestCommand(sublime_plugin.TextCommand):
-    def run(self, edit):
+    def run(self, edit, prefetch=False, chain=False):
         view = self.view
         settings = sublime.load_settings("CodeContinue.sublime-settings")
         endpoint = settings.get("endpoint", "")
         model = settings.get("model", "")
         max_lines = settings.get("max_context_lines", 40)
         timeout_ms = settings.get("timeout_ms", 30000) / 1000.0  # seconds
+        stream = settings.get("stream", True)
 
         if not is_endpoint_configured(settings):
             sublime.status_message("CodeContinue: Endpoint not configured. Opening configuration...")
@@ -168,101 +1299,399 @@ class CodeContinueSuggestCommand(sublime_plugin.TextCommand):
             return
         cursor = sel[0].begin()
 
-        # Build context: extract N lines around the cursor.
-        cursor_row, _cursor_col = view.rowcol(cursor)
-        lines_before = max_lines // 2
-        lines_after = max_lines // 2
-
-        total_lines = view.rowcol(view.size())[0] + 1
-        start_row = max(0, cursor_row - lines_before)
-        end_row = min(total_lines, cursor_row + lines_after + 1)
-
-        start_point = view.text_point(start_row, 0)
-        end_point = view.text_point(end_row, 0) if end_row < total_lines else view.size()
-        code = view.substr(sublime.Region(start_point, end_point))
+        system_prompt = settings.get("system_prompt", "").strip() or DEFAULT_SYSTEM_PROMPT
+        primary = Upstream(settings)
+        fim_url, fim_provider = primary.fim_url, primary.fim_provider
+        num_candidates = 1 if prefetch or chain else max(1, settings.get("num_candidates", 1))
+
+        # Inline suggestions are hedged against an optional second endpoint.
+        secondary = None
+        if not (prefetch or chain) and settings.get("secondary_endpoint", "").strip() and settings.get("secondary_model", ""):
+            secondary = Upstream(SecondarySettings(settings))
+
+        # While the endpoint is known to be down, fail now instead of
+        # tying a thread up until the connect timeout.
+        if not endpoint_health.allow(endpoint) and (secondary is None or not endpoint_health.allow(secondary.endpoint)):
+            if not (prefetch or chain):
+                sublime.status_message("CodeContinue: {0} is unreachable; retrying in the background".format(
+                    host_label(endpoint)))
+            return
 
-        cursor_offset = cursor - start_point
-        code_before = code[:cursor_offset]
-        prompt = "Continue the following code:\n{0}".format(code_before)
+        budget = settings.get("context_token_budget", 1024)
+        # The chat prompt only carries the prefix, so it gets the whole budget.
+        prefix_weight = FIM_PREFIX_WEIGHT if fim_provider is not None else 1.0
+        row, col = view.rowcol(cursor)
+        snapshot = get_snapshot(view)
+        change_count = snapshot.sync(view)
+
+        # Signatures of project symbols and snippets of open files related to
+        # the code near the cursor. FIM prefixes carry them as comments, so
+        # they need the syntax's comment marker.
+        symbol_budget = settings.get("symbol_context_tokens", 0)
+        symbols = _symbol_index(view) if symbol_budget > 0 else None
+        retrieval_budget = settings.get("retrieval_context_tokens", 0)
+        if retrieval_budget > 0:
+            _track_for_retrieval(view)
+        embedding_budget = settings.get("embedding_context_tokens", 384)
+        semantic_index = embedding_index(view.window(), settings, sublime.cache_path()) if embedding_budget > 0 else None
+        comment = None
+        if symbols is not None or retrieval_budget > 0 or semantic_index is not None:
+            comment = _line_comment(view, cursor)
+        buffer_id = view.buffer_id()
+        file_name = view.file_name()
+
+        # Keep each view on one server slot, and its context starting on the
+        # same row, so consecutive prompts share a prefix the server caches.
+        # Content-keyed prompt caches need the stable start too.
+        kv_affinity = settings.get("kv_cache_affinity", False)
+        kv_slots = settings.get("kv_cache_slots", 4)
+        stable_start = kv_affinity or getattr(primary.provider, "prompt_caching", False)
 
         vid = view.id()
+        cache = _completion_cache
+        cache.max_entries = settings.get("completion_cache_size", 64)
+        cache.ttl_s = settings.get("completion_cache_ttl_s", 300)
+
+        insert = ""
+        if prefetch:
+            job = Prefetch(row, view.substr(view.line(cursor)))
+            insert = "\n"
+        elif chain:
+            state = _states.get(vid)
+            pending = "\n".join(state.remaining_lines) if state and state.has_phantom and state.remaining_lines else ""
+            last_line = view.substr(sublime.Region(view.line(cursor).begin(), cursor)) + pending
+            last_line = last_line[last_line.rfind("\n") + 1:]
+            indent = last_line[:len(last_line) - len(last_line.lstrip(" \t"))]
+            job = Chain(cursor, pending, indent)
+            insert = pending + "\n" + indent
+
+        def read_context():
+            anchor = _context_anchors.get(vid) if stable_start else None
+            context = _read_context(snapshot, change_count, row, col, budget, prefix_weight, max_lines, insert, anchor)
+            if context is None:
+                _log("Buffer changed before the context was read; dropping request")
+                return None
+            code_before, code_after = context
+            if stable_start:
+                _context_anchors[vid] = row - code_before.count("\n") + insert.count("\n")
+            _log("Context: ~{0} tokens before the cursor, ~{1} after",
+                 estimate_tokens(code_before), estimate_tokens(code_after))
+            return code_before, code_after
+
+        def related_context(code_before, code_after, cancel):
+            """Cross-file context for the prompt: (signatures, snippets, semantic).
+
+            *cancel* is the request's CancelToken; it aborts the query embedding.
+            The semantic lookup runs alongside the others and is dropped if it
+            is not ready SEMANTIC_WAIT_S after them.
+            """
+            signatures, snippets, semantic = [], [], []
+            lookup = None
+            if semantic_index is not None:
+                semantic_start = time.monotonic()
+                query = code_before[-QUERY_BEFORE_CHARS:] + code_after[:QUERY_AFTER_CHARS]
+                exclude = (file_name, row - code_before.count("\n"), row + code_after.count("\n"))
+                lookup = _semantic_lookup(semantic_index, query, embedding_budget, exclude, cancel)
+            if symbols is not None:
+                signatures = symbols.related(code_before, code_after, symbol_budget)
+                _log("Symbol context: {0} signatures from {1}", len(signatures), symbols)
+            if retrieval_budget > 0:
+                start = time.monotonic()
+                snippets = _retrieve_snippets(buffer_id, code_before, code_after, row, retrieval_budget)
+                _log("Retrieved {0} snippets from {1} chunks in {2:.1f}ms",
+                     len(snippets), len(_chunk_index), (time.monotonic() - start) * 1000)
+            if lookup is not None:
+                try:
+                    found = lookup.result(SEMANTIC_WAIT_S)
+                except concurrent.futures.TimeoutError:
+                    _log("Semantic retrieval skipped: not ready after {0:.1f}ms", (time.monotonic() - semantic_start) * 1000)
+                except (OSError, ValueError, KeyError) as e:
+                    _log("Semantic retrieval failed: {0}", e)
+                else:
+                    seen = {text for _name, _row, text in snippets}
+                    semantic = [snippet for snippet in found if snippet[2] not in seen]
+                    _log("Semantic retrieval: {0} chunks from {1} in {2:.1f}ms",
+                         len(semantic), semantic_index, (time.monotonic() - semantic_start) * 1000)
+            return signatures, snippets, semantic
+
+        def make_cache_key(code_before, code_after, related):
+            if fim_provider is not None:
+                return cache.make_key(
+                    "fim", fim_url, model, fim_provider.template, normalize_context(code_before), code_after, related
+                )
+            return cache.make_key(
+                type(primary.provider).__name__, endpoint, model, system_prompt, normalize_context(code_before), related
+            )
+
+        def build_attempts(code_before, code_after, stream, related, upstream=primary, n=1, pin=True):
+            """The (url, provider, payload) attempts for one request, FIM first.
+
+            With *pin* and kv_cache_affinity the request goes to the view's
+            server slot; parallel candidate requests pass pin=False so they
+            do not queue behind each other on that one slot.
+            """
+            _log("Using system prompt: {0:.120}", system_prompt)
+            provider, fim = upstream.provider, upstream.fim_provider
+            # For a content-keyed prompt cache, most stable first: the system
+            # prompt never changes, the head of the code every few Enters,
+            # while the related code and the tail are recomputed on each
+            # trigger. A head too short to be cached is not split off.
+            head, tail = "", code_before
+            if getattr(provider, "prompt_caching", False):
+                head, tail = _split_for_cache(code_before)
+                if estimate_tokens(system_prompt + head) < provider.min_cache_tokens(upstream.model):
+                    head, tail = "", code_before
+            prompt = "Continue the following code:\n{0}".format(tail)
+            block = _related_prompt(related)
+            if block:
+                prompt = block + "\n" + prompt
+            messages = [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": ["Code from earlier in the file:\n" + head, prompt] if head else prompt}
+            ]
+            chat_n = n if _asks_n(upstream.endpoint, provider) else 1
+            pinned = kv_affinity and pin
+            attempts = [(upstream.endpoint, provider, provider.format_payload(
+                upstream.model, messages, 1024, 0.3, stream=stream, n=chat_n,
+                slot=_kv_slot(upstream.endpoint, vid, kv_slots) if pinned else None))]
+            if fim is not None:
+                _log("FIM request ({0}, template: {1})", fim.api, fim.template or "server")
+                fim_n = n if _asks_n(upstream.fim_url, fim) else 1
+                prefix = code_before
+                if comment:
+                    prefix = _related_prompt(related, comment) + code_before
+                fim_data = fim.format_payload(upstream.model, prefix, code_after, 1024, 0.3, stream=stream, n=fim_n,
+                                              slot=_kv_slot(upstream.fim_url, vid, kv_slots) if pinned else None)
+                attempts.insert(0, (upstream.fim_url, fim, fim_data))
+            return attempts
+
+        if prefetch or chain:
+            registry = _prefetches if prefetch else _chains
+            registry[vid] = job
+
+            timer = RequestTimer(job.flow, endpoint, model)
+
+            def background_completion():
+                completion = None
+                try:
+                    timer.lap("dispatch")
+                    context = read_context()
+                    if context is None or job.token.cancelled:
+                        return
+                    code_before, code_after = context
+                    related = related_context(code_before, code_after, job.token)
+                    job.key = make_cache_key(code_before, code_after, related)
+                    timer.lap("context")
+                    with _inflight_lock:
+                        completion = cache.peek(job.key)
+                        other = _inflight.get(job.key)
+                        if completion is None and other is None:
+                            _inflight[job.key] = job
+                    if completion is None and other is not None:
+                        other.done.wait(timeout_ms)
+                        completion = cache.peek(job.key)
+                    elif completion is None:
+                        _log("{0} started", job.label)
+                        start = time.time()
+                        response, active_provider = _open_completion(
+                            build_attempts(code_before, code_after, False, related), settings, timeout_ms, job.token, timer
+                        )
+                        first_byte_s = time.time() - start
+                        with response:
+                            raw_body = response.read()
+                        timer.lap("download")
+                        result = json.loads(raw_body.decode())
+                        completion = active_provider.parse_response(result)
+                        timer.lap("parse")
+                        _log_usage(job.label, parse_usage(result))
+                        _debounce.note_latency(time.time() - start)
+                        _scheduler.note_success(endpoint, first_byte_s)
+                        completion = clean_markdown_fences(completion)
+                        if completion:
+                            cache.put(job.key, completion)
+                        timer.lap("sanitize")
+                        timer.finish()
+                        _log("{0} finished in {1:.2f}s; completion cache: {2}", job.label, time.time() - start, cache)
+                except Exception as e:
+                    completion = None
+                    if not job.token.cancelled:
+                        _note_request_failure(endpoint, e)
+                        _log("{0} failed: {1}", job.label, str(e)[:200])
+                finally:
+                    with _inflight_lock:
+                        if _inflight.get(job.key) is job:
+                            del _inflight[job.key]
+                    job.done.set()
+                    if chain and completion and not job.token.cancelled:
+                        sublime.set_timeout(lambda: _apply_chain(view, job, completion), 0)
+                    elif registry.get(vid) is job:
+                        del registry[vid]
+
+            threading.Thread(target=background_completion, daemon=True).start()
+            return
+
+        _cancel_request(vid, "superseded")
         state = _get_state(vid)
         request_id = (vid, cursor, time.time())
+        token = CancelToken()
         state.pending_request_id = request_id
+        state.cancel_token = token
+        state.anchor = cursor
+        state.streaming = stream
+        timer = RequestTimer("suggest", endpoint, model, start=_trigger_times.pop(vid, None))
 
         sublime.status_message("CodeContinue: Fetching suggestion...")
 
         def fetch_completion():
             request_start_time = time.time()
+            timer.lap("dispatch")
             try:
                 if state.pending_request_id != request_id:
                     return
 
-                _DEFAULT_SYSTEM_PROMPT = (
-                    "You are a code completion expert. Output ONLY the code continuation "
-                    "without any markdown formatting, backticks, explanations, comments, or "
-                    "inline comments. Write clean code without any commentary. "
-                    "Do NOT include the <CURSOR_HERE> marker in your response."
-                )
-                system_prompt = settings.get("system_prompt", "").strip() or _DEFAULT_SYSTEM_PROMPT
-                _log("Using system prompt: {0}".format(system_prompt[:120]))
-
-                messages = [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": prompt}
-                ]
-                provider = get_provider(endpoint, settings)
-                data = provider.format_payload(model, messages, 1024, 0.3)
-
-                _log("Sending request to endpoint {0} (timeout: {1:.1f}s)".format(endpoint, timeout_ms))
-                req = urllib.request.Request(
-                    endpoint,
-                    data=json.dumps(data).encode(),
-                    headers=provider.build_headers(settings),
-                )
+                context = read_context()
+                if context is None:
+                    return
+                code_before, code_after = context
+                related = related_context(code_before, code_after, token)
+
+                cache_key = make_cache_key(code_before, code_after, related)
+                timer.lap("context")
+                cached = cache.get(cache_key) if cache.max_entries > 0 else None
+                with _inflight_lock:
+                    job = _inflight.get(cache_key)
+                if not cached and job is not None:
+                    _log("Waiting for the idle prefetch of this completion")
+                    job.done.wait(timeout_ms)
+                    if token.cancelled or not _is_current(vid, request_id):
+                        return
+                    cached = cache.get(cache_key)
+                if cached:
+                    _log("Cache hit; completion cache: {0}", cache)
+                    timer.flow = "suggest (cached)"
+                    sublime.set_timeout(lambda: _timed_render(timer, _show_cached, view, cursor, request_id, cached), 0)
+                    return
+
+                # Alternatives come back with the suggestion when the server
+                # supports "n"; otherwise they are sampled in parallel.
+                candidates = []
+                others = {} if num_candidates > 1 and secondary is None else None
+                attempts = build_attempts(code_before, code_after, stream, related,
+                                          n=num_candidates if others is not None else 1)
+                asked_n = {id(provider): (url, payload.get("n", 1)) for url, provider, payload in attempts}
+                if num_candidates > 1 and max(n for _url, n in asked_n.values()) == 1:
+                    _sample_candidates(view, build_attempts(code_before, code_after, False, related, pin=False), settings,
+                                       timeout_ms, num_candidates - 1, candidates)
                 response_start_time = time.time()
-                with urllib.request.urlopen(req, timeout=timeout_ms) as response:
+                if secondary is None:
+                    response, active_provider = _open_completion(attempts, settings, timeout_ms, token, timer)
+                    upstream, deltas = primary, None
+                else:
+                    legs = [(primary, attempts), (secondary, build_attempts(code_before, code_after, stream, related, secondary))]
+                    delay_s = hedge_delay(settings, attempts[0][0], model)
+                    response, active_provider, upstream, deltas = _open_hedged(
+                        legs, delay_s, timeout_ms, token, timer, stream
+                    )
+                with response:
                     response_received_time = time.time()
-                    raw_body = response.read().decode()
-                    _log("Raw response body: {0}".format(raw_body[:2000]))
-                    result = json.loads(raw_body)
-                    _log("Parsed response: {}".format(result))
-                    completion = provider.parse_response(result)
-                    parse_complete_time = time.time()
-
-                    response_time = response_received_time - response_start_time
-                    parse_time = parse_complete_time - response_received_time
-                    total_time = parse_complete_time - request_start_time
-                    _log("Response received: {0:.2f}s (network), {1:.3f}s (parse), total {2:.2f}s".format(response_time, parse_time, total_time))
-
+                    if stream:
+                        completion = _read_stream(view, cursor, request_id, response, active_provider, token, deltas, others)
+                        if completion is None:
+                            _log("Stream abandoned: request superseded or cancelled")
+                            return
+                        parse_complete_time = time.time()
+                        timer.lap("download")
+
+                        response_time = response_received_time - response_start_time
+                        stream_time = parse_complete_time - response_received_time
+                        total_time = parse_complete_time - request_start_time
+                        _log("Stream finished: {0:.2f}s (headers), {1:.2f}s (streaming), total {2:.2f}s", response_time, stream_time, total_time)
+                        _log_usage("Suggestion", getattr(response, "usage", None))
+                    else:
+                        raw_body = response.read().decode()
+                        timer.lap("download")
+                        _log("Raw response body: {0:.2000}", raw_body)
+                        result = json.loads(raw_body)
+                        _log("Parsed response: {0}", result)
+                        if others is not None and hasattr(active_provider, "parse_candidates"):
+                            completion, *alternatives = active_provider.parse_candidates(result)
+                            others.update(enumerate(alternatives, 1))
+                        else:
+                            completion = active_provider.parse_response(result)
+                        parse_complete_time = time.time()
+                        timer.lap("parse")
+
+                        response_time = response_received_time - response_start_time
+                        parse_time = parse_complete_time - response_received_time
+                        total_time = parse_complete_time - request_start_time
+                        _log("Response received: {0:.2f}s (network), {1:.3f}s (parse), total {2:.2f}s", response_time, parse_time, total_time)
+                        _log_usage("Suggestion", parse_usage(result))
+
+                    _debounce.note_latency(time.time() - response_start_time)
+                    if upstream is primary:
+                        # Time to the headers: streaming time is generation, not load.
+                        _scheduler.note_success(endpoint, response_received_time - response_start_time)
                     completion = clean_markdown_fences(completion)
+                    if completion:
+                        cache.put(cache_key, completion)
+                        _log("Completion cache: {0}", cache)
+                    alternatives = [clean_markdown_fences(others[i]) for i in sorted(others or ())]
+                    url, n = asked_n.get(id(active_provider), (None, 1))
+                    if n > 1 and not alternatives:
+                        _n_unsupported.add(url)
+                        _log("{0} ignored n={1}; sampling candidates in parallel from now on", url, n)
+                        _sample_candidates(view, build_attempts(code_before, code_after, False, related, pin=False), settings,
+                                           timeout_ms, num_candidates - 1, candidates)
+                    timer.lap("sanitize")
 
                     if state.pending_request_id == request_id and completion:
-                        sublime.set_timeout(lambda: show_phantom(view, cursor, completion), 0)
+                        if stream:
+                            sublime.set_timeout(lambda: _timed_render(
+                                timer, update_stream_phantom, view, cursor, request_id, completion, True), 0)
+                        else:
+                            sublime.set_timeout(lambda: _timed_render(timer, show_phantom, view, cursor, completion), 0)
+                        if num_candidates > 1:
+                            sublime.set_timeout(lambda: _add_candidates(
+                                view, candidates, [completion] + alternatives, main=True), 0)
                     elif state.pending_request_id == request_id:
+                        state.streaming = False
                         sublime.set_timeout(lambda: sublime.status_message("CodeContinue: Empty response"), 0)
+            except RequestCancelled as e:
+                _log("Request cancelled before the response arrived ({0})", e)
             except urllib.error.URLError as e:
+                if token.cancelled:
+                    return
+                _note_request_failure(endpoint, e)
                 elapsed = time.time() - request_start_time
-                _log_error("Network error after {0:.2f}s: {1}".format(elapsed, str(e)[:200]))
+                _log_error("Network error after {0:.2f}s: {1}", elapsed, str(e)[:200])
                 if state.pending_request_id == request_id:
                     msg = "CodeContinue: Network error - {0}".format(str(e)[:50])
                     sublime.set_timeout(lambda: sublime.status_message(msg), 0)
             except (ValueError, KeyError) as e:
+                if token.cancelled:
+                    return
                 elapsed = time.time() - request_start_time
-                _log_error("Parse error after {0:.2f}s: {1}".format(elapsed, str(e)[:200]))
+                _log_error("Parse error after {0:.2f}s: {1}", elapsed, str(e)[:200])
                 try:
-                    _log_error("Raw body that failed to parse: {0}".format(raw_body[:2000]))
+                    _log_error("Raw body that failed to parse: {0:.2000}", raw_body)
                 except NameError:
                     pass  # raw_body not set; error occurred before read()
                 if state.pending_request_id == request_id:
                     msg = "CodeContinue: Parse error - {0}".format(str(e)[:50])
                     sublime.set_timeout(lambda: sublime.status_message(msg), 0)
             except Exception as e:
+                if token.cancelled:
+                    return
                 elapsed = time.time() - request_start_time
-                _log_error("Unexpected error after {0:.2f}s: {1}".format(elapsed, str(e)[:200]))
+                _log_error("Unexpected error after {0:.2f}s: {1}", elapsed, str(e)[:200])
                 if state.pending_request_id == request_id:
                     msg = "CodeContinue: Unexpected error - {0}".format(str(e)[:50])
                     sublime.set_timeout(lambda: sublime.status_message(msg), 0)
+            finally:
+                if state.cancel_token is token:
+                    state.cancel_token = None
+                if stream:
+                    sublime.set_timeout(lambda: end_stream(view, request_id), 0)
 
         threading.Thread(target=fetch_completion, daemon=True).start()
 
@@ -277,7 +1706,8 @@ class CodeContinueAcceptCommand(sublime_plugin.TextCommand):
 
         remaining = state.remaining_lines
         if not isinstance(remaining, list) or len(remaining) == 0:
-            clear_phantoms(view)
+            if not state.streaming:
+                clear_phantoms(view)
             return
 
         sel = view.sel()
@@ -308,55 +1738,209 @@ class CodeContinueAcceptCommand(sublime_plugin.TextCommand):
             new_cursor = insert_pos + len(text_to_insert)
             view.sel().clear()
             view.sel().add(sublime.Region(new_cursor, new_cursor))
+            state.consumed = True
+            state.anchor = new_cursor
 
             if rem_lines:
-                preview = "\n".join(rem_lines)
-                ph = state.phantom_set
-                ph.update([sublime.Phantom(
-                    sublime.Region(new_cursor, new_cursor),
-                    '<span style="color: gray">{0}</span>'.format(html.escape(preview)),
-                    sublime.LAYOUT_INLINE,
-                )])
+                state.phantom_set.update([_make_phantom(new_cursor, rem_lines)])
                 state.remaining_lines = rem_lines
                 view.set_status('code_continue_visible', 'true')
+            elif state.streaming:
+                # More lines are still arriving; they continue below this one.
+                state.phantom_set.update([])
+                state.remaining_lines = []
+                state.pending_newline = True
             else:
                 clear_phantoms(view)
+
+            # With a line or two left, ask for what comes after them now.
+            if len(rem_lines) <= 1 and not state.streaming:
+                _start_chain(view)
         finally:
             # Keep a short grace window to avoid immediate on_modified clearing
             state.accept_grace_until = time.time() + 0.2
             state.suppress_clear = False
 
 
-def show_phantom(view, cursor, suggestion):
-    clear_phantoms(view)
-    vid = view.id()
-    state = _get_state(vid)
+def _make_phantom(point, lines):
+    return sublime.Phantom(
+        sublime.Region(point, point),
+        '<span style="color: gray">{0}</span>'.format(html.escape("\n".join(lines))),
+        sublime.LAYOUT_INLINE,
+    )
 
-    phantom_set = sublime.PhantomSet(view)
 
-    lines = suggestion.split('\n')
+def _render_lines(view, state, cursor, lines):
+    """Normalise *lines* and draw them as the view's phantom at *cursor*."""
     if len(lines) > 0 and lines[-1] == "":
         lines = lines[:-1]
 
     norm_lines, common_prefix = strip_common_indent(lines)
 
-    preview = "\n".join(norm_lines)
-    if not preview:
+    if not "\n".join(norm_lines):
         return
 
-    phantom = sublime.Phantom(
-        sublime.Region(cursor, cursor),
-        '<span style="color: gray">{0}</span>'.format(html.escape(preview)),
-        sublime.LAYOUT_INLINE,
-    )
-    phantom_set.update([phantom])
+    if state.phantom_set is None:
+        state.phantom_set = sublime.PhantomSet(view)
+    state.phantom_set.update([_make_phantom(cursor, norm_lines)])
 
-    state.phantom_set = phantom_set
     state.remaining_lines = norm_lines
     state.common_prefix = common_prefix
+    state.anchor = cursor
     view.set_status('code_continue_visible', 'true')
 
 
+def _timed_render(timer, render, *args):
+    """Run a phantom update on the UI thread and close *timer* with its render stage."""
+    render(*args)
+    timer.lap("render")
+    timer.finish()
+
+
+def _show_cached(view, cursor, request_id, suggestion):
+    if not _is_current(view.id(), request_id):
+        return
+    show_phantom(view, cursor, suggestion)
+    sublime.status_message("CodeContinue: Suggestion (cached)")
+
+
+def _add_candidates(view, candidates, texts, main=False):
+    """Merge *texts* into a request's candidate list (UI thread).
+
+    With *main*, the first text is the suggestion just rendered: it goes
+    first, and the list is attached to the phantom so it can be cycled.
+    Duplicates and empty texts are dropped.
+    """
+    if main:
+        if texts[0] in candidates:
+            candidates.remove(texts[0])
+        candidates.insert(0, texts[0])
+        texts = texts[1:]
+    for text in texts:
+        if text and text not in candidates:
+            candidates.append(text)
+    state = _states.get(view.id())
+    if main:
+        if state is None or not state.has_phantom:
+            return
+        state.candidates = candidates
+        state.candidate_index = 0
+    elif state is None or state.candidates is not candidates:
+        return
+    if len(candidates) > 1:
+        sublime.status_message("CodeContinue: Suggestion {0} of {1}".format(state.candidate_index + 1, len(candidates)))
+
+
+def _cycle_candidate(view, step):
+    """Swap the phantom for the next (*step* 1) or previous (-1) candidate."""
+    state = _states.get(view.id())
+    if not state or not state.has_phantom or state.streaming or state.consumed:
+        return
+    candidates = state.candidates
+    if not candidates or len(candidates) < 2:
+        sublime.status_message("CodeContinue: No other suggestions")
+        return
+    state.candidate_index = (state.candidate_index + step) % len(candidates)
+    _render_lines(view, state, state.anchor, candidates[state.candidate_index].split("\n"))
+    sublime.status_message("CodeContinue: Suggestion {0} of {1}".format(state.candidate_index + 1, len(candidates)))
+
+
+class CodeContinueNextSuggestionCommand(sublime_plugin.TextCommand):
+    """Show the next candidate (see `num_candidates`)."""
+
+    def run(self, edit):
+        _cycle_candidate(self.view, 1)
+
+
+class CodeContinuePreviousSuggestionCommand(sublime_plugin.TextCommand):
+    """Show the previous candidate (see `num_candidates`)."""
+
+    def run(self, edit):
+        _cycle_candidate(self.view, -1)
+
+
+def show_phantom(view, cursor, suggestion):
+    clear_phantoms(view)
+    state = _get_state(view.id())
+    _render_lines(view, state, cursor, suggestion.split('\n'))
+
+
+def _read_stream(view, cursor, request_id, response, provider, token, deltas=None, others=None):
+    """Accumulate a streamed reply, growing the phantom one complete line at a time.
+
+    *deltas* continues a stream whose first delta was already read (see
+    `_open_answer`). *others* collects the other choices of an `n` > 1
+    request (see `iter_stream_text`). Returns the full raw completion, or
+    None once the request was superseded or cancelled.
+    """
+    vid = view.id()
+    text = ""
+    shown = 0
+    if deltas is None:
+        deltas = iter_stream_text(response, provider, others)
+    for delta in deltas:
+        if token.cancelled or not _is_current(vid, request_id):
+            return None
+        text += delta
+        if "\n" not in delta:
+            continue
+        complete = clean_markdown_fences(text[:text.rfind("\n")])
+        count = complete.count("\n") + 1 if complete else 0
+        if count > shown:
+            shown = count
+            sublime.set_timeout(lambda c=complete: update_stream_phantom(view, cursor, request_id, c), 0)
+    if token.cancelled:
+        # A closed socket can look like a clean end of stream.
+        return None
+    return text
+
+
+def update_stream_phantom(view, cursor, request_id, text, done=False):
+    """Render the completed lines of a streamed suggestion.
+
+    Until the user accepts a line the whole phantom is re-rendered from the
+    cleaned text; afterwards only newly arrived lines are appended to
+    `remaining_lines` so accepted lines are not shown twice.
+    """
+    state = _states.get(view.id())
+    if not state or state.pending_request_id != request_id:
+        return
+    if done:
+        state.streaming = False
+
+    lines = text.split('\n') if text else []
+    if not state.consumed:
+        _render_lines(view, state, cursor, lines)
+    else:
+        new_lines = lines[state.stream_lines:]
+        if new_lines:
+            # Accepted lines are re-indented absolutely, and so are raw streamed lines.
+            state.common_prefix = ""
+            if state.pending_newline:
+                new_lines.insert(0, "")
+                state.pending_newline = False
+            state.remaining_lines.extend(new_lines)
+            state.phantom_set.update([_make_phantom(state.anchor, state.remaining_lines)])
+            view.set_status('code_continue_visible', 'true')
+    state.stream_lines = len(lines)
+
+    if done and not state.remaining_lines:
+        clear_phantoms(view)
+
+
+def end_stream(view, request_id):
+    """Mark a streamed suggestion finished, dropping an emptied phantom.
+
+    Idempotent: runs after every streamed request, including failed ones.
+    """
+    state = _states.get(view.id())
+    if not state or state.pending_request_id != request_id:
+        return
+    state.streaming = False
+    if state.has_phantom and not state.remaining_lines:
+        clear_phantoms(view)
+
+
 def clear_phantoms(view):
     vid = view.id()
     state = _states.get(vid)
@@ -0,0 +1,372 @@
+"""Project symbol index: function and class signatures from the open folders.
+
+Suggestions only see the text around the cursor, so calls into the rest of
+the project are guessed. A `SymbolIndex` scans the project folders for
+declarations (the same patterns `describe_code_selection` uses), keeps the
+signature line of each, and hands the suggest flow the signatures of
+identifiers used near the cursor, within a small token budget.
+
+Scans are incremental: a file is re-read only when its mtime changed. The
+index is persisted as JSON between sessions, so a restart only stats the
+tree. Scanning runs on a background thread; lookups never touch the disk.
+
+No Sublime imports.
+"""
+
+import json
+import keyword
+import os
+import re
+import threading
+import time
+
+from .text_utils import _CLASS_PATTERNS, _FUNC_PATTERNS, estimate_tokens
+
+
+INDEX_VERSION = 1
+
+SOURCE_EXTENSIONS = frozenset((
+    ".py", ".pyi", ".js", ".jsx", ".mjs", ".ts", ".tsx", ".go", ".rs",
+    ".c", ".h", ".cc", ".cpp", ".cxx", ".hpp", ".hh", ".java", ".cs",
+))
+
+# Directories never worth scanning (dot-directories are skipped as well).
+SKIP_DIRS = frozenset((
+    "node_modules", "__pycache__", "venv", "env", "build", "dist", "target",
+    "vendor", "site-packages", "bower_components",
+))
+
+MAX_FILE_BYTES = 512 * 1024
+MAX_FILES = 20000
+
+# Longest signature kept, after joining the lines of a wrapped parameter list.
+MAX_SIGNATURE_CHARS = 200
+MAX_SIGNATURE_LINES = 6
+
+# A name declared in more places than this is too ambiguous to help.
+MAX_DEFINITIONS = 3
+
+# How far around the cursor identifiers are collected, in characters.
+NEAR_BEFORE_CHARS = 1500
+NEAR_AFTER_CHARS = 500
+
+_IDENTIFIER_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]{2,}")
+
+# Statements the loose C-family pattern would otherwise take for declarations
+# (`return foo(x);`, `} else if (x) {`, `with open(p) as f:`).
+_STATEMENT_RE = re.compile(r"^\s*(?:{0})\b".format("|".join(sorted(
+    set(keyword.kwlist) - {"def", "class", "async"}
+    | {"switch", "case", "new", "delete", "throw", "do", "catch", "goto", "typedef"}
+))))
+
+_NOT_NAMES = frozenset(keyword.kwlist) | frozenset((
+    "self", "cls", "this", "super", "function", "const", "let", "var", "return",
+    "true", "false", "null", "undefined", "void", "int", "str", "string", "bool",
+    "sizeof", "typeof", "instanceof", "switch", "case", "default", "catch",
+))
+
+
+def extract_symbols(text):
+    """Return [(name, line, signature)] for the declarations in *text*.
+
+    *line* is 1-based. A parameter list wrapped over several lines is
+    joined onto one, up to MAX_SIGNATURE_LINES lines.
+    """
+    lines = text.split("\n")
+    symbols = []
+    for i, line in enumerate(lines):
+        if len(line) > MAX_SIGNATURE_CHARS * 2 or _STATEMENT_RE.match(line):
+            continue
+        name = None
+        for pattern in _CLASS_PATTERNS:
+            m = pattern.match(line)
+            if m:
+                name = m.group(1)
+                break
+        else:
+            for pattern in _FUNC_PATTERNS:
+                m = pattern.match(line)
+                if m:
+                    name = m.group(1)
+                    break
+        if name is None or name in _NOT_NAMES:
+            continue
+        signature = line.strip()
+        depth = signature.count("(") - signature.count(")")
+        j = i + 1
+        while depth > 0 and j < len(lines) and j - i < MAX_SIGNATURE_LINES:
+            more = lines[j].strip()
+            signature += ("" if signature.endswith("(") else " ") + more
+            depth += more.count("(") - more.count(")")
+            j += 1
+        signature = signature.rstrip(" {")[:MAX_SIGNATURE_CHARS]
+        symbols.append((name, i + 1, signature))
+    return symbols
+
+
+def format_related(entries, comment=""):
+    """Render (relpath, signature) pairs as a prompt block.
+
+    With *comment* (a line-comment marker such as "#" or "//") every line is
+    commented out, for prompts that must stay valid code (FIM prefixes).
+    """
+    if not entries:
+        return ""
+    prefix = comment + " " if comment else ""
+    out = [prefix + "Related definitions elsewhere in the project:"]
+    current = None
+    for relpath, signature in entries:
+        if relpath != current:
+            out.append(prefix + relpath + ":")
+            current = relpath
+        out.append(prefix + "  " + signature)
+    return "\n".join(out) + "\n"
+
+
+def source_files(folders):
+    """Yield the source files under *folders*, skipping SKIP_DIRS and dot-directories."""
+    for folder in folders:
+        for root, dirs, files in os.walk(folder):
+            dirs[:] = [d for d in dirs if not d.startswith(".") and d not in SKIP_DIRS]
+            for filename in files:
+                if os.path.splitext(filename)[1].lower() in SOURCE_EXTENSIONS:
+                    yield os.path.join(root, filename)
+
+
+def relative_path(path, folders):
+    """*path* relative to the folder containing it, with forward slashes."""
+    for folder in folders:
+        if path.startswith(folder.rstrip(os.sep) + os.sep):
+            return os.path.relpath(path, folder).replace(os.sep, "/")
+    return os.path.basename(path)
+
+
+class SymbolIndex:
+    """Declarations in the files under *folders*, persisted at *path*.
+
+    Thread-safe: the scan thread updates the tables while suggest workers
+    look names up.
+    """
+
+    def __init__(self, folders, path=None):
+        self.folders = tuple(folders)
+        self.path = path
+        self.refreshed_at = None    # time.monotonic() of the last finished scan
+        self.truncated = False      # the last scan stopped at MAX_FILES
+        self._files = {}            # abs path -> (mtime, [(name, line, signature)])
+        self._names = {}            # name -> [(abs path, line, signature)]
+        self._dirty = False         # changed since the last save
+        self._loaded = False
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    # -- tables --------------------------------------------------------------
+
+    def _set_file(self, path, mtime, symbols):
+        """Replace *path*'s entries (lock held)."""
+        old = self._files.get(path)
+        if old is not None:
+            for name in {s[0] for s in old[1]}:
+                remaining = [e for e in self._names.get(name, ()) if e[0] != path]
+                if remaining:
+                    self._names[name] = remaining
+                else:
+                    self._names.pop(name, None)
+        if symbols is None:
+            self._files.pop(path, None)
+        else:
+            self._files[path] = (mtime, symbols)
+            for name, line, signature in symbols:
+                self._names.setdefault(name, []).append((path, line, signature))
+        self._dirty = True
+
+    def __len__(self):
+        return len(self._names)
+
+    def describe(self):
+        return "{0} names in {1} files{2}".format(
+            len(self._names), len(self._files), " (truncated)" if self.truncated else "")
+
+    __str__ = describe  # lets _log format it lazily
+
+    def covers(self, path):
+        """True if *path* is a source file under one of the folders."""
+        return (
+            os.path.splitext(path)[1].lower() in SOURCE_EXTENSIONS
+            and any(path.startswith(folder.rstrip(os.sep) + os.sep) for folder in self.folders)
+        )
+
+    # -- scanning ------------------------------------------------------------
+
+    def _source_files(self):
+        self.truncated = False
+        for count, path in enumerate(source_files(self.folders)):
+            if count == MAX_FILES:
+                self.truncated = True
+                return
+            yield path
+
+    @staticmethod
+    def _parse_file(path, stat):
+        if stat.st_size > MAX_FILE_BYTES:
+            return []
+        try:
+            with open(path, encoding="utf-8", errors="replace") as f:
+                return extract_symbols(f.read())
+        except OSError:
+            return None
+
+    def update_file(self, path):
+        """Re-read one file now (e.g. after a save); no-op outside the folders."""
+        if not path or not self.covers(path):
+            return
+        try:
+            stat = os.stat(path)
+        except OSError:
+            with self._lock:
+                if path in self._files:
+                    self._set_file(path, None, None)
+            return
+        symbols = self._parse_file(path, stat)
+        with self._lock:
+            self._set_file(path, stat.st_mtime, symbols)
+
+    def refresh(self):
+        """Scan the folders, re-reading files whose mtime changed.
+
+        Returns the number of files added, changed or removed.
+        """
+        with self._lock:
+            known = {path: entry[0] for path, entry in self._files.items()}
+        seen = set()
+        changed = 0
+        for path in self._source_files():
+            seen.add(path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if known.get(path) == stat.st_mtime:
+                continue
+            symbols = self._parse_file(path, stat)
+            with self._lock:
+                self._set_file(path, stat.st_mtime, symbols)
+            changed += 1
+        with self._lock:
+            for path in set(known) - seen:
+                self._set_file(path, None, None)
+                changed += 1
+            self.refreshed_at = time.monotonic()
+        return changed
+
+    def refresh_async(self, min_interval_s=0.0, on_done=None):
+        """Load, scan and save on a background thread.
+
+        Does nothing while a scan is running or when the last one finished
+        less than *min_interval_s* ago. *on_done(changed, seconds, error)*
+        runs on the scan thread when it finishes.
+        """
+        with self._lock:
+            if self._refreshing:
+                return
+            if self.refreshed_at is not None and time.monotonic() - self.refreshed_at < min_interval_s:
+                return
+            self._refreshing = True
+
+        def scan():
+            start = time.monotonic()
+            changed, error = 0, None
+            try:
+                if not self._loaded:
+                    self.load()
+                changed = self.refresh()
+                if self._dirty:
+                    self.save()
+            except Exception as e:
+                error = e
+            finally:
+                with self._lock:
+                    self._refreshing = False
+            if on_done is not None:
+                on_done(changed, time.monotonic() - start, error)
+
+        threading.Thread(target=scan, name="CodeContinue symbol index", daemon=True).start()
+
+    # -- persistence ---------------------------------------------------------
+
+    def load(self):
+        """Read the saved index, if it is for the same folders and version."""
+        self._loaded = True
+        if not self.path:
+            return False
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get("version") != INDEX_VERSION or tuple(data.get("folders", ())) != self.folders:
+            return False
+        with self._lock:
+            for path, (mtime, symbols) in data.get("files", {}).items():
+                self._set_file(path, mtime, [tuple(s) for s in symbols])
+            self._dirty = False
+        return True
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            data = {
+                "version": INDEX_VERSION,
+                "folders": list(self.folders),
+                "files": {path: [mtime, symbols] for path, (mtime, symbols) in self._files.items()},
+            }
+            self._dirty = False
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, separators=(",", ":"))
+        os.replace(tmp, self.path)
+
+    # -- lookup --------------------------------------------------------------
+
+    def related(self, code_before, code_after, budget):
+        """Signatures of the identifiers near the cursor, nearest first.
+
+        Returns [(relpath, signature)] that `format_related` renders in
+        about *budget* tokens. Declarations already visible in the context
+        and names declared in more than MAX_DEFINITIONS places are left out.
+        """
+        near_before = code_before[-NEAR_BEFORE_CHARS:]
+        near_after = code_after[:NEAR_AFTER_CHARS]
+        names = list(reversed(_IDENTIFIER_RE.findall(near_before))) + _IDENTIFIER_RE.findall(near_after)
+        context = code_before + code_after
+        entries = []
+        seen = set()
+        used = estimate_tokens(format_related([("", "")]))
+        with self._lock:
+            for name in names:
+                if name in seen or name in _NOT_NAMES:
+                    continue
+                seen.add(name)
+                definitions = self._names.get(name)
+                if not definitions or len(definitions) > MAX_DEFINITIONS:
+                    continue
+                for path, _line, signature in definitions:
+                    if signature in context:
+                        continue
+                    relpath = relative_path(path, self.folders)
+                    cost = estimate_tokens(relpath + signature) + 2
+                    if used + cost > budget:
+                        return self._grouped(entries)
+                    used += cost
+                    entries.append((relpath, signature))
+        return self._grouped(entries)
+
+    @staticmethod
+    def _grouped(entries):
+        """Keep nearest-first order, but list each file's entries together."""
+        order = {}
+        for relpath, _signature in entries:
+            order.setdefault(relpath, len(order))
+        return sorted(entries, key=lambda entry: order[entry[0]])
@@ -64,6 +64,158 @@ def strip_common_indent(lines):
     return [ln[min_indent:] if len(ln) >= min_indent else ln for ln in lines], common_prefix
 
 
+def consume_typed_prefix(typed, lines):
+    """Remove text the user typed over from the head of a suggestion.
+
+    *typed* is what was inserted at the suggestion anchor; *lines* are the
+    suggestion's remaining lines. Returns the lines still left to show, or
+    None as soon as the typed text diverges from the suggestion.
+
+    The first line must match exactly. Each newline in *typed* finishes the
+    current suggestion line (which must then be fully typed, trailing
+    whitespace aside) and continues on the next one, where leading
+    whitespace is ignored on both sides because the editor auto-indents.
+    """
+    remaining = list(lines)
+    segments = typed.split("\n")
+    for i, segment in enumerate(segments):
+        if not remaining:
+            return None
+        head = remaining[0]
+        if i > 0:
+            segment = segment.lstrip(" \t")
+            head = head.lstrip(" \t")
+        if not head.startswith(segment):
+            return None
+        rest = head[len(segment):]
+        if i < len(segments) - 1:
+            if rest.strip():
+                return None
+            remaining.pop(0)
+        else:
+            remaining[0] = rest
+    return remaining
+
+
+def splice_lines(lines, a_row, a_col, b_row, b_col, text):
+    """Replace the span (a_row, a_col)-(b_row, b_col) of *lines* with *text*, in place.
+
+    *lines* is a document split on "\\n". Mirrors one buffer edit, so a line
+    list can track a document from its change deltas without re-reading it.
+    """
+    head = lines[a_row][:a_col]
+    tail = lines[b_row][b_col:]
+    new = (head + text + tail).split("\n")
+    lines[a_row:b_row + 1] = new
+
+
+def slice_around(lines, row, col, reach):
+    """Return (before, after) text around (row, col), about *reach* chars each way.
+
+    Whole lines are collected outward until *reach* is covered; the cursor
+    line is cut to *reach* on each side so one huge line stays bounded.
+    """
+    line = lines[row]
+    parts = [line[:col][-reach:]]
+    size = len(parts[0])
+    r = row - 1
+    while r >= 0 and size < reach:
+        parts.append(lines[r])
+        size += len(lines[r]) + 1
+        r -= 1
+    before = "\n".join(reversed(parts))
+
+    parts = [line[col:col + reach]]
+    size = len(parts[0])
+    r = row + 1
+    while r < len(lines) and size < reach:
+        parts.append(lines[r])
+        size += len(lines[r]) + 1
+        r += 1
+    return before, "\n".join(parts)
+
+
+def slice_lines(lines, row, col, above, below):
+    """Return (before, after) text for a fixed window of lines around (row, col)."""
+    start = max(0, row - above)
+    end = min(len(lines), row + below + 1)
+    before = "\n".join(lines[start:row] + [lines[row][:col]])
+    after = "\n".join([lines[row][col:]] + lines[row + 1:end])
+    if end < len(lines):
+        after += "\n"
+    return before, after
+
+
+# Rough characters-per-token ratio for source code with BPE tokenizers.
+CHARS_PER_TOKEN = 3.5
+
+
+def estimate_tokens(text):
+    """Fast token estimate for *text* (no tokenizer; ~CHARS_PER_TOKEN chars each)."""
+    if not text:
+        return 0
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+
+def _take_lines(lines, allowance):
+    """Count how many of *lines* fit in *allowance* tokens, in order."""
+    used = 0
+    count = 0
+    for line in lines:
+        cost = estimate_tokens(line + "\n")
+        if used + cost > allowance:
+            break
+        used += cost
+        count += 1
+    return count, used
+
+
+def build_context(before, after, budget, prefix_weight=0.75):
+    """Trim the text around the cursor to roughly *budget* tokens.
+
+    *before* and *after* are the text on either side of the cursor. The
+    cursor line is always kept; whole lines are then added outward from the
+    cursor, with *prefix_weight* of the budget reserved for the code before
+    it. Budget one side leaves unused goes to the other. Indentation alone on
+    the cursor line is not charged, so the context is the same just before
+    and just after an auto-indenting Enter.
+
+    Returns (code_before, code_after).
+    """
+    before_lines = before.split("\n")
+    after_lines = after.split("\n")
+    remaining = budget - estimate_tokens(before_lines[-1].lstrip(" \t")) - estimate_tokens(after_lines[0])
+
+    above = before_lines[-2::-1]
+    below = after_lines[1:]
+    n_above, used_above = _take_lines(above, remaining * prefix_weight)
+    n_below, used_below = _take_lines(below, remaining - used_above)
+    if n_below == len(below):
+        n_above, used_above = _take_lines(above, remaining - used_below)
+
+    code_before = "\n".join(before_lines[len(before_lines) - 1 - n_above:])
+    code_after = "\n".join(after_lines[:1 + n_below])
+    return code_before, code_after
+
+
+def extend_to_anchor(code_before, lines, covered, allowance):
+    """Start *code_before* at an earlier row again, if it costs little.
+
+    *lines* runs from that row (the first row of the previous request's
+    context) to the row above the cursor; the last *covered* of them are
+    already in *code_before*. The missing ones are prepended when they fit
+    in *allowance* tokens, so the prompt keeps the previous request's
+    prefix and a server with a prompt cache only processes the new text.
+    """
+    missing = lines[:max(0, len(lines) - covered)]
+    if not missing:
+        return code_before
+    count, _used = _take_lines(missing, allowance)
+    if count < len(missing):
+        return code_before
+    return "\n".join(missing) + "\n" + code_before
+
+
 _FUNC_PATTERNS = [
     # Python def / async def
     re.compile(r"^\s*(?:async\s+)?def\s+([a-zA-Z_][a-zA-Z0-9_]*)"),